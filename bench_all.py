@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+"""Benchmarks for machfs, with machine-readable output for comparing commits
+
+    python3 bench_all.py --scale 0.1 -o before.json
+    python3 bench_all.py --scale 0.1 -o after.json
+    python3 bench_all.py --compare before.json after.json
+"""
+
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from machfs import Volume, Folder, File, OutOfSpaceError
+from machfs import btree, bitmanip
+from machfs.main import _catalog_rec_sort
+from macresources import Resource, make_file
+
+
+########################################################################
+# Synthetic volumes
+
+def vol_tiny(scale):
+    """100k tiny files in 100 folders (most forks empty, to fit in 65535 blocks)"""
+    v = Volume()
+    nfiles = int(100000 * scale)
+    for i in range(nfiles):
+        folder = 'Folder %d' % (i % 100)
+        if folder not in v: v[folder] = Folder()
+        f = File()
+        if i % 4 == 0: f.data = b'tiny %d' % i
+        v[folder]['file %d' % i] = f
+    return v
+
+
+def vol_deep(scale):
+    """Folders nested 100 deep, a few files at each level"""
+    v = Volume()
+    here = v
+    for depth in range(max(int(100 * scale), 2)):
+        for i in range(3):
+            f = File()
+            f.data = b'level %d' % depth
+            here['file %d' % i] = f
+        here['deeper'] = Folder()
+        here = here['deeper']
+    return v
+
+
+def vol_huge(scale):
+    """A few forks of tens of megabytes"""
+    v = Volume()
+    for i in range(3):
+        f = File()
+        f.data = bytes([i]) * int(64*1024*1024 * scale)
+        f.rsrc = make_file([Resource(b'snd ', 128, data=bytes(int(1024*1024 * scale)))])
+        v['movie %d' % i] = f
+    return v
+
+
+def vol_aliases(scale):
+    """Half files, half aliases to those files and their folders"""
+    v = Volume()
+    n = max(int(2000 * scale), 1)
+    v['Targets'] = Folder()
+    v['Aliases'] = Folder()
+    for i in range(n):
+        f = File()
+        f.type, f.creator = b'APPL', b'ttxt'
+        f.data = b'app %d' % i
+        v['Targets']['app %d' % i] = f
+        a = File()
+        a.aliastarget = f if i % 10 else v['Targets']
+        v['Aliases']['alias %d' % i] = a
+    return v
+
+
+def vol_rsrc(scale):
+    """Many files with busy resource forks"""
+    v = Volume()
+    for i in range(max(int(2000 * scale), 1)):
+        f = File()
+        f.type, f.creator = b'rsrc', b'RSED'
+        f.rsrc = make_file([Resource(b'STR#', rid, name='string list %d' % rid, data=bytes(100)) for rid in range(20)])
+        v['resources %d' % i] = f
+    return v
+
+
+SCENARIOS = {
+    'tiny': vol_tiny,
+    'deep': vol_deep,
+    'huge': vol_huge,
+    'aliases': vol_aliases,
+    'rsrc': vol_rsrc,
+}
+
+
+def fitting_write(v):
+    """Serialise at the smallest power-of-two size that fits"""
+    size = 800*1024
+    while True:
+        try:
+            return size, v.write(size)
+        except OutOfSpaceError:
+            size *= 2
+
+
+def fragmented_image(scale, blksize=512):
+    """An image holding one file with its data fork in every other block,
+    so that most of its extents are in the extents overflow file.
+
+    Volume.write only ever makes contiguous forks, so build it by hand.
+    """
+    nfrags = min(max(int(20000 * scale), 4), 30000) # 65535 blocks at most
+    cnid = 16
+
+    # fragments first, then the extents and catalog files
+    extents = [(2*i, 1) for i in range(nfrags)]
+    data = b''.join(struct.pack('>L', i) * (blksize // 4) for i in range(nfrags))
+
+    xtrecs = []
+    for fabn in range(3, nfrags, 3):
+        three = extents[fabn:fabn+3]
+        three += [(0, 0)] * (3 - len(three))
+        xtrecs.append((struct.pack('>LH', cnid, fabn), struct.pack('>6H', *sum(three, ()))))
+    xtfile = btree.make_btree(xtrecs, bthKeyLen=7, blksize=blksize)
+    xtstart = 2 * nfrags
+
+    first = extents[:3]
+    filExtRec = struct.pack('>6H', *sum(first, ()))
+    volname = b'Fragmented'
+    catrecs = [
+        (struct.pack('>L', 1) + bitmanip.pstring(volname),
+            struct.pack('>BxHHLLLL16s16s16x', 1, 0, 1, 2, 0, 0, 0, bytes(16), bytes(16))),
+        (struct.pack('>Lx', 2),
+            struct.pack('>BxxxxxxxxxL', 3, 1) + bitmanip.pstring(volname)),
+        (struct.pack('>L', 2) + bitmanip.pstring(b'frag'),
+            struct.pack('>BxBB16sLHLLHLLLLL16sH12s12sxxxx', 2, 2, 0, b'BINAbnch' + bytes(8), cnid,
+                0, len(data), len(data), 0, 0, 0, 0, 0, 0, bytes(16), 0, filExtRec, bytes(12))),
+        (struct.pack('>Lx', cnid),
+            struct.pack('>BxxxxxxxxxL', 4, 2) + bitmanip.pstring(b'frag')),
+    ]
+    catrecs.sort(key=_catalog_rec_sort)
+    ctfile = btree.make_btree(catrecs, bthKeyLen=37, blksize=blksize)
+    ctstart = xtstart + len(xtfile) // blksize
+
+    nalloc = ctstart + len(ctfile) // blksize + 16
+    bitmap_blks = bitmanip.pad_up(nalloc, 4096) // 4096
+    alloc = bytearray(nalloc * blksize)
+    used = bytearray(bitmap_blks * 512)
+    def put(blk, buf):
+        alloc[blk*blksize:blk*blksize+len(buf)] = buf
+        for b in range(blk, blk + len(buf) // blksize):
+            used[b // 8] |= 0x80 >> (b % 8)
+    for i, (blk, cnt) in enumerate(extents):
+        put(blk, data[i*blksize:(i+1)*blksize])
+    put(xtstart, xtfile)
+    put(ctstart, ctfile)
+    nused = sum(bin(x).count('1') for x in used)
+
+    vib = struct.pack('>2sLLHHHHHLLHLH28pLHLLLHLL32sHHHLHHxxxxxxxxLHHxxxxxxxx',
+        b'BD', 0, 0, 1<<8, 1, 3, 0, nalloc, blksize, blksize, 3 + bitmap_blks,
+        cnid + 1, nalloc - nused, volname, 0, 0, 0, blksize, blksize, 0, 1, 0,
+        bytes(32), 0, 0, 0,
+        len(xtfile), xtstart, len(xtfile) // blksize,
+        len(ctfile), ctstart, len(ctfile) // blksize,
+    ).ljust(512, b'\0')
+
+    return b''.join([bytes(1024), vib, bytes(used), bytes(alloc), vib, bytes(512)]), data
+
+
+def catalog_file(image):
+    """Get the catalog file of a contiguous image, and its records as (key, val) tuples"""
+    fields = struct.unpack_from('>2sLLHHHHHLLHLH28pLHLLLHLL32sHHHL12sL12s', image, 1024)
+    drAlBlkSiz, drAlBlSt, drCTFlSize, drCTExtRec = fields[8], fields[10], fields[28], fields[29]
+    start = 512*drAlBlSt + drAlBlkSiz*struct.unpack_from('>H', drCTExtRec)[0]
+    ctfile = image[start:start+drCTFlSize]
+
+    records = []
+    for rec in btree.dump_btree(ctfile):
+        key = rec[2:1+rec[0]]
+        val = rec[bitmanip.pad_up(1+rec[0], 2):]
+        records.append((key, val))
+
+    return ctfile, records, drAlBlkSiz
+
+
+########################################################################
+# Measurement
+
+def measure(fn, repeat):
+    """Best wall time of several runs, then peak Python heap use of one more run"""
+    best = float('inf')
+    for i in range(repeat):
+        gc.collect()
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return best, peak
+
+
+def bench_scenario(name, scale, repeat, tmpdir):
+    if name == 'fragmented':
+        image, data = fragmented_image(scale)
+        v = Volume()
+        v.read(image)
+        assert v['frag'].data == data
+        size = max(bitmanip.pad_up(len(image), 512), 800*1024) # write() refuses images under 400K
+    else:
+        v = SCENARIOS[name](scale)
+        size, image = fitting_write(v)
+
+    ctfile, catrecs, blksize = catalog_file(image)
+    folder = os.path.join(tmpdir, name)
+
+    def write_folder():
+        shutil.rmtree(folder, ignore_errors=True)
+        os.mkdir(folder)
+        v.write_folder(folder)
+
+    def read_lazy():
+        with io.BytesIO(image) as f:
+            Volume().read(f)
+
+    ops = [
+        ('Volume.write', lambda: v.write(size)),
+        ('Volume.read', lambda: Volume().read(image)),
+        ('Volume.read(file)', read_lazy),
+        ('btree.make_btree', lambda: btree.make_btree(catrecs, bthKeyLen=37, blksize=blksize)),
+        ('btree.dump_btree', lambda: sum(1 for rec in btree.dump_btree(ctfile))),
+        ('write_folder', write_folder),
+        ('read_folder', lambda: Volume().read_folder(folder)),
+    ]
+
+    for op, fn in ops:
+        seconds, peak = measure(fn, repeat)
+        yield dict(scenario=name, op=op, seconds=round(seconds, 6), peak_bytes=peak,
+            image_bytes=len(image), catalog_records=len(catrecs))
+
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f: old = json.load(f)
+    with open(new_path) as f: new = json.load(f)
+
+    old_results = {(r['scenario'], r['op']): r for r in old['results']}
+    print('%-12s %-20s %10s %10s %7s %12s %12s' % ('scenario', 'op', 'old s', 'new s', 'ratio', 'old peak', 'new peak'))
+    for r in new['results']:
+        o = old_results.get((r['scenario'], r['op']))
+        if o is None: continue
+        ratio = r['seconds'] / o['seconds'] if o['seconds'] else float('nan')
+        print('%-12s %-20s %10.4f %10.4f %6.2fx %12d %12d' % (r['scenario'], r['op'],
+            o['seconds'], r['seconds'], ratio, o['peak_bytes'], r['peak_bytes']))
+
+
+def main():
+    args = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    args.add_argument('--scale', type=float, default=1.0, help='shrink or grow every scenario (default: 1)')
+    args.add_argument('--repeat', type=int, default=3, help='timed runs per measurement (default: 3)')
+    args.add_argument('--only', action='append', choices=[*SCENARIOS, 'fragmented'], help='run just this scenario (repeatable)')
+    args.add_argument('-o', '--output', default='-', help='JSON results file (default: stdout)')
+    args.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two results files instead')
+    args = args.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name in args.only or [*SCENARIOS, 'fragmented']:
+            for r in bench_scenario(name, args.scale, args.repeat, tmpdir):
+                print('%(scenario)-12s %(op)-20s %(seconds)10.4fs %(peak_bytes)12d bytes' % r, file=sys.stderr)
+                results.append(r)
+
+    doc = dict(
+        meta=dict(commit=git_commit(), python=platform.python_version(), platform=platform.platform(),
+            scale=args.scale, repeat=args.repeat, time=time.time()),
+        results=results,
+    )
+
+    if args.output == '-':
+        json.dump(doc, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(doc, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,12 @@
 from .main import OutOfSpaceError, BadNameError
 from .main import Volume
+from .image import stat, manifest
 from .directory import File, Folder
+from .forkio import LazyFork, ForkIO
+from .compressed import CompressedImage, open_image
+from .shared import SharedImage
+from .stats import Stats
+from .check import fsck, Problem
+from .compare import diff, Change
+from .corpus import index_corpus
+from .watcher import watch
@@ -71,10 +71,10 @@ def _pack_leaf_record(key, value):
     return b
 
 
-def _make_index_record(rec, pointer):
+def _make_index_record(rec, pointer, keylen):
     """Convert a key-value to a special key-pointer record"""
     rec = rec[:1+rec[0]]
-    rec = b'\x25' + rec[1:]
+    rec = bytes([keylen]) + rec[1:]
     rec += bytes(rec[0]+1-len(rec))
     rec += struct.pack('>L', pointer)
     return rec
@@ -103,7 +103,11 @@ def dump_btree(buf):
         this_leaf = ndFLink
 
 
-def make_btree(records, bthKeyLen, blksize):
+def make_btree(records, bthKeyLen, blksize, spare=0):
+    """Serialise sorted (key, value) records as an HFS B*-tree
+
+    At least spare free nodes are left over for the tree to grow into.
+    """
     nodemult = blksize // 512
 
     nodelist = [] # append to this as we go
@@ -150,7 +154,7 @@ def make_btree(records, bthKeyLen, blksize):
             newnode = _Node(ndType=0, ndNHeight=bthDepth)
             for pointer in g:
                 rec = nodelist[pointer].records[0]
-                rec = _make_index_record(rec, pointer)
+                rec = _make_index_record(rec, pointer, bthKeyLen)
                 newnode.records.append(rec)
             nodelist.append(newnode)
 
@@ -158,7 +162,7 @@ def make_btree(records, bthKeyLen, blksize):
     # Add map nodes with 3952-bit bitmap recs to cover every node
     bits_covered = 2048
     mapnodes = []
-    while bits_covered < bitmanip.pad_up(len(nodelist), nodemult):
+    while bits_covered < bitmanip.pad_up(len(nodelist) + spare, nodemult):
         mapnode = _Node(ndType=2, ndNHeight=1)
         nodelist.append(mapnode)
         mapnodes.append(mapnode)
@@ -182,8 +186,9 @@ def make_btree(records, bthKeyLen, blksize):
         node.ndFLink = most_recent.get(node.ndType, 0)
         most_recent[node.ndType] = i
     bthFNode = most_recent.get(0xFF, 0)
+    headnode.ndFLink = most_recent.get(2, 0) # the map node chain hangs off the header
 
-    bthFree = bitmanip.pad_up(len(nodelist), nodemult) - len(nodelist)
+    bthFree = bitmanip.pad_up(len(nodelist) + spare, nodemult) - len(nodelist)
     bthNNodes = len(nodelist) + bthFree
 
     # Populate the first (header) record of the header node
@@ -0,0 +1,108 @@
+import contextlib
+import dbm
+import os
+from os import path
+from . import forkio
+
+
+_FICLONE = 0x40049409 # from linux/fs.h
+
+
+def _reflink(src, dst):
+    try:
+        import fcntl
+        fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+    except (ImportError, OSError):
+        return False
+    else:
+        return True
+
+
+def place(src, dest, link='reflink'):
+    """Replace dest with a copy of src, all at once
+
+    link is 'reflink' (share blocks if the filesystem can, else copy),
+    'hardlink' (which is only safe if neither file will be modified in
+    place) or 'copy'.
+    """
+    if link not in ('reflink', 'hardlink', 'copy'):
+        raise ValueError('link must be reflink, hardlink or copy')
+
+    tmp = '%s.%d.tmp' % (dest, os.getpid())
+    try:
+        if link == 'hardlink':
+            os.link(src, tmp)
+        else:
+            with open(src, 'rb') as s, open(tmp, 'wb') as d:
+                if link == 'copy' or not _reflink(s, d):
+                    forkio.copy_range(s.fileno(), 0, d.fileno(), 0, os.fstat(s.fileno()).st_size)
+        os.replace(tmp, dest)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+        raise
+
+
+def unshare(dest):
+    """If dest has other hard links (e.g. into an ImageCache), make it a copy of its own
+
+    Call this before writing to dest in place, which would otherwise
+    change every link. Returns True if dest was replaced, so that any
+    open file object should be reopened.
+    """
+    if os.stat(dest).st_nlink > 1:
+        place(dest, dest, 'reflink')
+        return True
+    return False
+
+
+class ImageCache:
+    """A folder of built images, named by Volume.fingerprint
+
+    Each use of an image touches its mtime, and once the images take up
+    more than maxbytes, the ones used least recently are deleted.
+    """
+
+    def __init__(self, folder, maxbytes=4*1024*1024*1024, link='reflink'):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.maxbytes = maxbytes
+        self.link = link
+
+    def path(self, fingerprint):
+        return path.join(self.folder, fingerprint + '.img')
+
+    def digests(self):
+        """Open the dbm database of fork digests to pass to Volume.fingerprint"""
+        return dbm.open(path.join(self.folder, 'digests'), 'c')
+
+    def fetch(self, fingerprint, dest):
+        """Put the cached image at dest and return True, or return False if there is none"""
+        src = self.path(fingerprint)
+        try:
+            os.utime(src)
+        except FileNotFoundError:
+            return False
+        place(src, dest, self.link)
+        return True
+
+    def store(self, fingerprint, src):
+        """Add a newly built image to the cache, then make room"""
+        place(src, self.path(fingerprint), self.link)
+        self.evict()
+
+    def evict(self):
+        images = []
+        with os.scandir(self.folder) as it:
+            for e in it:
+                if e.name.endswith('.img'):
+                    st = e.stat()
+                    images.append((st.st_mtime_ns, st.st_size, e.path))
+        images.sort()
+
+        total = sum(size for (mtime, size, p) in images)
+        for mtime, size, p in images:
+            if total <= self.maxbytes: break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(p)
+            total -= size
@@ -0,0 +1,495 @@
+import collections
+import os
+import struct
+from . import btree, compressed, image
+from .main import _catalog_rec_sort
+
+
+Problem = collections.namedtuple('Problem', 'severity where message')
+
+# Fields that must agree between the MDB and the alternate MDB. Others,
+# such as the file count, are only updated in the alternate now and then.
+_STRUCTURAL_FIELDS = ('drSigWord', 'drCrDate', 'drVBMSt', 'drNmAlBlks', 'drAlBlkSiz', 'drAlBlSt')
+
+
+def fsck(image_or_path):
+    """Check the structure of an HFS image, returning a list of Problems
+
+    Each Problem has a severity ('error' or 'warning'), a where (such as
+    'MDB', 'catalog file node 5' or a colon-separated path) and a message.
+    An empty list means the volume is clean.
+
+    Only the MDBs, the bitmap and the two B*-trees are read, so the time
+    taken depends on the size of the catalog and not of the forks.
+    """
+    if isinstance(image_or_path, (str, os.PathLike)):
+        with compressed.open_image(image_or_path) as f:
+            return fsck(f)
+
+    return _Checker(image_or_path).run()
+
+
+def _catalog_key(key):
+    key = key[1:] # ckrResrv1
+    return _catalog_rec_sort((key[:5+key[4]],)) # drop index key padding
+
+
+def _extents_key(key):
+    xkrFkType, xkrFNum, xkrFABN = struct.unpack_from('>BLH', key)
+    return xkrFNum, xkrFkType, xkrFABN
+
+
+def _ranges(blocks):
+    """Describe a sorted list of block numbers as compact ranges"""
+    out = []
+    for b in blocks:
+        if out and out[-1][1] == b - 1:
+            out[-1][1] = b
+        else:
+            out.append([b, b])
+    return ', '.join(str(a) if a == b else '%d-%d' % (a, b) for (a, b) in out)
+
+
+class _Checker:
+    def __init__(self, img):
+        self.readat, self.image_len = image.reader(img)
+        self.volstart, self.mdb = image.find_mdb(img)
+        self.problems = []
+        self.owners = None # block number -> (cnid, fork) using it
+        self.dirs = {}     # cnid -> (parent, name, DirRec)
+        self.files = {}    # cnid -> (parent, name, FilRec)
+
+    def report(self, severity, where, message, *args):
+        if isinstance(where, tuple): where = self.describe(*where)
+        self.problems.append(Problem(severity, where, message % args if args else message))
+
+    def describe(self, cnid, fork=None):
+        """Name a file, folder or fork by its path, only when it is needed"""
+        if cnid == 3: return 'extents file'
+        if cnid == 4: return 'catalog file'
+
+        names = []
+        here = cnid
+        while here in self.dirs or here in self.files:
+            here, name, datarec = self.dirs.get(here) or self.files[here]
+            names.append(name.decode('mac_roman'))
+            if len(names) > 100: break # a loop
+        where = ':'.join(reversed(names)) or 'CNID %d' % cnid
+
+        if fork: where += ' (%s fork)' % fork
+        return where
+
+    def run(self):
+        if not self.check_mdb():
+            return self.problems
+
+        self.check_alternate_mdb()
+
+        self.owners = [None] * self.mdb.drNmAlBlks
+
+        xtfile = self.special_file(3, self.mdb.drXTFlSize, self.mdb.drXTExtRec, {})
+        xtrecs = self.check_btree('extents file', xtfile, 7, _extents_key) if xtfile else []
+
+        overflow = {}
+        for rec in xtrecs:
+            try:
+                xkrFkType, xkrFNum, xkrFABN, extrec = image.unpack_extents_record(rec)
+            except struct.error:
+                self.report('error', 'extents file', 'truncated record')
+                continue
+            fork = {0: 'data', 0xFF: 'rsrc'}.get(xkrFkType)
+            if fork is None:
+                self.report('error', 'extents file', 'bad fork type 0x%02x for file %d', xkrFkType, xkrFNum)
+                continue
+            overflow[xkrFNum, fork, xkrFABN] = extrec
+
+        ctfile = self.special_file(4, self.mdb.drCTFlSize, self.mdb.drCTExtRec, overflow)
+        ctrecs = self.check_btree('catalog file', ctfile, 37, _catalog_key) if ctfile else []
+
+        self.check_catalog(ctrecs, overflow)
+
+        for (cnid, fork, fabn) in overflow:
+            self.report('warning', 'extents file', 'unused record for file %d %s fork at block %d', cnid, fork, fabn)
+
+        self.check_bitmap()
+
+        return self.problems
+
+    ####################################################################
+    # Master Directory Block
+
+    def check_mdb(self):
+        """Check what the rest of the checks rely on, and return False if hopeless"""
+        mdb = self.mdb
+
+        if mdb.drAlBlkSiz == 0 or mdb.drAlBlkSiz % 512:
+            self.report('error', 'MDB', 'allocation block size %d is not a multiple of 512', mdb.drAlBlkSiz)
+            return False
+
+        bitmap_blks = (mdb.drNmAlBlks + 4095) // 4096
+        if mdb.drVBMSt < 3 or mdb.drVBMSt + bitmap_blks > mdb.drAlBlSt:
+            self.report('error', 'MDB', 'bitmap (sector %d, %d sectors) does not fit before the allocation area (sector %d)',
+                mdb.drVBMSt, bitmap_blks, mdb.drAlBlSt)
+            return False
+
+        self.alloc_end = self.volstart + 512*mdb.drAlBlSt + mdb.drAlBlkSiz*mdb.drNmAlBlks
+        if self.alloc_end > self.image_len:
+            self.report('error', 'MDB', 'allocation area ends at byte %d, past the end of the image (%d)',
+                self.alloc_end, self.image_len)
+            return False
+
+        if mdb.drAtrb & (1<<8) == 0:
+            self.report('warning', 'MDB', 'volume was not cleanly unmounted')
+
+        return True
+
+    def check_alternate_mdb(self):
+        # The alternate is 1024 bytes before the end of the volume, which
+        # is within one allocation block of the end of the allocation area
+        candidates = []
+        if self.volstart == 0:
+            candidates.append(self.image_len - 1024)
+        candidates.extend(range(self.alloc_end, self.alloc_end + self.mdb.drAlBlkSiz + 512, 512))
+
+        for offset in candidates:
+            if offset >= self.alloc_end and self.readat(offset, 2) == b'BD':
+                break
+        else:
+            self.report('warning', 'alternate MDB', 'not found')
+            return
+
+        alt = image.MDB._make(struct.unpack_from(image.MDB_FORMAT, self.readat(offset, 512)))
+        differ = [f for f in image.MDB._fields if getattr(alt, f) != getattr(self.mdb, f)]
+
+        for f in differ:
+            if f in _STRUCTURAL_FIELDS:
+                self.report('error', 'alternate MDB', '%s is %r but the MDB has %r', f, getattr(alt, f), getattr(self.mdb, f))
+
+        stale = [f for f in differ if f not in _STRUCTURAL_FIELDS]
+        if stale:
+            self.report('warning', 'alternate MDB', 'differs from the MDB in %s', ', '.join(stale))
+
+    ####################################################################
+    # Extents and the bitmap
+
+    def claim(self, owner, extents, nblocks):
+        """Check a fork's extents against its physical length, and mark its blocks used"""
+        total = 0
+        for first, count in extents:
+            total += count
+            if first + count > self.mdb.drNmAlBlks:
+                self.report('error', owner, 'extent %d+%d runs past the last allocation block (%d)',
+                    first, count, self.mdb.drNmAlBlks)
+                continue
+
+            clashes = {}
+            for blk in range(first, first + count):
+                other = self.owners[blk]
+                if other is None:
+                    self.owners[blk] = owner
+                else:
+                    clashes.setdefault(other, []).append(blk)
+
+            for other, blocks in clashes.items():
+                self.report('error', owner, 'shares blocks %s with %s', _ranges(blocks), self.describe(*other))
+
+        if total != nblocks:
+            self.report('error', owner, 'extents cover %d blocks but the physical length is %d blocks', total, nblocks)
+
+    def fork_extents(self, owner, nblocks, extrec, overflow):
+        """Gather a fork's extents from its first record and the overflow file"""
+        extents = btree.unpack_extent_record(extrec)
+        accum = sum(count for (first, count) in extents)
+
+        while accum < nblocks:
+            try:
+                extrec = overflow.pop((*owner, accum))
+            except KeyError:
+                self.report('error', owner, 'no extent record for block %d of %d', accum, nblocks)
+                break
+            more = btree.unpack_extent_record(extrec)
+            if not more: break
+            extents.extend(more)
+            accum += sum(count for (first, count) in more)
+
+        return extents
+
+    def physical_blocks(self, owner, logical, physical):
+        if physical % self.mdb.drAlBlkSiz:
+            self.report('error', owner, 'physical length %d is not a whole number of blocks', physical)
+        if logical > physical:
+            self.report('error', owner, 'logical length %d exceeds physical length %d', logical, physical)
+        return (physical + self.mdb.drAlBlkSiz - 1) // self.mdb.drAlBlkSiz
+
+    def special_file(self, cnid, size, extrec, overflow):
+        """Read the extents or catalog file, or return None if unreadable"""
+        owner = (cnid, 'data')
+        nblocks = self.physical_blocks(owner, size, size)
+        extents = self.fork_extents(owner, nblocks, extrec, overflow)
+        self.claim(owner, extents, nblocks)
+
+        if any(first + count > self.mdb.drNmAlBlks for (first, count) in extents):
+            return None
+
+        blksize = self.mdb.drAlBlkSiz
+        base = self.volstart + 512*self.mdb.drAlBlSt
+        buf = b''.join(self.readat(base + blksize*first, blksize*count) for (first, count) in extents)
+        if len(buf) < size:
+            self.report('error', owner, 'only %d of %d bytes could be read', len(buf), size)
+            return None
+        return buf[:size]
+
+    def check_bitmap(self):
+        mdb = self.mdb
+        vbm = self.readat(self.volstart + 512*mdb.drVBMSt, (mdb.drNmAlBlks+7)//8)
+
+        leaked = []
+        unmarked = {}
+        for blk, owner in enumerate(self.owners):
+            marked = vbm[blk >> 3] & (0x80 >> (blk & 7))
+            if marked and owner is None:
+                leaked.append(blk)
+            elif owner is not None and not marked:
+                unmarked.setdefault(owner, []).append(blk)
+
+        if leaked:
+            self.report('warning', 'bitmap', 'blocks %s are marked used but belong to no fork', _ranges(leaked))
+        for owner, blocks in unmarked.items():
+            self.report('error', 'bitmap', 'blocks %s belong to %s but are marked free', _ranges(blocks), self.describe(*owner))
+
+        free = image.count_free(vbm, mdb.drNmAlBlks)
+        if free != mdb.drFreeBks:
+            self.report('error', 'MDB', 'drFreeBks is %d but the bitmap has %d free blocks', mdb.drFreeBks, free)
+
+    ####################################################################
+    # B*-trees
+
+    def node(self, where, buf, i):
+        """Unpack node i, or return None and report why not"""
+        if 512*(i+1) > len(buf):
+            self.report('error', where, 'node %d is past the end of the file', i)
+            return None
+
+        ndNRecs, = struct.unpack_from('>H', buf, 512*i + 10)
+        offsets = struct.unpack_from('>%dH' % (ndNRecs+1), buf, 512*(i+1) - 2*(ndNRecs+1)) if ndNRecs < 248 else ()
+        if not offsets or offsets[-1] != 14 or list(offsets) != sorted(offsets, reverse=True) \
+                or offsets[0] > 512 - 2*(ndNRecs+1):
+            self.report('error', '%s node %d' % (where, i), 'record offsets are corrupt')
+            return None
+
+        return btree._unpack_btree_node(buf, 512*i)
+
+    def check_btree(self, where, buf, maxkeylen, keyfunc):
+        """Check a B*-tree, returning its leaf records in order"""
+        if len(buf) % 512 or not buf:
+            self.report('error', where, 'length %d is not a whole number of nodes', len(buf))
+            return []
+
+        header = self.node(where, buf, 0)
+        if header is None: return []
+        ndFLink, ndBLink, ndType, ndNHeight, records = header
+        if ndType != 1 or len(records) < 3:
+            self.report('error', where + ' node 0', 'not a header node')
+            return []
+
+        bthDepth, bthRoot, bthNRecs, bthFNode, bthLNode, bthNodeSize, bthKeyLen, bthNNodes, bthFree = \
+        struct.unpack_from('>HLLLLHHLL', records[0])
+
+        if bthNodeSize != 512:
+            self.report('error', where, 'bthNodeSize is %d', bthNodeSize)
+            return []
+        if bthKeyLen != maxkeylen:
+            self.report('error', where, 'bthKeyLen is %d, expected %d', bthKeyLen, maxkeylen)
+        if bthNNodes * 512 > len(buf):
+            self.report('error', where, 'bthNNodes is %d but the file has room for %d', bthNNodes, len(buf) // 512)
+            bthNNodes = len(buf) // 512
+
+        # The node bitmap: the header's map record, then a chain of map nodes
+        bitmap = bytearray(records[2])
+        seen_maps = {0}
+        i = ndFLink
+        while i and len(bitmap) * 8 < bthNNodes:
+            if i in seen_maps:
+                self.report('error', where, 'map node chain loops at node %d', i)
+                break
+            seen_maps.add(i)
+            mapnode = self.node(where, buf, i)
+            if mapnode is None: break
+            if mapnode[2] != 2:
+                self.report('error', '%s node %d' % (where, i), 'expected a map node, found type %d', mapnode[2])
+                break
+            bitmap.extend(mapnode[4][0])
+            i = mapnode[0]
+        in_use = {n for n in range(min(bthNNodes, len(bitmap) * 8)) if bitmap[n >> 3] & (0x80 >> (n & 7))}
+
+        if bthFree != bthNNodes - len(in_use):
+            self.report('error', where, 'bthFree is %d but the node bitmap has %d free', bthFree, bthNNodes - len(in_use))
+
+        reached = set(seen_maps)
+        leaves = []
+
+        # Descend from the root one level at a time, checking that each
+        # index key is no greater than the first key of the node it points to
+        if bthDepth:
+            level = [(bthRoot, None)]
+            for height in range(bthDepth, 0, -1):
+                next_level = []
+                for i, parent_key in level:
+                    nodewhere = '%s node %d' % (where, i)
+                    if i in reached:
+                        self.report('error', nodewhere, 'reached twice')
+                        continue
+                    reached.add(i)
+
+                    nd = self.node(where, buf, i)
+                    if nd is None: continue
+                    ndFLink, ndBLink, ndType, ndNHeight, records = nd
+
+                    want = 0xFF if height == 1 else 0
+                    if ndType != want or ndNHeight != height:
+                        self.report('error', nodewhere, 'type %d height %d, expected type %d height %d',
+                            ndType, ndNHeight, want, height)
+                        continue
+                    if not records:
+                        self.report('error', nodewhere, 'no records')
+                        continue
+
+                    keys = []
+                    for rec in records:
+                        if not 1 <= rec[0] < len(rec):
+                            self.report('error', nodewhere, 'bad key length %d', rec[0])
+                            break
+                        try:
+                            keys.append(keyfunc(rec[1:1+rec[0]]))
+                        except (IndexError, struct.error):
+                            self.report('error', nodewhere, 'unreadable key')
+                            break
+                    else:
+                        if any(a >= b for (a, b) in zip(keys, keys[1:])):
+                            self.report('error', nodewhere, 'keys out of order')
+                        if parent_key is not None and keys[0] < parent_key:
+                            self.report('error', nodewhere, 'first key sorts before its index key')
+
+                        if height == 1:
+                            leaves.append((i, ndFLink, ndBLink, records, keys))
+                        else:
+                            for rec, key in zip(records, keys):
+                                next_level.append((struct.unpack_from('>L', rec, 1+rec[0])[0], key))
+
+                level = next_level
+
+        elif bthNRecs or bthRoot:
+            self.report('error', where, 'bthDepth is 0 but bthRoot is %d and bthNRecs is %d', bthRoot, bthNRecs)
+
+        # The leaf chain must visit the same leaves in the same order
+        if leaves:
+            if bthFNode != leaves[0][0] or bthLNode != leaves[-1][0]:
+                self.report('error', where, 'bthFNode/bthLNode are %d/%d but the tree runs from %d to %d',
+                    bthFNode, bthLNode, leaves[0][0], leaves[-1][0])
+            prev = 0
+            for n, (i, ndFLink, ndBLink, records, keys) in enumerate(leaves):
+                following = leaves[n+1][0] if n+1 < len(leaves) else 0
+                if ndBLink != prev or ndFLink != following:
+                    self.report('error', '%s node %d' % (where, i), 'leaf links are %d<-->%d, expected %d<-->%d',
+                        ndBLink, ndFLink, prev, following)
+                if n and keys[0] <= leaves[n-1][4][-1]:
+                    self.report('error', '%s node %d' % (where, i), 'first key does not follow the previous leaf')
+                prev = i
+
+        nrecs = sum(len(leaf[3]) for leaf in leaves)
+        if nrecs != bthNRecs:
+            self.report('error', where, 'bthNRecs is %d but the leaves hold %d records', bthNRecs, nrecs)
+
+        for i in sorted(reached - in_use):
+            self.report('error', '%s node %d' % (where, i), 'in use but free in the node bitmap')
+        unreached = sorted(in_use - reached)
+        if unreached:
+            self.report('warning', where, 'nodes %s are marked used but not in the tree', _ranges(unreached))
+
+        return [rec for leaf in leaves for rec in leaf[3]]
+
+    ####################################################################
+    # Catalog
+
+    def check_catalog(self, records, overflow):
+        dirs, files = self.dirs, self.files
+        threads = {}  # cnid -> (cdrType, ThdRec)
+        children = collections.Counter()
+
+        for rec in records:
+            try:
+                ckrParID, ckrCName, cdrType, datarec = image.unpack_catalog_record(rec)
+            except (ValueError, struct.error) as e:
+                self.report('error', 'catalog file', 'unreadable record: %s', e)
+                continue
+
+            if cdrType in (1, 2):
+                cnid = datarec.dirDirID if cdrType == 1 else datarec.filFlNum
+                if cnid in dirs or cnid in files:
+                    self.report('error', 'catalog file', 'CNID %d is used twice', cnid)
+                    continue
+                (dirs if cdrType == 1 else files)[cnid] = (ckrParID, ckrCName, datarec)
+                children[ckrParID] += 1
+                if not 1 <= len(ckrCName) <= 31 and ckrParID != 1:
+                    self.report('error', 'catalog file', 'CNID %d has a name of %d bytes', cnid, len(ckrCName))
+            else:
+                if ckrCName:
+                    self.report('error', 'catalog file', 'thread record for CNID %d has a name in its key', ckrParID)
+                threads[ckrParID] = (cdrType, datarec)
+
+        # Threads and records must point to each other
+        for cnid, (cdrType, datarec) in threads.items():
+            rec = (dirs if cdrType == 3 else files).get(cnid)
+            if rec is None:
+                self.report('error', 'catalog file', '%s thread for missing CNID %d',
+                    'folder' if cdrType == 3 else 'file', cnid)
+            elif (datarec.thdParID, datarec.thdCName) != rec[:2]:
+                self.report('error', (cnid,), 'thread points to parent %d name %r',
+                    datarec.thdParID, datarec.thdCName.decode('mac_roman'))
+
+        for cnid in dirs:
+            if threads.get(cnid, (None,))[0] != 3:
+                self.report('error', (cnid,), 'folder has no thread record')
+
+        for cnid, (parent, name, datarec) in files.items():
+            if datarec.filFlags & 2 and threads.get(cnid, (None,))[0] != 4:
+                self.report('error', (cnid,), 'file is flagged as having a thread record but has none')
+
+        # Every record needs a parent folder, whose valence counts it
+        for cnid, (parent, name, datarec) in [*dirs.items(), *files.items()]:
+            if parent not in dirs and not (cnid == 2 and parent == 1):
+                self.report('error', (cnid,), 'parent folder %d does not exist', parent)
+
+        for cnid, (parent, name, datarec) in dirs.items():
+            if datarec.dirVal != children[cnid]:
+                self.report('error', (cnid,), 'valence is %d but the folder has %d items', datarec.dirVal, children[cnid])
+
+        mdb = self.mdb
+        if 2 not in dirs:
+            self.report('error', 'catalog file', 'no root folder')
+        else:
+            if dirs[2][1] != mdb.drVN:
+                self.report('warning', 'catalog file', 'root folder is named %r but the volume is %r',
+                    dirs[2][1].decode('mac_roman'), mdb.drVN.decode('mac_roman'))
+
+        root_files = sum(1 for (parent, name, datarec) in files.values() if parent == 2)
+        root_dirs = sum(1 for (parent, name, datarec) in dirs.values() if parent == 2)
+        for field, actual in [
+                ('drNmFls', root_files), ('drNmRtDirs', root_dirs),
+                ('drFilCnt', len(files)), ('drDirCnt', len(dirs) - (2 in dirs))]:
+            if getattr(mdb, field) != actual:
+                self.report('error', 'MDB', '%s is %d but the catalog has %d', field, getattr(mdb, field), actual)
+
+        highest = max([*dirs, *files], default=0)
+        if mdb.drNxtCNID <= highest:
+            self.report('error', 'MDB', 'drNxtCNID is %d but CNID %d is in use', mdb.drNxtCNID, highest)
+
+        # Forks
+        for cnid, (parent, name, datarec) in files.items():
+            for fork, logical, physical, extrec in [
+                    ('data', datarec.filLgLen, datarec.filPyLen, datarec.filExtRec),
+                    ('rsrc', datarec.filRLgLen, datarec.filRPyLen, datarec.filRExtRec)]:
+                owner = (cnid, fork)
+                nblocks = self.physical_blocks(owner, logical, physical)
+                extents = self.fork_extents(owner, nblocks, extrec, overflow)
+                self.claim(owner, extents, nblocks)
@@ -0,0 +1,84 @@
+import collections
+import contextlib
+import os
+import struct
+from . import compressed, image
+from .main import _CATALOG_ORDER
+
+
+Change = collections.namedtuple('Change', 'status path fields')
+
+FIELDS = ('kind', 'type', 'creator', 'flags', 'position', 'locked', 'crdate', 'mddate', 'bkdate', 'data', 'rsrc')
+
+
+def _metadata(datarec):
+    """Everything we compare about a catalog entry, except the fork contents"""
+    if isinstance(datarec, image.FilRec):
+        type, creator, flags, x, y = struct.unpack_from('>4s4sHHH', datarec.filUsrWds)
+        return dict(kind='file', type=type, creator=creator, flags=flags, position=(x, y),
+            locked=bool(datarec.filFlags & 1),
+            crdate=datarec.filCrDat, mddate=datarec.filMdDat, bkdate=datarec.filBkDat,
+            data=datarec.filLgLen, rsrc=datarec.filRLgLen)
+    else:
+        return dict(kind='folder',
+            crdate=datarec.dirCrDat, mddate=datarec.dirMdDat, bkdate=datarec.dirBkDat)
+
+
+def _sorted_entries(catalog):
+    """Catalog entries as (sort key, path, datarec), sorted like the catalog sorts names"""
+    entries = [(tuple(name.encode('mac_roman').translate(_CATALOG_ORDER) for name in path), path, datarec)
+        for (path, cnid, datarec) in catalog.walk()]
+    entries.sort(key=lambda e: e[0])
+    return entries
+
+
+def diff(a, b, digests=True, ignore=()):
+    """Compare the catalogs of two HFS images, returning a list of Changes
+
+    a and b are paths, binary file objects or bytes-like objects. Each
+    Change has a status ('added', 'removed' or 'changed'), a path (a
+    tuple of names below the root) and, if changed, the fields that
+    differ (see FIELDS). Names are matched case-insensitively, as HFS
+    does. Fields named in ignore are not compared.
+
+    Forks of equal length are compared by streaming a digest of each,
+    unless digests=False, in which case only their lengths are compared.
+    Nothing is decompiled and no fork is held in memory.
+    """
+    with contextlib.ExitStack() as stack:
+        a, b = (stack.enter_context(compressed.open_image(x)) if isinstance(x, (str, os.PathLike)) else x for x in (a, b))
+        cat_a, cat_b = image.Catalog(a), image.Catalog(b)
+        left, right = _sorted_entries(cat_a), _sorted_entries(cat_b)
+
+        changes = []
+        i = j = 0
+        while i < len(left) or j < len(right):
+            if j == len(right) or (i < len(left) and left[i][0] < right[j][0]):
+                changes.append(Change('removed', left[i][1], ()))
+                i += 1
+            elif i == len(left) or right[j][0] < left[i][0]:
+                changes.append(Change('added', right[j][1], ()))
+                j += 1
+            else:
+                fields = _compare(cat_a, left[i][2], cat_b, right[j][2], digests, ignore)
+                if fields:
+                    changes.append(Change('changed', right[j][1], fields))
+                i += 1
+                j += 1
+
+        return changes
+
+
+def _compare(cat_a, rec_a, cat_b, rec_b, digests, ignore):
+    meta_a, meta_b = _metadata(rec_a), _metadata(rec_b)
+
+    fields = []
+    for field in FIELDS:
+        if field in ignore: continue
+        if meta_a.get(field) != meta_b.get(field):
+            fields.append(field)
+        elif field in ('data', 'rsrc') and meta_a['kind'] == 'file' and meta_a[field] and digests:
+            if cat_a.digest(rec_a, field) != cat_b.digest(rec_b, field):
+                fields.append(field)
+
+    return tuple(fields)
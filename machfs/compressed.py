@@ -0,0 +1,383 @@
+import bisect
+import bz2
+import io
+import json
+import lzma
+import os
+import struct
+import zlib
+from .forkio import pread
+
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_XZ_MAGIC = b'\xfd7zXZ\x00'
+_BZ2_MAGIC = b'BZh'
+_BZ2_BLOCK = 0x314159265359 # the first 48 bits of every bzip2 block (pi)
+_BZ2_EOS = 0x177245385090 # and of the end of every bzip2 stream (sqrt pi)
+
+_CHUNK = 1 << 20
+
+
+def sniff(f):
+    """Tell whether a binary file object is 'gzip', 'xz' or 'bz2' compressed, or None"""
+    magic = pread(f, 0, 6)
+    if magic.startswith(_GZIP_MAGIC):
+        return 'gzip'
+    elif magic.startswith(_XZ_MAGIC):
+        return 'xz'
+    elif magic.startswith(_BZ2_MAGIC):
+        return 'bz2'
+
+
+def open_image(image_path, sidecar=True):
+    """Open a disk image for reading, as a seekable binary file object
+
+    If the image is gzip, xz or bz2 compressed, the file object decompresses
+    only the parts that are read, using an index saved beside the image as
+    image_path + '.idx' (see CompressedImage), or not saved if sidecar=False.
+    Otherwise it is just the open file.
+    """
+    f = open(image_path, 'rb')
+    if sniff(f) is None:
+        return f
+    return CompressedImage(f, image_path + '.idx' if sidecar else None)
+
+
+########################################################################
+# Index building: one pass over each format, finding independent units
+# as [uncompressed offset, compressed start, compressed end, extra]
+
+def _gzip_units(f):
+    """Members of a gzip file (bgzip and friends make many)"""
+    units = []
+    upos = cpos = 0
+    while True:
+        d = zlib.decompressobj(31)
+        units.append([upos, cpos, None, 0])
+        data = b''
+        more = False
+        while not d.eof:
+            if not data and not more:
+                data = pread(f, cpos, _CHUNK)
+                if not data:
+                    raise ValueError('gzip file ends early')
+                cpos += len(data)
+            n = len(d.decompress(data, _CHUNK))
+            upos += n
+            more = n == _CHUNK # maybe more to come, even with no input
+            data = d.unconsumed_tail
+        cpos -= len(d.unused_data) + len(data)
+        units[-1][2] = cpos
+
+        if pread(f, cpos, 2) != _GZIP_MAGIC:
+            return units, upos # ignore trailing garbage, like gzip
+
+
+def _varint(buf, pos):
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        n |= (b & 0x7F) << shift
+        pos += 1
+        shift += 7
+        if b < 0x80: return n, pos
+
+
+def _pack_varint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _xz_units(f):
+    """Blocks of an xz file (xz -T makes many), found from the index at the end of each stream"""
+    streams = []
+    pos = f.seek(0, 2)
+    while pos > 0:
+        while pos >= 4 and pread(f, pos - 4, 4) == bytes(4):
+            pos -= 4 # stream padding
+
+        footer = pread(f, pos - 12, 12)
+        if footer[10:] != b'YZ':
+            raise ValueError('xz stream footer not found')
+        index_size = (struct.unpack_from('<L', footer, 4)[0] + 1) * 4
+        flags = struct.unpack_from('<H', footer, 8)[0]
+
+        index = pread(f, pos - 12 - index_size, index_size)
+        count, i = _varint(index, 1)
+        blocks = []
+        for n in range(count):
+            unpadded, i = _varint(index, i)
+            usize, i = _varint(index, i)
+            blocks.append((unpadded, usize))
+
+        start = pos - 12 - index_size - sum((unpadded + 3) & ~3 for (unpadded, usize) in blocks) - 12
+        if pread(f, start, 6) != _XZ_MAGIC:
+            raise ValueError('xz stream header not found')
+        streams.append((start + 12, flags, blocks))
+        pos = start
+
+    units = []
+    upos = 0
+    for cpos, flags, blocks in reversed(streams):
+        for unpadded, usize in blocks:
+            units.append([upos, cpos, cpos + unpadded, flags])
+            upos += usize
+            cpos += (unpadded + 3) & ~3
+    return units, upos
+
+
+def _bits(buf, start, n):
+    """Get n bits from a bytes-like object, starting at a bit offset, as an int"""
+    first, last = start // 8, (start + n + 7) // 8
+    return (int.from_bytes(buf[first:last], 'big') >> (last*8 - start - n)) & ((1 << n) - 1)
+
+
+def _find_bits(buf, magic):
+    """Find a 48-bit pattern at any bit offset, fast, by searching for its whole bytes"""
+    hits = set()
+    for shift in range(8):
+        window = (magic << (8 - shift)).to_bytes(7, 'big') # magic at this bit offset within 7 bytes
+        whole = window[:6] if shift == 0 else window[1:6]
+        i = buf.find(whole)
+        while i >= 0:
+            bit = i*8 + shift - (0 if shift == 0 else 8)
+            if bit >= 0 and _bits(buf, bit, 48) == magic:
+                hits.add(bit)
+            i = buf.find(whole, i + 1)
+    return sorted(hits)
+
+
+def _bz2_block_stream(buf, start, end):
+    """Wrap the bits of one bzip2 block (from its magic to the next) as a whole bzip2 stream"""
+    crc = _bits(buf, start + 48, 32) # the stream CRC of a one-block stream is the block CRC
+    nbits = end - start + 80
+    value = _bits(buf, start, end - start) << 80 | _BZ2_EOS << 32 | crc
+    value <<= -nbits % 8
+    return b'BZh9' + value.to_bytes((nbits + 7) // 8, 'big')
+
+
+def _bz2_magic(f):
+    """Find the block and end-of-stream magic of a bzip2 file, a window at a time, in bits"""
+    starts, ends = [], []
+    pos = 0
+    while True:
+        buf = pread(f, pos, _CHUNK + 6) # overlap, for magic that straddles two windows
+        if len(buf) < 6: break
+        for hits, magic in [(starts, _BZ2_BLOCK), (ends, _BZ2_EOS)]:
+            hits.extend(pos*8 + bit for bit in _find_bits(buf, magic) if bit < _CHUNK*8)
+        pos += _CHUNK
+    return starts, ends
+
+
+def _bz2_units(f):
+    """Blocks of a bzip2 file (each at most 900k uncompressed), in bits"""
+    starts, ends = _bz2_magic(f)
+    bounds = sorted(starts + ends)
+
+    units = []
+    upos = 0
+    i = j = 0
+    while i < len(starts):
+        start = starts[i]
+        while j < len(bounds) and bounds[j] <= start: j += 1
+        for end in (bounds[k] for k in range(j, len(bounds))): # usually the first will do
+            try: # the magic can turn up by chance inside a block, so check
+                first = start // 8
+                buf = pread(f, first, (end + 7) // 8 - first)
+                usize = len(bz2.decompress(_bz2_block_stream(buf, start - first*8, end - first*8)))
+                break
+            except (OSError, EOFError, ValueError):
+                continue
+        else:
+            raise ValueError('bzip2 block at bit %d is damaged' % start)
+        units.append([upos, start, end, 0])
+        upos += usize
+        while i < len(starts) and starts[i] < end: i += 1
+    return units, upos
+
+
+_INDEXERS = {'gzip': _gzip_units, 'xz': _xz_units, 'bz2': _bz2_units}
+
+
+def build_index(f):
+    """Make the index of a compressed image, as a dict that json can save"""
+    fmt = sniff(f)
+    units, size = _INDEXERS[fmt](f)
+    return {'format': fmt, 'size': size, 'units': units}
+
+
+########################################################################
+# Reading: decompress one unit at a time, from its start
+
+class CompressedImage(io.RawIOBase):
+    """Seekable, read-only raw file object over a compressed disk image
+
+    The first time an image is opened, one pass over it finds the points
+    where decompression can start afresh: gzip members, xz blocks and
+    bzip2 blocks. The result is saved as JSON in index_path (if given and
+    writable), so that later opens need no pass. A read then decompresses
+    from the start of the unit that holds it, and a few decompressors are
+    kept going for reads that follow on, like those of the catalog, or of
+    a fork, extent by extent.
+
+    A gzip file with only one member therefore has to be decompressed from
+    the start for every read that goes backwards. Tools like bgzip, and
+    xz -T, make files with many units.
+    """
+
+    def __init__(self, f, index_path=None, ncursors=4):
+        if isinstance(f, (str, os.PathLike)):
+            f = open(f, 'rb')
+        self.f = f
+        self.index = None
+        self.ncursors = ncursors
+
+        st = os.fstat(f.fileno())
+        stamp = [st.st_size, st.st_mtime_ns]
+        if index_path is not None:
+            try:
+                with open(index_path) as jf:
+                    index = json.load(jf)
+                if index.get('stamp') == stamp: self.index = index
+            except (OSError, ValueError):
+                pass
+
+        if self.index is None:
+            self.index = build_index(f)
+            self.index['stamp'] = stamp
+            if index_path is not None:
+                try:
+                    with open(index_path, 'w') as jf:
+                        json.dump(self.index, jf)
+                except OSError:
+                    pass # e.g. a read-only archive, so just keep it in memory
+
+        self.format = self.index['format']
+        self.size = self.index['size']
+        self.units = self.index['units']
+        self.starts = [u[0] for u in self.units]
+        self.pos = 0
+        self._cursors = [] # [unit number, chunk generator, offset of chunk, chunk], newest last
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self.pos
+        elif whence == io.SEEK_END:
+            pos += self.size
+        elif whence != io.SEEK_SET:
+            raise ValueError('invalid whence (%r)' % whence)
+        if pos < 0:
+            raise ValueError('negative seek position %d' % pos)
+        self.pos = pos
+        return pos
+
+    def readinto(self, b):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+
+        view = memoryview(b).cast('B')
+        want = max(min(len(view), self.size - self.pos), 0)
+        done = 0
+        while done < want:
+            start, chunk = self._chunk_at(self.pos)
+            skip = self.pos - start
+            n = min(len(chunk) - skip, want - done)
+            view[done:done+n] = chunk[skip:skip+n]
+            done += n
+            self.pos += n
+        return done
+
+    def close(self):
+        if not self.closed:
+            self._cursors = []
+            self.f.close()
+        super().close()
+
+    def _chunk_at(self, pos):
+        unit = bisect.bisect_right(self.starts, pos) - 1
+
+        usable = [c for c in self._cursors if c[0] == unit and c[2] <= pos]
+        if usable:
+            cursor = max(usable, key=lambda c: c[2])
+            self._cursors.remove(cursor)
+        else:
+            cursor = [unit, self._unit_chunks(unit), self.units[unit][0], b'']
+            if len(self._cursors) >= self.ncursors: del self._cursors[0]
+        self._cursors.append(cursor)
+
+        while pos >= cursor[2] + len(cursor[3]):
+            cursor[2] += len(cursor[3])
+            cursor[3] = next(cursor[1], None)
+            if not cursor[3]:
+                raise ValueError('compressed image ends early at %d' % pos)
+        return cursor[2], cursor[3]
+
+    def _unit_chunks(self, unit):
+        ustart, cstart, cend, extra = self.units[unit]
+
+        if self.format == 'gzip':
+            d = zlib.decompressobj(31)
+            while not d.eof:
+                data = pread(self.f, cstart, min(_CHUNK, cend - cstart))
+                if not data: return
+                cstart += len(data)
+                while True: # a full chunk out means there may be more to come, even with no input
+                    out = d.decompress(data, _CHUNK)
+                    data = d.unconsumed_tail
+                    if out: yield out
+                    if d.eof or (not data and len(out) < _CHUNK): break
+
+        elif self.format == 'xz':
+            flags = struct.pack('<H', extra)
+            header = _XZ_MAGIC + flags + struct.pack('<L', zlib.crc32(flags))
+            record = b'\x00' + _pack_varint(1) + _pack_varint(cend - cstart) + \
+                _pack_varint(self._unit_size(unit))
+            record += bytes(-len(record) % 4)
+            index = record + struct.pack('<L', zlib.crc32(record))
+            footer = struct.pack('<L', len(index) // 4 - 1) + flags
+            footer = struct.pack('<L', zlib.crc32(footer)) + footer + b'YZ'
+
+            d = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+            def feed(data):
+                while not d.eof:
+                    out = d.decompress(data, _CHUNK)
+                    data = b''
+                    if out: yield out
+                    if d.needs_input: break
+
+            yield from feed(header)
+            padded = (cend + 3) & ~3
+            while cstart < padded:
+                data = pread(self.f, cstart, min(_CHUNK, padded - cstart))
+                if not data: return
+                cstart += len(data)
+                yield from feed(data)
+            yield from feed(index + footer)
+
+        else: # bz2, in bits
+            first = cstart // 8
+            buf = pread(self.f, first, (cend + 7) // 8 - first)
+            stream = _bz2_block_stream(buf, cstart - first*8, cend - first*8)
+            d = bz2.BZ2Decompressor()
+            while not d.eof:
+                out = d.decompress(stream, _CHUNK)
+                stream = b''
+                if out: yield out
+                if d.needs_input: break
+
+    def _unit_size(self, unit):
+        end = self.starts[unit + 1] if unit + 1 < len(self.starts) else self.size
+        return end - self.starts[unit]
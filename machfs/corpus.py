@@ -0,0 +1,139 @@
+import collections
+import concurrent.futures
+import contextlib
+import fnmatch
+import os
+import sqlite3
+from . import compressed, image
+
+
+IndexResult = collections.namedtuple('IndexResult', 'scanned skipped removed failed')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    volume TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS entries (
+    image_id INTEGER NOT NULL REFERENCES images(id) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    cnid INTEGER NOT NULL,
+    type TEXT,
+    creator TEXT,
+    data_length INTEGER,
+    rsrc_length INTEGER,
+    crdate INTEGER,
+    mddate INTEGER,
+    data_digest TEXT,
+    rsrc_digest TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_image ON entries(image_id);
+CREATE INDEX IF NOT EXISTS entries_type ON entries(type);
+CREATE INDEX IF NOT EXISTS entries_creator ON entries(creator);
+CREATE INDEX IF NOT EXISTS entries_data_digest ON entries(data_digest);
+'''
+
+
+def _scan_image(job):
+    """Read one image's catalog, in a worker process
+
+    Returns (path, volume name, rows, error), where rows match the
+    entries table without its image_id column.
+    """
+    path, algorithm = job
+    try:
+        with compressed.open_image(path, sidecar=False) as f: # each image is read once, so don't leave indexes about
+            catalog = image.Catalog(f)
+            rows = []
+            for hfspath, cnid, datarec in catalog.walk():
+                if isinstance(datarec, image.FilRec):
+                    rows.append((':'.join(hfspath), 'file', cnid,
+                        datarec.filUsrWds[:4].decode('mac_roman'), datarec.filUsrWds[4:8].decode('mac_roman'),
+                        datarec.filLgLen, datarec.filRLgLen, datarec.filCrDat, datarec.filMdDat,
+                        catalog.digest(datarec, 'data', algorithm) if algorithm else None,
+                        catalog.digest(datarec, 'rsrc', algorithm) if algorithm else None))
+                else:
+                    rows.append((':'.join(hfspath), 'folder', cnid,
+                        None, None, None, None, datarec.dirCrDat, datarec.dirMdDat, None, None))
+            return path, catalog.mdb.drVN.decode('mac_roman'), rows, None
+
+    except Exception as e: # one bad image must not stop the run
+        return path, None, [], '%s: %s' % (type(e).__name__, e)
+
+
+def _candidates(root, pattern):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if fnmatch.fnmatch(name, pattern):
+                yield os.path.join(dirpath, name)
+
+
+def index_corpus(root, db_path, pattern='*', algorithm='sha256', jobs=None):
+    """Index the catalog of every HFS image under a directory into SQLite
+
+    Every file matching pattern is tried. Each file or folder becomes a
+    row of the entries table (see SCHEMA) and each image a row of the
+    images table, with error set if it could not be read. Images whose
+    size and mtime match the last run are skipped, and images that have
+    gone (including dangling symlinks) are removed.
+
+    The catalogs are read by a pool of jobs worker processes (default:
+    one per CPU, or none if jobs=1). algorithm=None skips fork digests,
+    which is much faster because then no fork is read.
+    """
+    db = sqlite3.connect(db_path)
+    try:
+        db.execute('PRAGMA foreign_keys = ON')
+        db.executescript(SCHEMA)
+
+        known = {path: (size, mtime_ns) for (path, size, mtime_ns) in db.execute('SELECT path, size, mtime_ns FROM images')}
+
+        todo = {}
+        skipped = 0
+        for path in _candidates(root, pattern):
+            try:
+                st = os.stat(path)
+            except OSError: # a dangling symlink, or deleted since the walk, so treat it as gone
+                continue
+            if known.pop(path, None) == (st.st_size, st.st_mtime_ns):
+                skipped += 1
+            else:
+                todo[path] = st
+
+        for path in known: # no longer there
+            db.execute('DELETE FROM images WHERE path = ?', (path,))
+
+        scanned = failed = 0
+        work = [(path, algorithm) for path in todo]
+
+        with contextlib.ExitStack() as stack:
+            if jobs == 1:
+                results = map(_scan_image, work)
+            else:
+                pool = stack.enter_context(concurrent.futures.ProcessPoolExecutor(jobs))
+                results = pool.map(_scan_image, work, chunksize=4)
+
+            for path, volume, rows, error in results:
+                st = todo[path]
+                db.execute('DELETE FROM images WHERE path = ?', (path,))
+                image_id = db.execute('INSERT INTO images (path, size, mtime_ns, volume, error) VALUES (?, ?, ?, ?, ?)',
+                    (path, st.st_size, st.st_mtime_ns, volume, error)).lastrowid
+                db.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    ((image_id, *row) for row in rows))
+                scanned += 1
+                failed += error is not None
+
+                if scanned % 100 == 0:
+                    db.commit() # so that an interrupted run keeps most of what it has done
+
+        db.commit()
+        return IndexResult(scanned=scanned, skipped=skipped, removed=len(known), failed=failed)
+
+    finally:
+        db.close()
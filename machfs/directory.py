@@ -1,12 +1,27 @@
 from collections.abc import MutableMapping
+import fnmatch
+import io
+import json
 import os
 from os import path
+import posixpath
 from macresources import make_rez_code, parse_rez_code, make_file, parse_file
+import stat
 import sys
+import tarfile
+import time
+import zipfile
+from .forkio import LazyFork, ForkIO
 
 
 TEXT_TYPES = [b'TEXT', b'ttro'] # Teach Text read-only
 
+INDEX_NAME = '.idump' # optional metadata for a whole tree, instead of one .idump per file
+
+_UNIX_EPOCH = 2082844800 # 1970 in HFS seconds-since-1904
+
+_rdump_cache = None # compiled .rdump files, keyed by file identity, set by machfs.server
+
 
 def _unsyncability(name): # files named '_' reserved for directory Finder info
     if path.splitext(name)[1].lower() in ('.rdump', '.idump'): return True
@@ -38,32 +53,318 @@ def _symlink_rel(src, dst):
 def _get_datafork_paths(base):
     """Symlinks are NOT GOOD"""
     base = path.abspath(path.realpath(base))
-    for dirpath, dirnames, filenames in os.walk(base):
-        dirnames[:] = [x for x in dirnames if not _unsyncability(x)]
-        filenames[:] = [x for x in filenames if not _unsyncability(x)]
+    yield from _scan_datafork_paths(base, base)
 
-        for kindcode, the_list in ((0, filenames), (1, dirnames)):
-            for fname in the_list:
-                nativepath = path.join(dirpath, fname)
-                hfspath = tuple(_swapsep(c) for c in path.relpath(nativepath, base).split(path.sep))
+def _scan_datafork_paths(base, dirpath):
+    # Like os.walk, but one directory listing also tells us about symlinks and sidecars
+    try:
+        with os.scandir(dirpath) as it:
+            entries = list(it)
+    except OSError:
+        return
+
+    listing = set(e.name for e in entries)
+    filenames, dirnames = [], []
+    for e in entries:
+        if _unsyncability(e.name): continue
+        try:
+            is_dir = e.is_dir()
+        except OSError:
+            is_dir = False
+        (dirnames if is_dir else filenames).append(e)
 
-                hfslink = kindcode # if not a link then default to this
+    for kindcode, the_list in ((0, filenames), (1, dirnames)):
+        for e in the_list:
+            nativepath = e.path
+            hfspath = tuple(_swapsep(c) for c in path.relpath(nativepath, base).split(path.sep))
 
-                if path.islink(nativepath):
-                    nativelink = path.realpath(nativepath)
-                    if len(path.commonpath((nativelink, base))) < len(base): continue
+            hfslink = kindcode # if not a link then default to this
 
-                    hfslink = tuple(_swapsep(c) for c in path.relpath(nativelink, base).split(path.sep))
-                    if hfslink == (path.relpath('x', 'x'),): hfslink = () # nasty special case
+            if e.is_symlink():
+                nativelink = path.realpath(nativepath)
+                if len(path.commonpath((nativelink, base))) < len(base): continue
 
-                yield nativepath, hfspath, hfslink
+                hfslink = tuple(_swapsep(c) for c in path.relpath(nativelink, base).split(path.sep))
+                if hfslink == (path.relpath('x', 'x'),): hfslink = () # nasty special case
+
+            sidecars = [ext for ext in ('.idump', '.rdump') if e.name + ext in listing]
+
+            yield nativepath, hfspath, hfslink, sidecars
+
+    for e in dirnames:
+        if not e.is_symlink():
+            yield from _scan_datafork_paths(base, e.path)
 
 def _swapsep(n):
     return n.replace(':', path.sep)
 
+def _iter_syncable(iter_paths):
+    """Filter out unsyncable names, and everything inside unsyncable folders"""
+    blacklist = list()
+    for p, obj in iter_paths:
+        blacklist_test = ':'.join(p) + ':'
+        if blacklist_test.startswith(tuple(blacklist)): continue
+        if _unsyncability(p[-1]):
+            print('Ignoring unsyncable name: %r' % (':' + ':'.join(p)), file=sys.stderr)
+            blacklist.append(blacklist_test)
+            continue
+
+        yield p, obj
+
+def _glob_parts(pattern): # 'Sources:*.c' -> ['sources', '*.c'], one glob per name
+    return [c.lower() for c in pattern.split(':') if c]
+
+def _glob_matches(parts, p): # p is the match, or inside it
+    return len(p) >= len(parts) and all(fnmatch.fnmatchcase(n.lower(), g) for (n, g) in zip(p, parts))
+
+def _glob_leads_to(parts, p): # something inside folder p could be the match
+    return len(p) < len(parts) and all(fnmatch.fnmatchcase(n.lower(), g) for (n, g) in zip(p, parts))
+
+def _iter_selected(folder, include=(), exclude=(), types=(), creators=()):
+    """Like iter_paths, but only the files that pass the filters (see write_folder), and the folders that hold them
+
+    Only names, types and creators are looked at, so no fork of a file
+    that is left out is ever read, and a folder that cannot hold a match
+    is skipped without walking it.
+    """
+    include = [_glob_parts(g) for g in include]
+    exclude = [_glob_parts(g) for g in exclude]
+    types, creators = set(types), set(creators)
+
+    def walk(folder, prefix, inside):
+        for name, child in folder.items():
+            p = prefix + (name,)
+            if any(_glob_matches(g, p) for g in exclude): continue
+            child_inside = inside or any(_glob_matches(g, p) for g in include)
+
+            if isinstance(child, AbstractFolder):
+                if not child_inside and not any(_glob_leads_to(g, p) for g in include): continue
+                below = walk(child, p, child_inside)
+                first = next(below, None)
+                if first is not None or (child_inside and not types and not creators):
+                    yield p, child
+                if first is not None:
+                    yield first
+                    yield from below
+
+            elif child_inside and (not types or child.type in types) and (not creators or child.creator in creators):
+                yield p, child
+
+    return walk(folder, (), not include)
+
+def _native_data(obj):
+    data = obj.data
+    if obj.type in TEXT_TYPES:
+        data = bytes(data).decode('mac_roman').replace('\r', os.linesep).encode('utf8')
+    return data
+
+def _mac_text(data):
+    data = data.replace(b'\r\n', b'\r').replace(b'\n', b'\r')
+    try:
+        data = data.decode('utf8').encode('mac_roman')
+    except UnicodeEncodeError:
+        pass # not happy, but whatever...
+    return data
+
+def _archive_hfspath(name):
+    return tuple(c.replace(':', '/') for c in name.split('/') if c not in ('', '.'))
+
+def _iter_archive(fileobj):
+    """Yield (name, kind, mtime, payload) for each member of a tar or zip archive
+
+    kind is 'file', 'dir' or 'link', and payload is the file contents or
+    the link target.
+    """
+    if hasattr(fileobj, 'peek'):
+        magic = fileobj.peek(4)[:4]
+    else:
+        magic = fileobj.read(4)
+        fileobj.seek(-len(magic), 1)
+
+    if magic[:2] == b'PK':
+        if not fileobj.seekable():
+            fileobj = io.BytesIO(fileobj.read())
+        with zipfile.ZipFile(fileobj) as z:
+            for info in z.infolist():
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                if info.is_dir():
+                    yield info.filename, 'dir', mtime, None
+                elif stat.S_ISLNK(info.external_attr >> 16):
+                    yield info.filename, 'link', mtime, z.read(info).decode('utf8')
+                else:
+                    yield info.filename, 'file', mtime, z.read(info)
+
+    else:
+        with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+            for member in tar:
+                if member.isdir():
+                    yield member.name, 'dir', member.mtime, None
+                elif member.issym():
+                    yield member.name, 'link', member.mtime, member.linkname
+                elif member.isfile():
+                    yield member.name, 'file', member.mtime, tar.extractfile(member).read()
+
+def _compile_rdump(f):
+    if _rdump_cache is None:
+        return make_file(parse_rez_code(f.read()), align=4)
+
+    st = os.fstat(f.fileno())
+    key = f.name, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+    if key not in _rdump_cache:
+        _rdump_cache[key] = make_file(parse_rez_code(f.read()), align=4)
+    return _rdump_cache[key]
+
+def _ingest_file(thefile, nativepath, sidecars, entry, date, mpw_dates, lazy):
+    thefile.crdate = thefile.mddate = thefile.bkdate = date
+
+    if mpw_dates: thefile.real_t = 0
+
+    if entry is not None:
+        _apply_index_entry(thefile, entry)
+
+    elif '.idump' in sidecars:
+        try:
+            with open(nativepath + '.idump', 'rb') as f:
+                if mpw_dates: thefile.real_t = max(thefile.real_t, path.getmtime(f.name))
+                thefile.type = f.read(4)
+                thefile.creator = f.read(4)
+        except FileNotFoundError:
+            pass
+
+    if '.rdump' in sidecars:
+        try:
+            with open(nativepath + '.rdump', 'rb') as f:
+                if mpw_dates: thefile.real_t = max(thefile.real_t, path.getmtime(f.name))
+                thefile.rsrc = _compile_rdump(f)
+        except FileNotFoundError:
+            pass
+
+    if lazy and thefile.type not in TEXT_TYPES:
+        # leave the data fork on disk until Volume.write copies it
+        if mpw_dates: thefile.real_t = max(thefile.real_t, path.getmtime(nativepath))
+        thefile.data = LazyFork(nativepath)
+    else:
+        with open(nativepath, 'rb') as f:
+            if mpw_dates: thefile.real_t = max(thefile.real_t, path.getmtime(f.name))
+            thefile.data = f.read()
+
+    if thefile.type in TEXT_TYPES:
+        thefile.data = _mac_text(thefile.data)
+
+def _index_key(hfspath):
+    return '/'.join(c.replace('/', ':') for c in hfspath)
+
+def _index_entry(obj):
+    entry = dict(crdate=obj.crdate, mddate=obj.mddate, bkdate=obj.bkdate)
+    if isinstance(obj, (File, Folder)):
+        entry.update(flags=obj.flags, x=obj.x, y=obj.y)
+    if isinstance(obj, File):
+        entry.update(type=obj.type.decode('mac_roman'), creator=obj.creator.decode('mac_roman'))
+    return entry
+
+def _index_fields(obj): # what an index entry may set, no more, as the file is hand-editable
+    fields = ('crdate', 'mddate', 'bkdate')
+    if isinstance(obj, (File, Folder)):
+        fields += ('flags', 'x', 'y')
+    if isinstance(obj, File):
+        fields += ('type', 'creator', 'locked')
+    return fields
+
+def _apply_index_entry(obj, entry):
+    if not entry: return
+    fields = _index_fields(obj)
+    for k, v in entry.items():
+        if k not in fields:
+            continue # e.g. 'alias', implied by the symlink
+        if k in ('type', 'creator'):
+            v = v.encode('mac_roman')
+        setattr(obj, k, v)
+
+def _read_index(index_path):
+    try:
+        with open(index_path, 'rb') as f:
+            return json.loads(f.read().decode('utf8'))
+    except FileNotFoundError:
+        return {}
+
+def _dump_index(index):
+    # one line per entry, so that diffs stay readable
+    lines = (json.dumps(k) + ': ' + json.dumps(v, sort_keys=True) for (k, v) in sorted(index.items()))
+    return ('{\n' + ',\n'.join(lines) + '\n}\n').encode('utf8')
+
+def _open_fork(fork):
+    if isinstance(fork, LazyFork):
+        return ForkIO(fork)
+    else:
+        return io.BytesIO(fork)
+
+def _rez_dump(obj):
+    return make_rez_code(parse_file(bytes(obj.rsrc)), ascii_clean=True)
+
+def _tarinfo(arcname, obj, **kwargs):
+    info = tarfile.TarInfo(arcname)
+    info.mtime = max(obj.mddate - _UNIX_EPOCH, 0)
+    info.mode = 0o644
+    for k, v in kwargs.items():
+        setattr(info, k, v)
+    return info
+
+
+
+class _TreeIndex:
+    """Secondary indexes over a whole tree, kept up to date by AbstractFolder
+
+    Every folder in the tree points back here (folder._index) and knows
+    its own path (folder._path), so adding or removing anything costs
+    only the size of what was added or removed.
+    """
+
+    def __init__(self, attrs=()):
+        self.tables = {attr: {} for attr in attrs} # attr -> value -> {lowercase path: (path, obj)}
+        self.values = {} # lowercase path -> {attr: value when it was indexed}
+        self.cnids = {}  # cnid -> obj, for objects read from an image
+        self.cnid_of = {} # id(obj) -> cnid
+
+    def attach(self, path, obj, known_cnids={}, lower=None):
+        if lower is None: lower = tuple(n.lower() for n in path)
+
+        if id(obj) in known_cnids:
+            cnid = known_cnids[id(obj)]
+            self.cnids[cnid] = obj
+            self.cnid_of[id(obj)] = cnid
+
+        if isinstance(obj, AbstractFolder):
+            obj._index, obj._path = self, path
+            for name, child in obj.items():
+                self.attach(path + (name,), child, known_cnids, lower + (name.lower(),))
+
+        elif self.tables:
+            self.values[lower] = vals = {attr: getattr(obj, attr, None) for attr in self.tables}
+            for attr, value in vals.items():
+                self.tables[attr].setdefault(value, {})[lower] = (path, obj)
+
+    def detach(self, path, obj):
+        cnid = self.cnid_of.pop(id(obj), None)
+        if cnid is not None:
+            del self.cnids[cnid]
+
+        if isinstance(obj, AbstractFolder):
+            for name, child in obj.items():
+                self.detach(path + (name,), child)
+            obj._index, obj._path = None, ()
+
+        elif self.tables:
+            lower = tuple(n.lower() for n in path)
+            for attr, value in self.values.pop(lower, {}).items():
+                table = self.tables[attr]
+                del table[value][lower]
+                if not table[value]: del table[value]
 
 
 class AbstractFolder(MutableMapping):
+    _index = None # a _TreeIndex, if the tree this folder is in has one
+    _path = ()
+
     def __init__(self, from_dict=()):
         self._prefdict = {} # lowercase to preferred
         self._maindict = {} # lowercase to contents
@@ -88,9 +389,16 @@ class AbstractFolder(MutableMapping):
         key.encode('mac_roman')
 
         lower = key.lower()
+
+        if self._index is not None and lower in self._maindict:
+            self._index.detach(self._path + (self._prefdict[lower],), self._maindict[lower])
+
         self._prefdict[lower] = key
         self._maindict[lower] = value
 
+        if self._index is not None:
+            self._index.attach(self._path + (key,), value)
+
     def __getitem__(self, key):
         if isinstance(key, tuple):
             if len(key) == 1:
@@ -125,9 +433,66 @@ class AbstractFolder(MutableMapping):
             pass
 
         lower = key.lower()
+
+        if self._index is not None and lower in self._maindict:
+            self._index.detach(self._path + (self._prefdict[lower],), self._maindict[lower])
+
         del self._maindict[lower]
         del self._prefdict[lower]
 
+    def add_children(self, children, validate=True):
+        """Add many (parent folder, name, object) triples in one pass
+
+        Each does what parent[name] = object does, where parent is this
+        folder or any folder in it (or added by an earlier triple), but
+        without walking any path. With validate=False the names must
+        already be str that encode as mac_roman, and are not checked.
+        Indexes (see Volume.index_by) are updated once, at the end.
+        """
+        attach = []
+        for parent, name, obj in children:
+            if validate:
+                if isinstance(name, bytes):
+                    name = name.decode('mac_roman')
+                name.encode('mac_roman')
+
+            lower = name.lower()
+
+            index = parent._index
+            if index is not None:
+                if lower in parent._maindict:
+                    index.detach(parent._path + (parent._prefdict[lower],), parent._maindict[lower])
+                attach.append((index, parent._path + (name,), obj))
+
+            parent._prefdict[lower] = name
+            parent._maindict[lower] = obj
+
+        for index, p, obj in attach:
+            index.attach(p, obj)
+
+    def add_paths(self, entries, validate=True):
+        """Add many (path tuple, object) pairs in one pass, parents before children
+
+        Like self[path] = object for each, except that each parent folder
+        is found from the one before, not by walking the path from here.
+        So for a sorted or top-down listing, the cost is close to that of
+        the dict inserts. See add_children for validate.
+        """
+        folders = {(): self}
+
+        def triples():
+            for p, obj in entries:
+                if not p: raise KeyError(p)
+                try:
+                    parent = folders[p[:-1]]
+                except KeyError: # already in the tree, or in another case
+                    parent = folders[p[:-1]] = self[p[:-1]]
+                if isinstance(obj, AbstractFolder):
+                    folders[p] = obj
+                yield parent, p[-1], obj
+
+        self.add_children(triples(), validate)
+
     def __iter__(self):
         return iter(self._prefdict.values())
 
@@ -181,78 +546,279 @@ class AbstractFolder(MutableMapping):
         for dn in dirnames: # the caller can change dirnames in a loop
             yield from self[dn]._recursive_walk(my_path=my_path+(dn,), topdown=topdown)
 
-    def read_folder(self, folder_path, date=0, mpw_dates=False):
+    def read_folder(self, folder_path, date=0, mpw_dates=False, lazy=False, stats=None):
+        if stats: stats.start('read_folder')
+
         self.crdate = self.mddate = self.bkdate = date
 
+        index = _read_index(path.join(folder_path, INDEX_NAME))
+        _apply_index_entry(self, index.get(''))
+
+        walked = list(_get_datafork_paths(folder_path))
+
+        if stats: stats.lap('walk', entries=len(walked), indexed=len(index))
+
         deferred_aliases = []
-        for nativepath, hfspath, hfslink in _get_datafork_paths(folder_path):
+        entries = [] # (hfspath, object), parents first, to add in one pass
+        for nativepath, hfspath, hfslink, sidecars in walked:
+            entry = index.get(_index_key(hfspath))
+
             if hfslink == 0: # file
-                thefile = File(); self[hfspath] = thefile
+                thefile = File(); entries.append((hfspath, thefile))
+                _ingest_file(thefile, nativepath, sidecars, entry, date, mpw_dates, lazy)
+
+            elif hfslink == 1: # folder
+                thedir = Folder(); entries.append((hfspath, thedir))
+                thedir.crdate = thedir.mddate = thedir.bkdate = date
+                _apply_index_entry(thedir, entry)
+
+            else: # symlink, i.e. alias
+                deferred_aliases.append((hfspath, hfslink)) # alias, targetpath
+
+        self.add_paths(entries, validate=False) # _scan_datafork_paths skipped unsyncable names
+
+        if stats:
+            files = [obj for (p, obj) in self.iter_paths() if isinstance(obj, File)]
+            stats.lap('ingest', files=len(files), bytes=sum(len(f.data) + len(f.rsrc) for f in files))
+
+        self._make_aliases(deferred_aliases, index)
+
+        if mpw_dates:
+            self._spread_mpw_dates()
+
+        if stats: stats.lap('aliases and dates', aliases=len(deferred_aliases))
+
+    def update_folder(self, folder_path, changed, date=0, mpw_dates=False, lazy=False):
+        """After read_folder, re-read only the native paths that changed
+
+        changed lists paths below folder_path (e.g. from machfs.watch)
+        that were created, modified or deleted: data forks, their .idump
+        and .rdump sidecars, or folders. The other arguments must match
+        those given to read_folder.
+
+        Returns False, having changed nothing, if only a fresh read_folder
+        will do: when the INDEX_NAME file or a symlink is involved.
+        """
+        base = path.abspath(path.realpath(folder_path))
+        index = _read_index(path.join(base, INDEX_NAME))
+
+        todo = set()
+        for p in changed:
+            rel = path.relpath(path.abspath(p), path.abspath(folder_path))
+            if rel == INDEX_NAME: return False
+            if rel == os.curdir or rel.split(path.sep)[0] == os.pardir: continue
+
+            stem, ext = path.splitext(rel)
+            if ext.lower() in ('.idump', '.rdump'): rel = stem
+
+            parts = tuple(rel.split(path.sep))
+            if any(_unsyncability(c) for c in parts): continue
+            todo.add(parts)
+
+        todo = sorted(todo, key=len) # parents first
+        for parts in todo:
+            hfspath = tuple(_swapsep(c) for c in parts)
+            try:
+                old = self[hfspath]
+            except KeyError:
+                old = None
+            if path.islink(path.join(base, *parts)) or getattr(old, 'aliastarget', None) is not None:
+                return False
+
+        deferred_aliases = []
+        for parts in todo:
+            nativepath = path.join(base, *parts)
+            hfspath = tuple(_swapsep(c) for c in parts)
+            entry = index.get(_index_key(hfspath))
+
+            try:
+                parent = self[hfspath[:-1]]
+            except KeyError:
+                continue # inside something that is not there any more
+            if not isinstance(parent, AbstractFolder): continue
+            old = parent.get(hfspath[-1])
+
+            if path.isdir(nativepath):
+                if isinstance(old, AbstractFolder): continue # its contents are listed separately
+
+                thedir = Folder(); self[hfspath] = thedir
+                thedir.crdate = thedir.mddate = thedir.bkdate = date
+                _apply_index_entry(thedir, entry)
+
+                # A folder moved in all at once, so take everything in it
+                for subpath, subhfspath, hfslink, sidecars in _scan_datafork_paths(base, nativepath):
+                    if hfslink == 0:
+                        thefile = File(); self[subhfspath] = thefile
+                        _ingest_file(thefile, subpath, sidecars, index.get(_index_key(subhfspath)), date, mpw_dates, lazy)
+                    elif hfslink == 1:
+                        subdir = Folder(); self[subhfspath] = subdir
+                        subdir.crdate = subdir.mddate = subdir.bkdate = date
+                        _apply_index_entry(subdir, index.get(_index_key(subhfspath)))
+                    else:
+                        deferred_aliases.append((subhfspath, hfslink))
+
+            elif path.isfile(nativepath):
+                # Refill the same File, so that aliases to it stay good
+                thefile = old if isinstance(old, File) else File()
+                thefile.__init__()
+                sidecars = [ext for ext in ('.idump', '.rdump') if path.exists(nativepath + ext)]
+                _ingest_file(thefile, nativepath, sidecars, entry, date, mpw_dates, lazy)
+                self[hfspath] = thefile # and reindex it
+
+            elif old is not None:
+                del self[hfspath]
+
+        self._make_aliases(deferred_aliases, index)
+
+        if mpw_dates:
+            for pathtpl, obj in self.iter_paths():
+                if hasattr(obj, 'real_t'): obj.crdate = date
+            self._spread_mpw_dates()
+
+        return True
+
+    def read_archive(self, fileobj, date=0, mpw_dates=False):
+        """Like read_folder, but from a tar or zip archive, in one pass and without extracting
+
+        The archive uses the write_folder layout. Sidecar files may appear
+        before or after their data fork. A zip archive is buffered in
+        memory if fileobj cannot seek.
+        """
+        self.crdate = self.mddate = self.bkdate = date
+
+        files = {} # hfspath: (File, mtime)
+        sidecars = {} # (hfspath, ext): (contents, mtime)
+        links = {} # hfspath: hfspath of target
+        folders = {(): self}
+
+        def folder_at(hfspath): # tar files need not list every folder, or list them first
+            if hfspath not in folders:
+                thedir = Folder()
+                thedir.crdate = thedir.mddate = thedir.bkdate = date
+                folder_at(hfspath[:-1])[hfspath[-1]] = thedir
+                folders[hfspath] = thedir
+            return folders[hfspath]
+
+        index = {}
+
+        for name, kind, mtime, payload in _iter_archive(fileobj):
+            hfspath = _archive_hfspath(name)
+            if hfspath == (INDEX_NAME,) and kind == 'file':
+                index = json.loads(payload.decode('utf8'))
+                continue
+            if not hfspath: continue
+
+            ext = path.splitext(hfspath[-1])[1].lower()
+            if kind == 'file' and ext in ('.idump', '.rdump') and not any(_unsyncability(c) for c in hfspath[:-1]):
+                sidecars[hfspath[:-1] + (hfspath[-1][:-len(ext)],), ext] = payload, mtime
+                continue
+
+            if any(_unsyncability(c) for c in hfspath): continue
+
+            if kind == 'file':
+                thefile = File(); folder_at(hfspath[:-1])[hfspath[-1]] = thefile
                 thefile.crdate = thefile.mddate = thefile.bkdate = date
+                thefile.data = payload
+                files[hfspath] = thefile, mtime
 
-                if mpw_dates: thefile.real_t = 0
+            elif kind == 'dir':
+                folder_at(hfspath)
 
-                try:
-                    with open(nativepath + '.idump', 'rb') as f:
-                        if mpw_dates: thefile.real_t = max(thefile.real_t, path.getmtime(f.name))
-                        thefile.type = f.read(4)
-                        thefile.creator = f.read(4)
-                except FileNotFoundError:
-                    pass
+            elif kind == 'link':
+                target = posixpath.normpath(posixpath.join(posixpath.dirname(name.strip('/')), payload))
+                if posixpath.isabs(payload) or target == '..' or target.startswith('../'):
+                    continue # points outside the tree, so ignore like read_folder
+                links[hfspath] = _archive_hfspath(target)
 
+        _apply_index_entry(self, index.get(''))
+        for hfspath, thedir in folders.items():
+            if hfspath: _apply_index_entry(thedir, index.get(_index_key(hfspath)))
+
+        for hfspath, (thefile, mtime) in files.items():
+            if mpw_dates: thefile.real_t = mtime
+
+            if _index_key(hfspath) in index:
+                _apply_index_entry(thefile, index[_index_key(hfspath)])
+            else:
                 try:
-                    with open(nativepath + '.rdump', 'rb') as f:
-                        if mpw_dates: thefile.real_t = max(thefile.real_t, path.getmtime(f.name))
-                        thefile.rsrc = make_file(parse_rez_code(f.read()), align=4)
-                except FileNotFoundError:
+                    idump, t = sidecars[hfspath, '.idump']
+                    if mpw_dates: thefile.real_t = max(thefile.real_t, t)
+                    thefile.type, thefile.creator = idump[:4], idump[4:8]
+                except KeyError:
                     pass
 
-                with open(nativepath, 'rb') as f:
-                    if mpw_dates: thefile.real_t = max(thefile.real_t, path.getmtime(f.name))
-                    thefile.data = f.read()
+            try:
+                rdump, t = sidecars[hfspath, '.rdump']
+                if mpw_dates: thefile.real_t = max(thefile.real_t, t)
+                thefile.rsrc = make_file(parse_rez_code(rdump), align=4)
+            except KeyError:
+                pass
 
-                if thefile.type in TEXT_TYPES:
-                    thefile.data = thefile.data.replace(b'\r\n', b'\r').replace(b'\n', b'\r')
-                    try:
-                        thefile.data = thefile.data.decode('utf8').encode('mac_roman')
-                    except UnicodeEncodeError:
-                        pass # not happy, but whatever...
+            if thefile.type in TEXT_TYPES:
+                thefile.data = _mac_text(thefile.data)
 
-            elif hfslink == 1: # folder
-                thedir = Folder(); self[hfspath] = thedir
-                thedir.crdate = thedir.mddate = thedir.bkdate = date
+        deferred_aliases = []
+        for hfspath, target in links.items():
+            seen = set()
+            while target in links and target not in seen: # symlink to symlink
+                seen.add(target)
+                target = links[target]
+            folder_at(hfspath[:-1])
+            deferred_aliases.append((hfspath, target))
 
-            else: # symlink, i.e. alias
-                deferred_aliases.append((hfspath, hfslink)) # alias, targetpath
+        self._make_aliases(deferred_aliases, index)
 
+        if mpw_dates:
+            self._spread_mpw_dates()
+
+    def _make_aliases(self, deferred_aliases, index=None):
+        if index is None: index = {}
         for aliaspath, targetpath in deferred_aliases:
             try:
                 alias = File()
+                _apply_index_entry(alias, index.get(_index_key(aliaspath)))
                 alias.flags |= 0x8000
                 alias.aliastarget = self[targetpath]
                 self[aliaspath] = alias
             except (KeyError, ValueError):
                 raise
 
-        if mpw_dates:
-            all_real_times = set()
-            for pathtpl, obj in self.iter_paths():
-                try:
-                    all_real_times.add(obj.real_t)
-                except AttributeError:
-                    pass
-            ts2idx = {ts: idx for (idx, ts) in enumerate(sorted(set(all_real_times)))}
+    def _spread_mpw_dates(self):
+        all_real_times = set()
+        for pathtpl, obj in self.iter_paths():
+            try:
+                all_real_times.add(obj.real_t)
+            except AttributeError:
+                pass
+        ts2idx = {ts: idx for (idx, ts) in enumerate(sorted(set(all_real_times)))}
 
-            for pathtpl, obj in self.iter_paths():
-                try:
-                    real_t = obj.real_t
-                except AttributeError:
-                    pass
-                else:
-                    fake_t = obj.crdate + 60 * ts2idx[real_t]
-                    obj.crdate = obj.mddate = obj.bkdate = fake_t
+        for pathtpl, obj in self.iter_paths():
+            try:
+                real_t = obj.real_t
+            except AttributeError:
+                pass
+            else:
+                fake_t = obj.crdate + 60 * ts2idx[real_t]
+                obj.crdate = obj.mddate = obj.bkdate = fake_t
+
+    def write_folder(self, folder_path, index=False, stats=None, include=(), exclude=(), types=(), creators=()):
+        """Write the tree to a native folder
+
+        If index is true then type, creator, Finder flags, dates and alias
+        targets go into a single INDEX_NAME file, instead of an .idump file
+        for every file.
+
+        To write only part of the tree, give include and exclude as lists of
+        colon-separated paths, in which each name is a case-insensitive glob
+        (e.g. 'Sources:*.c'), and types and creators as lists of 4-byte
+        codes. A file is written if it is (inside) a match of any include,
+        of no exclude, and has one of the types and creators, where each
+        empty list allows anything. Folders are written if they hold such
+        a file, or if they are inside an include and there is no type or
+        creator filter. Forks are only read from the files written.
+        """
+        if stats: stats.start('write_folder')
 
-    def write_folder(self, folder_path):
         def any_exists(at_path):
             if path.exists(at_path): return True
             if path.exists(at_path + '.rdump'): return True
@@ -260,22 +826,16 @@ class AbstractFolder(MutableMapping):
             return False
 
         written = []
-        blacklist = list()
         alias_fixups = list()
         valid_alias_targets = dict()
-        for p, obj in self.iter_paths():
-            blacklist_test = ':'.join(p) + ':'
-            if blacklist_test.startswith(tuple(blacklist)): continue
-            if _unsyncability(p[-1]):
-                print('Ignoring unsyncable name: %r' % (':' + ':'.join(p)), file=sys.stderr)
-                blacklist.append(blacklist_test)
-                continue
-
+        index_entries = {'': _index_entry(self)}
+        for p, obj in _iter_syncable(_iter_selected(self, include, exclude, types, creators)):
             nativepath = path.join(folder_path, *(comp.replace(path.sep, ':') for comp in p))
             info_path = nativepath + '.idump'
             rsrc_path = nativepath + '.rdump'
 
             valid_alias_targets[id(obj)] = nativepath
+            index_entries[_index_key(p)] = _index_entry(obj)
 
             if isinstance(obj, Folder):
                 os.makedirs(nativepath, exist_ok=True)
@@ -284,20 +844,21 @@ class AbstractFolder(MutableMapping):
                 if obj.aliastarget is not None:
                     alias_fixups.append((nativepath, id(obj.aliastarget)))
 
-                # always write the data fork
-                data = obj.data
-                if obj.type in TEXT_TYPES:
-                    data = data.decode('mac_roman').replace('\r', os.linesep).encode('utf8')
+                # always write the data fork (lazy forks copy from the image in-kernel)
+                data = _native_data(obj)
                 with open(nativepath, 'wb') as f:
-                    f.write(data)
+                    if isinstance(data, LazyFork):
+                        data.copy_to(f, 0)
+                    else:
+                        f.write(data)
 
                 # write a resource dump iff that fork has any bytes (dump may still be empty)
                 if obj.rsrc:
                     try:
-                        rdump = make_rez_code(parse_file(obj.rsrc), ascii_clean=True)
+                        rdump = _rez_dump(obj)
                     except:
                         with open(nativepath + '.rdump.corrupt', 'wb') as f:
-                            f.write(obj.rsrc)
+                            f.write(bytes(obj.rsrc))
                         print('Dumping corrupt resource fork: %r' % (':' + ':'.join(p)), file=sys.stderr)
                     else:
                         with open(rsrc_path, 'wb') as f:
@@ -307,7 +868,9 @@ class AbstractFolder(MutableMapping):
 
                 # write an info dump iff either field is non-null
                 idump = obj.type + obj.creator
-                if any(idump):
+                if index:
+                    pass
+                elif any(idump):
                     with open(info_path, 'wb') as f:
                         f.write(idump)
                 else:
@@ -318,6 +881,8 @@ class AbstractFolder(MutableMapping):
             for w in written:
                 os.utime(w, (t, t))
 
+        if stats: stats.lap('write', objects=len(valid_alias_targets))
+
         for alias_path, target_id in alias_fixups:
             try:
                 target_path = valid_alias_targets[target_id]
@@ -333,6 +898,78 @@ class AbstractFolder(MutableMapping):
                     if path.exists(target_path + ext):
                         _symlink_rel(target_path + ext, alias_path + ext)
 
+                key = path.relpath(alias_path, folder_path).replace(path.sep, '/')
+                index_entries[key]['alias'] = path.relpath(target_path, folder_path).replace(path.sep, '/')
+
+        if index:
+            with open(path.join(folder_path, INDEX_NAME), 'wb') as f:
+                f.write(_dump_index(index_entries))
+        else:
+            _try_delete(path.join(folder_path, INDEX_NAME))
+
+        if stats: stats.lap('aliases and index', aliases=len(alias_fixups))
+
+    def write_tar(self, fileobj, index=False, include=(), exclude=(), types=(), creators=()):
+        """Stream the write_folder layout into a tar archive, without temporary files
+
+        Members are emitted in tree order, one fork in memory at a time,
+        except that aliases come last, once the sidecars of their targets
+        are known. fileobj need not be seekable (e.g. sys.stdout.buffer).
+        The filters are those of write_folder.
+        """
+        syncable = list(_iter_syncable(_iter_selected(self, include, exclude, types, creators)))
+        arcnames = {id(obj): _index_key(p) for (p, obj) in syncable}
+        sidecars = {} # id(obj): extensions actually written, for aliases to link to
+        alias_fixups = []
+
+        with tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+            if index: # goes first, because we can't seek back to it
+                index_entries = {'': _index_entry(self)}
+                for p, obj in syncable:
+                    index_entries[arcnames[id(obj)]] = entry = _index_entry(obj)
+                    if isinstance(obj, File) and id(obj.aliastarget) in arcnames:
+                        entry['alias'] = arcnames[id(obj.aliastarget)]
+                idx = _dump_index(index_entries)
+                tar.addfile(_tarinfo(INDEX_NAME, self, size=len(idx)), io.BytesIO(idx))
+
+            for p, obj in syncable:
+                arcname = arcnames[id(obj)]
+
+                if isinstance(obj, Folder):
+                    tar.addfile(_tarinfo(arcname, obj, type=tarfile.DIRTYPE, mode=0o755))
+                    continue
+
+                if obj.aliastarget is not None and id(obj.aliastarget) in arcnames:
+                    alias_fixups.append((arcname, obj))
+                    continue
+
+                data = _native_data(obj)
+                if isinstance(data, LazyFork):
+                    tar.addfile(_tarinfo(arcname, obj, size=len(data)), data.open())
+                else:
+                    tar.addfile(_tarinfo(arcname, obj, size=len(data)), io.BytesIO(data))
+
+                if obj.rsrc:
+                    try:
+                        rdump, ext = _rez_dump(obj), '.rdump'
+                    except:
+                        rdump, ext = bytes(obj.rsrc), '.rdump.corrupt'
+                        print('Dumping corrupt resource fork: %r' % (':' + ':'.join(p)), file=sys.stderr)
+                    tar.addfile(_tarinfo(arcname + ext, obj, size=len(rdump)), io.BytesIO(rdump))
+                    sidecars.setdefault(id(obj), []).append(ext)
+
+                idump = obj.type + obj.creator
+                if any(idump) and not index:
+                    tar.addfile(_tarinfo(arcname + '.idump', obj, size=len(idump)), io.BytesIO(idump))
+                    sidecars.setdefault(id(obj), []).append('.idump')
+
+            # an alias becomes a relative symlink, just like in write_folder
+            for arcname, obj in alias_fixups:
+                target = arcnames[id(obj.aliastarget)]
+                for ext in [''] + [e for e in sidecars.get(id(obj.aliastarget), []) if e in ('.idump', '.rdump')]:
+                    linkname = posixpath.relpath(target + ext, posixpath.dirname(arcname))
+                    tar.addfile(_tarinfo(arcname + ext, obj, type=tarfile.SYMTYPE, linkname=linkname))
+
 
 class Folder(AbstractFolder):
     def __init__(self):
@@ -361,6 +998,18 @@ class File:
         self.rsrc = bytearray()
         self.data = bytearray()
 
+    def open_data(self):
+        """Return a seekable, readable binary file object over the data fork
+
+        A fork read lazily from an image or folder (a LazyFork) is read
+        piecemeal, only where asked. Otherwise this is an io.BytesIO.
+        """
+        return _open_fork(self.data)
+
+    def open_rsrc(self):
+        """Return a seekable, readable binary file object over the resource fork"""
+        return _open_fork(self.rsrc)
+
     def __str__(self):
         if isinstance(self.aliastarget, File):
             return '[alias] ' + str(self.aliastarget)
@@ -0,0 +1,202 @@
+import bisect
+import contextlib
+import io
+import os
+
+
+def _fileno(f):
+    try:
+        return f.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None # e.g. io.BytesIO
+
+
+def pread(f, offset, length):
+    """Read from a binary file object at an absolute offset"""
+    fd = _fileno(f)
+    if fd is None:
+        f.seek(offset)
+        return f.read(length)
+    else:
+        return os.pread(fd, length, offset)
+
+
+def preadinto(f, buf, offset):
+    """Read into a writable buffer from a binary file object at an absolute offset"""
+    fd = _fileno(f)
+    if fd is not None and hasattr(os, 'preadv'):
+        return os.preadv(fd, [buf], offset)
+    else:
+        f.seek(offset)
+        return f.readinto(buf)
+
+
+def copy_range(src_fd, src_pos, dst_fd, dst_pos, count):
+    """Copy count bytes between file descriptors, in the kernel if possible"""
+    while count:
+        try:
+            n = os.copy_file_range(src_fd, dst_fd, count, src_pos, dst_pos)
+        except (AttributeError, OSError): # not Linux, or not the same kind of fs
+            try:
+                os.lseek(dst_fd, dst_pos, os.SEEK_SET)
+                n = os.sendfile(dst_fd, src_fd, src_pos, count)
+            except (AttributeError, OSError):
+                buf = os.pread(src_fd, min(count, 1<<20), src_pos)
+                n = os.pwrite(dst_fd, buf, dst_pos) if buf else 0
+
+        if n == 0:
+            raise ValueError('source file ended %d bytes early' % count)
+
+        src_pos += n
+        dst_pos += n
+        count -= n
+
+
+class LazyFork:
+    """Fork contents that stay in a file until they are needed
+
+    source is a path or a binary file object. runs is a list of
+    (offset, length) byte ranges that are concatenated to make the fork,
+    or None to take the whole of the source file.
+    """
+
+    def __init__(self, source, runs=None):
+        self.source = source
+        if runs is None:
+            if isinstance(source, (str, bytes, os.PathLike)):
+                runs = [(0, os.path.getsize(source))]
+            else:
+                runs = [(0, source.seek(0, 2))]
+        self.runs = runs
+
+    def __len__(self):
+        return sum(length for (offset, length) in self.runs)
+
+    def __bytes__(self):
+        return b''.join(self.chunks())
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and bytes(self) == bytes(other)
+        except TypeError:
+            return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'LazyFork(%r, %r)' % (self.source, self.runs)
+
+    def _open(self):
+        if isinstance(self.source, (str, bytes, os.PathLike)):
+            return open(self.source, 'rb')
+        else:
+            return contextlib.nullcontext(self.source) # caller's file, so don't close it
+
+    def chunks(self, size=1<<20):
+        """Yield the contents of the fork in pieces of at most size bytes"""
+        with self._open() as f:
+            for offset, length in self.runs:
+                while length:
+                    buf = pread(f, offset, min(length, size))
+                    if not buf:
+                        raise ValueError('source file ended %d bytes early' % length)
+                    yield buf
+                    offset += len(buf)
+                    length -= len(buf)
+
+    def open(self):
+        """Return a seekable binary file object that reads the fork"""
+        return io.BufferedReader(ForkIO(self))
+
+    def copy_to(self, dest, pos):
+        """Write the fork into a binary file object at an absolute position"""
+        dst_fd = _fileno(dest)
+        if dst_fd is not None:
+            dest.flush()
+            with self._open() as f:
+                src_fd = _fileno(f)
+                if src_fd is not None:
+                    for offset, length in self.runs:
+                        copy_range(src_fd, offset, dst_fd, pos, length)
+                        pos += length
+                    return
+
+        dest.seek(pos)
+        for buf in self.chunks():
+            dest.write(buf)
+
+
+class ForkIO(io.RawIOBase):
+    """Seekable, read-only raw file object over a LazyFork
+
+    Only the bytes asked for are read from the source, by translating
+    each offset through the fork's runs. readinto() reads straight into
+    the caller's buffer where the OS allows.
+    """
+
+    def __init__(self, fork):
+        self.fork = fork
+        self.starts = [] # offset within the fork of each run
+        pos = 0
+        for offset, length in fork.runs:
+            self.starts.append(pos)
+            pos += length
+        self.size = pos
+        self.pos = 0
+
+        if isinstance(fork.source, (str, bytes, os.PathLike)):
+            self.f = open(fork.source, 'rb')
+            self.own_f = True
+        else:
+            self.f = fork.source
+            self.own_f = False
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self.pos
+        elif whence == io.SEEK_END:
+            pos += self.size
+        elif whence != io.SEEK_SET:
+            raise ValueError('invalid whence (%r)' % whence)
+        if pos < 0:
+            raise ValueError('negative seek position %d' % pos)
+        self.pos = pos
+        return pos
+
+    def readinto(self, b):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+
+        view = memoryview(b).cast('B')
+        want = max(min(len(view), self.size - self.pos), 0)
+        done = 0
+
+        i = bisect.bisect_right(self.starts, self.pos) - 1
+        while done < want:
+            offset, length = self.fork.runs[i]
+            skip = self.pos + done - self.starts[i]
+            n = min(length - skip, want - done)
+            if n > 0:
+                got = preadinto(self.f, view[done:done+n], offset + skip)
+                if not got:
+                    raise ValueError('source file ended %d bytes early' % (want - done))
+                done += got
+                if got < n: continue # short read, same run
+            i += 1
+
+        self.pos += done
+        return done
+
+    def close(self):
+        if not self.closed and self.own_f:
+            self.f.close()
+        super().close()
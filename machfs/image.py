@@ -0,0 +1,364 @@
+import collections
+import hashlib
+import os
+import struct
+from . import bitmanip, btree, compressed, forkio
+
+
+MDB_FORMAT = '>2sLLHHHHHLLHLH28pLHLLLHLL32sHHHL12sL12s'
+
+MDB = collections.namedtuple('MDB', '''
+    drSigWord drCrDate drLsMod drAtrb drNmFls
+    drVBMSt drAllocPtr drNmAlBlks drAlBlkSiz drClpSiz drAlBlSt
+    drNxtCNID drFreeBks drVN drVolBkUp drVSeqNum
+    drWrCnt drXTClpSiz drCTClpSiz drNmRtDirs drFilCnt drDirCnt
+    drFndrInfo drVCSize drVBMCSize drCtlCSize
+    drXTFlSize drXTExtRec
+    drCTFlSize drCTExtRec
+''')
+
+DirRec = collections.namedtuple('DirRec', '''
+    dirFlags dirVal dirDirID dirCrDat dirMdDat dirBkDat dirUsrInfo dirFndrInfo
+''')
+
+FilRec = collections.namedtuple('FilRec', '''
+    filFlags filTyp filUsrWds filFlNum
+    filStBlk filLgLen filPyLen
+    filRStBlk filRLgLen filRPyLen
+    filCrDat filMdDat filBkDat
+    filFndrInfo filClpSize
+    filExtRec filRExtRec
+''')
+
+ThdRec = collections.namedtuple('ThdRec', 'thdParID thdCName')
+
+ManifestEntry = collections.namedtuple('ManifestEntry', '''
+    path cnid type creator data_length rsrc_length data_digest rsrc_digest
+''')
+
+VolumeStat = collections.namedtuple('VolumeStat', '''
+    name crdate mddate bkdate
+    offset blksize total_blocks free_blocks bitmap_free_blocks
+    files folders
+''')
+
+
+def reader(image):
+    """Return (readat, length) for a bytes-like image or a binary file object"""
+    if hasattr(image, 'read'):
+        return (lambda offset, length: forkio.pread(image, offset, length)), image.seek(0, 2)
+    else:
+        return (lambda offset, length: image[offset:offset+length]), len(image)
+
+
+def find_mdb(image):
+    """Find the Master Directory Block, allowing for a partition map
+
+    Returns (offset of the volume within the image, MDB)
+    """
+    readat, image_len = reader(image)
+
+    for volstart in range(0, image_len, 512):
+        if readat(volstart+1024, 2) == b'BD':
+            break
+    else:
+        raise ValueError('Magic number not found in image')
+
+    return volstart, MDB._make(struct.unpack_from(MDB_FORMAT, readat(volstart+1024, 512)))
+
+
+def unpack_catalog_record(rec):
+    """Split a catalog leaf record into (ckrParID, ckrCName, cdrType, datarec)
+
+    cdrType is 1 (folder), 2 (file), 3 (folder thread) or 4 (file thread),
+    and datarec is a DirRec, FilRec or ThdRec to match.
+    """
+    rec_len = rec[0]
+    key = rec[2:1+rec_len]
+    val = rec[bitmanip.pad_up(1+rec_len, 2):]
+
+    ckrParID, namelen = struct.unpack_from('>LB', key)
+    ckrCName = key[5:5+namelen]
+
+    cdrType = val[0]
+    if cdrType == 1:
+        datarec = DirRec._make(struct.unpack_from('>HHLLLL16s16s', val, 2))
+    elif cdrType == 2:
+        datarec = FilRec._make(struct.unpack_from('>BB16sLHLLHLLLLL16sH12s12s', val, 2))
+    elif cdrType in (3, 4):
+        thdParID, namelen = struct.unpack_from('>8xLB', val, 2)
+        datarec = ThdRec(thdParID, val[15:15+namelen])
+    else:
+        raise ValueError('bad catalog record type %d' % cdrType)
+
+    return ckrParID, ckrCName, cdrType, datarec
+
+
+def unpack_extents_record(rec):
+    """Split an extents overflow leaf record into (xkrFkType, xkrFNum, xkrFABN, extrec)"""
+    return struct.unpack_from('>xBLH12s', rec)
+
+
+def _get_every_extent(nblocks, firstrecord, cnid, xoflow, fork):
+    accum = 0
+    extlist = []
+
+    for a, b in btree.unpack_extent_record(firstrecord):
+        if not b: continue
+        accum += b
+        extlist.append((a, b))
+
+    while accum < nblocks:
+        nextrecord = xoflow[cnid, fork, accum]
+        for a, b in btree.unpack_extent_record(nextrecord):
+            if not b: continue
+            accum += b
+            extlist.append((a, b))
+
+    return extlist
+
+
+class Catalog:
+    """The catalog of an HFS image, read without touching any fork
+
+    image is a bytes-like object or a binary file object, which must stay
+    open while forks are read from it. The extents overflow file and the
+    catalog file are each read once, the first time they are needed.
+
+    Fork digests are remembered in digest_cache, a mapping of str to str.
+    Pass the same one (e.g. a dbm database) to later Catalogs to avoid
+    hashing forks again. Its keys include the device, inode, size and
+    mtime of the image file, so it is only used for images with a file
+    descriptor (not bytes, BytesIO or CompressedImage), and a modified
+    image is hashed afresh.
+    """
+
+    def __init__(self, image, digest_cache=None):
+        self.image = image
+        self.readat, self.length = reader(image)
+        self.offset, self.mdb = find_mdb(image)
+        self._overflow = None
+        self._records = None
+
+        self.digest_cache = {} if digest_cache is None else digest_cache
+        fd = forkio._fileno(image)
+        if fd is None:
+            self.digest_cache = {} # nothing identifies the image beyond our own lifetime
+            self._fingerprint = 'object'
+        else:
+            st = os.fstat(fd)
+            self._fingerprint = '%d:%d:%d:%d' % (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def block2offset(self, block):
+        return self.offset + 512*self.mdb.drAlBlSt + self.mdb.drAlBlkSiz*block
+
+    def runs(self, cnid, fork, size, extrec):
+        """Get the (offset, length) byte ranges in the image that make up a fork"""
+        blksize = self.mdb.drAlBlkSiz
+        runs = []
+        for firstblk, blkcnt in _get_every_extent((size+blksize-1)//blksize, extrec, cnid, self.overflow, fork):
+            runs.append((self.block2offset(firstblk), min(blkcnt*blksize, size)))
+            size -= runs[-1][1]
+        return runs
+
+    def fork_runs(self, filrec, fork):
+        """Get the byte ranges of the 'data' or 'rsrc' fork of a FilRec"""
+        if fork == 'data':
+            return self.runs(filrec.filFlNum, 'data', filrec.filLgLen, filrec.filExtRec)
+        else:
+            return self.runs(filrec.filFlNum, 'rsrc', filrec.filRLgLen, filrec.filRExtRec)
+
+    def fork(self, filrec, fork):
+        """Get a fork as a LazyFork if the image is a file, otherwise as bytes"""
+        runs = self.fork_runs(filrec, fork)
+        if hasattr(self.image, 'read'):
+            return forkio.LazyFork(self.image, runs)
+        else:
+            return b''.join(self.readat(*r) for r in runs)
+
+    def chunks(self, filrec, fork, size=1<<20):
+        """Yield a fork in pieces of at most size bytes, one extent at a time"""
+        return self._read_runs(self.fork_runs(filrec, fork), size)
+
+    def _read_runs(self, runs, size=1<<20):
+        for offset, length in runs:
+            while length:
+                buf = self.readat(offset, min(length, size))
+                if not buf:
+                    raise ValueError('image ended %d bytes early' % length)
+                yield buf
+                offset += len(buf)
+                length -= len(buf)
+
+    def digest(self, filrec, fork, algorithm='sha256'):
+        """Hash a fork with hashlib, reading it one extent at a time unless the digest is cached"""
+        runs = self.fork_runs(filrec, fork)
+        key = '%s %s %s' % (self._fingerprint, algorithm, hashlib.sha1(repr(runs).encode('ascii')).hexdigest())
+
+        try:
+            cached = self.digest_cache[key]
+        except KeyError:
+            pass
+        else:
+            return cached.decode('ascii') if isinstance(cached, bytes) else cached # from dbm
+
+        h = hashlib.new(algorithm)
+        for buf in self._read_runs(runs):
+            h.update(buf)
+        self.digest_cache[key] = digest = h.hexdigest()
+        return digest
+
+    def manifest(self, algorithm='sha256'):
+        """List a ManifestEntry for every file, in catalog order"""
+        entries = []
+        for path, cnid, datarec in self.walk():
+            if isinstance(datarec, FilRec):
+                entries.append(ManifestEntry(
+                    path=path, cnid=cnid,
+                    type=datarec.filUsrWds[:4], creator=datarec.filUsrWds[4:8],
+                    data_length=datarec.filLgLen, rsrc_length=datarec.filRLgLen,
+                    data_digest=self.digest(datarec, 'data', algorithm),
+                    rsrc_digest=self.digest(datarec, 'rsrc', algorithm),
+                ))
+        return entries
+
+    def layout(self, algorithm='sha256'):
+        """Record where each contiguous fork is, for Volume.write to keep it there
+
+        The result is a dict that json can save as a sidecar file. Its
+        'forks' are [path, 'data' or 'rsrc', first block, block count,
+        digest] lists, with path as a list of names. 'offset' is where
+        block 0 is in the image, for Volume.write(in_place=True).
+        """
+        forks = []
+        for path, cnid, datarec in self.walk():
+            if isinstance(datarec, FilRec):
+                for fork, extrec, pylen in [('data', datarec.filExtRec, datarec.filPyLen), ('rsrc', datarec.filRExtRec, datarec.filRPyLen)]:
+                    first, count = struct.unpack_from('>HH', extrec)
+                    if pylen and count * self.mdb.drAlBlkSiz == pylen: # in one piece
+                        forks.append([list(path), fork, first, count, self.digest(datarec, fork, algorithm)])
+        return {'blksize': self.mdb.drAlBlkSiz, 'offset': self.block2offset(0), 'algorithm': algorithm, 'forks': forks}
+
+    def special_file(self, cnid):
+        """Get the contents of the extents (3) or catalog (4) file"""
+        if cnid == 3:
+            size, extrec = self.mdb.drXTFlSize, self.mdb.drXTExtRec
+            overflow = {}
+        else:
+            size, extrec = self.mdb.drCTFlSize, self.mdb.drCTExtRec
+            overflow = self.overflow
+
+        blksize = self.mdb.drAlBlkSiz
+        extents = _get_every_extent((size+blksize-1)//blksize, extrec, cnid, overflow, 'data')
+        return b''.join(self.readat(self.block2offset(first), count*blksize) for (first, count) in extents)[:size]
+
+    @property
+    def overflow(self):
+        """Extent records from the extents overflow file, keyed by (cnid, fork, first block)"""
+        if self._overflow is None:
+            self._overflow = {}
+            for rec in btree.dump_btree(self.special_file(3)):
+                if rec[0] != 7: continue
+                xkrFkType, xkrFNum, xkrFABN, extrec = unpack_extents_record(rec)
+                fork = {0: 'data', 0xFF: 'rsrc'}.get(xkrFkType)
+                self._overflow[xkrFNum, fork, xkrFABN] = extrec
+        return self._overflow
+
+    def records(self):
+        """List every catalog record as (ckrParID, ckrCName, cdrType, datarec), in key order"""
+        if self._records is None:
+            self._records = [unpack_catalog_record(rec) for rec in btree.dump_btree(self.special_file(4)) if rec[0]]
+        return self._records
+
+    def walk(self):
+        """Yield (path, cnid, datarec) for every file and folder but the root
+
+        path is a tuple of names (str) below the root folder, and datarec
+        is a DirRec or a FilRec. The order is that of the catalog, so
+        parents do not necessarily come before their children.
+        """
+        folders = {} # cnid -> (parent cnid, name)
+        for ckrParID, ckrCName, cdrType, datarec in self.records():
+            if cdrType == 1:
+                folders[datarec.dirDirID] = ckrParID, ckrCName
+
+        paths = {2: ()}
+        def path_of(cnid):
+            try:
+                return paths[cnid]
+            except KeyError:
+                parent, name = folders[cnid]
+                p = paths[cnid] = path_of(parent) + (name.decode('mac_roman'),)
+                return p
+
+        for ckrParID, ckrCName, cdrType, datarec in self.records():
+            if cdrType == 1 and datarec.dirDirID != 2:
+                yield path_of(datarec.dirDirID), datarec.dirDirID, datarec
+            elif cdrType == 2:
+                yield path_of(ckrParID) + (ckrCName.decode('mac_roman'),), datarec.filFlNum, datarec
+
+
+def count_free(bitmap, nblocks):
+    """Count the clear bits among the first nblocks of a volume bitmap"""
+    used = int.from_bytes(bitmap[:(nblocks+7)//8], 'big') >> (-nblocks % 8)
+    try:
+        return nblocks - used.bit_count()
+    except AttributeError: # Python < 3.10
+        return nblocks - bin(used).count('1')
+
+
+def stat(image, bitmap=True):
+    """Summarise a volume from its MDB (and bitmap) alone, without reading the catalog
+
+    image is a path, a binary file object or a bytes-like object. With
+    bitmap=True, bitmap_free_blocks is counted from the volume bitmap,
+    to check the MDB's drFreeBks. Otherwise it is None.
+    """
+    if isinstance(image, (str, os.PathLike)):
+        with compressed.open_image(image) as f:
+            return stat(f, bitmap)
+
+    readat, image_len = reader(image)
+    volstart, mdb = find_mdb(image)
+
+    bitmap_free_blocks = None
+    if bitmap:
+        vbm = readat(volstart + 512*mdb.drVBMSt, (mdb.drNmAlBlks+7)//8)
+        bitmap_free_blocks = count_free(vbm, mdb.drNmAlBlks)
+
+    return VolumeStat(
+        name=mdb.drVN.decode('mac_roman'),
+        crdate=mdb.drCrDate, mddate=mdb.drLsMod, bkdate=mdb.drVolBkUp,
+        offset=volstart, blksize=mdb.drAlBlkSiz,
+        total_blocks=mdb.drNmAlBlks, free_blocks=mdb.drFreeBks,
+        bitmap_free_blocks=bitmap_free_blocks,
+        files=mdb.drFilCnt, folders=mdb.drDirCnt,
+    )
+
+
+def layout(image, algorithm='sha256', digest_cache=None):
+    """Record where the forks of an image are, for Volume.write(layout=...)
+
+    image is a path, a binary file object or a bytes-like object. See
+    Catalog.layout for the format, and Catalog for digest_cache.
+    """
+    if isinstance(image, (str, os.PathLike)):
+        with compressed.open_image(image) as f:
+            return layout(f, algorithm, digest_cache)
+
+    return Catalog(image, digest_cache).layout(algorithm)
+
+
+def manifest(image, algorithm='sha256', digest_cache=None):
+    """List the path, CNID, type, creator, fork lengths and fork digests
+    of every file in an image, without extracting anything
+
+    image is a path, a binary file object or a bytes-like object.
+    algorithm is any name that hashlib.new accepts. See Catalog for
+    digest_cache.
+    """
+    if isinstance(image, (str, os.PathLike)):
+        with compressed.open_image(image) as f:
+            return manifest(f, algorithm, digest_cache)
+
+    return Catalog(image, digest_cache).manifest(algorithm)
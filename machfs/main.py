@@ -1,55 +1,65 @@
+import hashlib
+import inspect
+import os
 import struct
 from macresources import Resource, make_file, parse_file
-from . import btree, bitmanip
-from .directory import AbstractFolder, Folder, File
+from . import btree, bitmanip, image, forkio
+from .forkio import LazyFork
+from .directory import AbstractFolder, Folder, File, _TreeIndex
 
 
-def _catalog_rec_sort(b):
-    order = [
-        0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07,
-        0x08, 0x09, 0x0a, 0x0b, 0x0c, 0x0d, 0x0e, 0x0f,
-        0x10, 0x11, 0x12, 0x13, 0x14, 0x15, 0x16, 0x17,
-        0x18, 0x19, 0x1a, 0x1b, 0x1c, 0x1d, 0x1e, 0x1f,
-
-        0x20, 0x22, 0x23, 0x28, 0x29, 0x2a, 0x2b, 0x2c,
-        0x2f, 0x30, 0x31, 0x32, 0x33, 0x34, 0x35, 0x36,
-        0x37, 0x38, 0x39, 0x3a, 0x3b, 0x3c, 0x3d, 0x3e,
-        0x3f, 0x40, 0x41, 0x42, 0x43, 0x44, 0x45, 0x46,
-
-        0x47, 0x48, 0x58, 0x5a, 0x5e, 0x60, 0x67, 0x69,
-        0x6b, 0x6d, 0x73, 0x75, 0x77, 0x79, 0x7b, 0x7f,
-        0x8d, 0x8f, 0x91, 0x93, 0x96, 0x98, 0x9f, 0xa1,
-        0xa3, 0xa5, 0xa8, 0xaa, 0xab, 0xac, 0xad, 0xae,
-
-        0x54, 0x48, 0x58, 0x5a, 0x5e, 0x60, 0x67, 0x69,
-        0x6b, 0x6d, 0x73, 0x75, 0x77, 0x79, 0x7b, 0x7f,
-        0x8d, 0x8f, 0x91, 0x93, 0x96, 0x98, 0x9f, 0xa1,
-        0xa3, 0xa5, 0xa8, 0xaf, 0xb0, 0xb1, 0xb2, 0xb3,
-
-        0x4c, 0x50, 0x5c, 0x62, 0x7d, 0x81, 0x9a, 0x55,
-        0x4a, 0x56, 0x4c, 0x4e, 0x50, 0x5c, 0x62, 0x64,
-        0x65, 0x66, 0x6f, 0x70, 0x71, 0x72, 0x7d, 0x89,
-        0x8a, 0x8b, 0x81, 0x83, 0x9c, 0x9d, 0x9e, 0x9a,
-
-        0xb4, 0xb5, 0xb6, 0xb7, 0xb8, 0xb9, 0xba, 0x95,
-        0xbb, 0xbc, 0xbd, 0xbe, 0xbf, 0xc0, 0x52, 0x85,
-        0xc1, 0xc2, 0xc3, 0xc4, 0xc5, 0xc6, 0xc7, 0xc8,
-        0xc9, 0xca, 0xcb, 0x57, 0x8c, 0xcc, 0x52, 0x85,
-
-        0xcd, 0xce, 0xcf, 0xd0, 0xd1, 0xd2, 0xd3, 0x26,
-        0x27, 0xd4, 0x20, 0x4a, 0x4e, 0x83, 0x87, 0x87,
-        0xd5, 0xd6, 0x24, 0x25, 0x2d, 0x2e, 0xd7, 0xd8,
-        0xa7, 0xd9, 0xda, 0xdb, 0xdc, 0xdd, 0xde, 0xdf,
-
-        0xe0, 0xe1, 0xe2, 0xe3, 0xe4, 0xe5, 0xe6, 0xe7,
-        0xe8, 0xe9, 0xea, 0xeb, 0xec, 0xed, 0xee, 0xef,
-        0xf0, 0xf1, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7,
-        0xf8, 0xf9, 0xfa, 0xfb, 0xfc, 0xfd, 0xfe, 0xff,
-    ]
+_read_cache = None # parsed images, keyed by file identity, set by machfs.server
+
+_FINGERPRINT_VERSION = 2 # bump whenever Volume.write makes different images from the same input
+
+
+_CATALOG_ORDER = bytes([
+    0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07,
+    0x08, 0x09, 0x0a, 0x0b, 0x0c, 0x0d, 0x0e, 0x0f,
+    0x10, 0x11, 0x12, 0x13, 0x14, 0x15, 0x16, 0x17,
+    0x18, 0x19, 0x1a, 0x1b, 0x1c, 0x1d, 0x1e, 0x1f,
+
+    0x20, 0x22, 0x23, 0x28, 0x29, 0x2a, 0x2b, 0x2c,
+    0x2f, 0x30, 0x31, 0x32, 0x33, 0x34, 0x35, 0x36,
+    0x37, 0x38, 0x39, 0x3a, 0x3b, 0x3c, 0x3d, 0x3e,
+    0x3f, 0x40, 0x41, 0x42, 0x43, 0x44, 0x45, 0x46,
+
+    0x47, 0x48, 0x58, 0x5a, 0x5e, 0x60, 0x67, 0x69,
+    0x6b, 0x6d, 0x73, 0x75, 0x77, 0x79, 0x7b, 0x7f,
+    0x8d, 0x8f, 0x91, 0x93, 0x96, 0x98, 0x9f, 0xa1,
+    0xa3, 0xa5, 0xa8, 0xaa, 0xab, 0xac, 0xad, 0xae,
+
+    0x54, 0x48, 0x58, 0x5a, 0x5e, 0x60, 0x67, 0x69,
+    0x6b, 0x6d, 0x73, 0x75, 0x77, 0x79, 0x7b, 0x7f,
+    0x8d, 0x8f, 0x91, 0x93, 0x96, 0x98, 0x9f, 0xa1,
+    0xa3, 0xa5, 0xa8, 0xaf, 0xb0, 0xb1, 0xb2, 0xb3,
+
+    0x4c, 0x50, 0x5c, 0x62, 0x7d, 0x81, 0x9a, 0x55,
+    0x4a, 0x56, 0x4c, 0x4e, 0x50, 0x5c, 0x62, 0x64,
+    0x65, 0x66, 0x6f, 0x70, 0x71, 0x72, 0x7d, 0x89,
+    0x8a, 0x8b, 0x81, 0x83, 0x9c, 0x9d, 0x9e, 0x9a,
+
+    0xb4, 0xb5, 0xb6, 0xb7, 0xb8, 0xb9, 0xba, 0x95,
+    0xbb, 0xbc, 0xbd, 0xbe, 0xbf, 0xc0, 0x52, 0x85,
+    0xc1, 0xc2, 0xc3, 0xc4, 0xc5, 0xc6, 0xc7, 0xc8,
+    0xc9, 0xca, 0xcb, 0x57, 0x8c, 0xcc, 0x52, 0x85,
+
+    0xcd, 0xce, 0xcf, 0xd0, 0xd1, 0xd2, 0xd3, 0x26,
+    0x27, 0xd4, 0x20, 0x4a, 0x4e, 0x83, 0x87, 0x87,
+    0xd5, 0xd6, 0x24, 0x25, 0x2d, 0x2e, 0xd7, 0xd8,
+    0xa7, 0xd9, 0xda, 0xdb, 0xdc, 0xdd, 0xde, 0xdf,
+
+    0xe0, 0xe1, 0xe2, 0xe3, 0xe4, 0xe5, 0xe6, 0xe7,
+    0xe8, 0xe9, 0xea, 0xeb, 0xec, 0xed, 0xee, 0xef,
+    0xf0, 0xf1, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7,
+    0xf8, 0xf9, 0xfa, 0xfb, 0xfc, 0xfd, 0xfe, 0xff,
+])
 
+
+def _catalog_rec_sort(b):
     b = b[0] # we are only sorting keys!
 
-    return b[:4] + bytes(order[ch] for ch in b[5:])
+    return b[:4] + b[5:].translate(_CATALOG_ORDER)
 
 
 def _suggest_allocblk_size(volsize, minalign):
@@ -60,25 +70,6 @@ def _suggest_allocblk_size(volsize, minalign):
     return retval
 
 
-def _get_every_extent(nblocks, firstrecord, cnid, xoflow, fork):
-    accum = 0
-    extlist = []
-
-    for a, b in btree.unpack_extent_record(firstrecord):
-        if not b: continue
-        accum += b
-        extlist.append((a, b))
-
-    while accum < nblocks:
-        nextrecord = xoflow[cnid, fork, accum]
-        for a, b in btree.unpack_extent_record(nextrecord):
-            if not b: continue
-            accum += b
-            extlist.append((a, b))
-
-    return extlist
-
-
 def _encode_name(name, kind='file'):
     longest = {'file': 31, 'vol': 27, 'bb': 15}[kind]
 
@@ -112,7 +103,7 @@ def _link_aliases(vol_cr_date, cnid_dict): # vol creation date confirms within-v
     for cnid, obj in cnid_dict.items():
         try:
             if obj.flags & 0x8000:
-                alis_rsrc = next(r.data for r in parse_file(obj.rsrc) if r.type == b'alis')
+                alis_rsrc = next(r.data for r in parse_file(bytes(obj.rsrc)) if r.type == b'alis')
 
                 # print(hex(obj.flags))
                 # print(obj)
@@ -139,6 +130,96 @@ def _link_aliases(vol_cr_date, cnid_dict): # vol creation date confirms within-v
             pass
 
 
+_ICON_FAMILY = [b'ICN#', b'icl4', b'icl8', b'ics#', b'ics4', b'ics8']
+
+
+def _fork_digest(fork, algorithm, digest_cache=None):
+    key = None
+    if digest_cache is not None and isinstance(fork, LazyFork) and isinstance(fork.source, (str, bytes, os.PathLike)):
+        st = os.stat(fork.source) # only files on disk can be remembered
+        key = '%d:%d:%d:%d %s %r' % (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, algorithm, fork.runs)
+        try:
+            cached = digest_cache[key]
+        except KeyError:
+            pass
+        else:
+            return cached.decode('ascii') if isinstance(cached, bytes) else cached # from dbm
+
+    h = hashlib.new(algorithm)
+    for buf in (fork.chunks() if isinstance(fork, LazyFork) else [fork]):
+        h.update(buf)
+    digest = h.hexdigest()
+
+    if key is not None: digest_cache[key] = digest
+    return digest
+
+
+def _canonical(x):
+    """repr that does not depend on dict order, for fingerprints"""
+    if isinstance(x, dict):
+        return '{%s}' % ', '.join(sorted('%s: %s' % (_canonical(k), _canonical(v)) for (k, v) in x.items()))
+    elif isinstance(x, (list, tuple)):
+        return '[%s]' % ', '.join(_canonical(v) for v in x)
+    else:
+        return repr(x)
+
+
+def _desktop_file(bundles):
+    """Make the resource fork of a Finder Desktop file, as the Finder would
+
+    For each (creator, parent cnid, name, rsrc) with a BNDL resource, the
+    bundle and everything it refers to (signature, FREFs and icon
+    families) is copied in with fresh IDs, and the BNDL is rewritten to
+    match. The 'APPL' resource maps each creator to its application.
+    """
+    out = [Resource(b'STR ', 0, data=b'\x0AFinder 1.0')]
+    next_id = [128] # unique across types, so an icon family keeps a common ID
+    def copy(family):
+        for res in family:
+            out.append(Resource(res.type, next_id[0], name=res.name, data=res.data))
+        next_id[0] += 1
+        return next_id[0] - 1
+
+    appl = bytearray()
+    seen = set()
+
+    for creator, parent_cnid, name, rsrc in bundles:
+        if creator in seen: continue # the first copy of an app wins
+
+        try:
+            resources = {(r.type, r.id): r for r in parse_file(bytes(rsrc))}
+            bndl = next(r for r in resources.values() if r.type == b'BNDL')
+            owner, owner_id, ntypes = struct.unpack_from('>4shh', bndl.data)
+            if owner != creator: raise ValueError
+
+            newbndl = bytearray(bndl.data)
+            pos = 8
+            for i in range(ntypes + 1):
+                restype, nmaps = struct.unpack_from('>4sh', newbndl, pos)
+                pos += 6
+                for j in range(nmaps + 1):
+                    local_id, res_id = struct.unpack_from('>hh', newbndl, pos)
+                    family = _ICON_FAMILY if restype == b'ICN#' else [restype]
+                    members = [resources[t, res_id] for t in family if (t, res_id) in resources]
+                    if members:
+                        struct.pack_into('>h', newbndl, pos + 2, copy(members))
+                    pos += 4
+
+        except (ValueError, KeyError, StopIteration, struct.error):
+            continue # no usable bundle: the Finder will show a generic icon
+
+        seen.add(creator)
+        if (owner, owner_id) in resources:
+            struct.pack_into('>h', newbndl, 4, copy([resources[owner, owner_id]]))
+        copy([Resource(b'BNDL', 0, data=newbndl)])
+        appl.extend(struct.pack('>4sL', creator, parent_cnid) + bitmanip.pstring(name))
+
+    if appl:
+        out.append(Resource(b'APPL', 0, data=appl))
+
+    return make_file(out)
+
+
 def _defer_special_files(iter_paths):
     """Defer special files (aliases) to late CNIDs, and resolve aliases"""
     approved_dict = dict()
@@ -199,120 +280,198 @@ class Volume(AbstractFolder):
         self.crdate = self.mddate = self.bkdate = 0
         self.name = 'Untitled'
 
-    def read(self, from_volume):
-        for i in range(0, len(from_volume), 512):
-            if from_volume[i+1024:i+1024+2] == b'BD':
-                if i: from_volume = from_volume[i:]
-                break
-        else:
-            raise ValueError('Magic number not found in image')
-
-        drSigWord, drCrDate, drLsMod, drAtrb, drNmFls, \
-        drVBMSt, drAllocPtr, drNmAlBlks, drAlBlkSiz, drClpSiz, drAlBlSt, \
-        drNxtCNID, drFreeBks, drVN, drVolBkUp, drVSeqNum, \
-        drWrCnt, drXTClpSiz, drCTClpSiz, drNmRtDirs, drFilCnt, drDirCnt, \
-        drFndrInfo, drVCSize, drVBMCSize, drCtlCSize, \
-        drXTFlSize, drXTExtRec, \
-        drCTFlSize, drCTExtRec, \
-        = struct.unpack_from('>2sLLHHHHHLLHLH28pLHLLLHLL32sHHHL12sL12s', from_volume, 1024)
-
-        self.crdate, self.mddate, self.bkdate = drCrDate, drLsMod, drVolBkUp
-
-        block2offset = lambda block: 512*drAlBlSt + drAlBlkSiz*block
-        getextents = lambda extents: b''.join(from_volume[block2offset(firstblk):block2offset(firstblk+blkcnt)] for (firstblk, blkcnt) in extents)
-        getfork = lambda size, extrec1, cnid, fork: getextents(_get_every_extent((size+drAlBlkSiz-1)//drAlBlkSiz, extrec1, cnid, extoflow, fork))[:size]
-
-        extoflow = {}
-        for rec in btree.dump_btree(getfork(drXTFlSize, drXTExtRec, 3, 'data')):
-            if rec[0] != 7: continue
-            xkrFkType, xkrFNum, xkrFABN, extrec = struct.unpack_from('>xBLH12s', rec)
-            if xkrFkType == 0xFF:
-                fork = 'rsrc'
-            elif xkrFkType == 0:
-                fork = 'data'
-            extoflow[xkrFNum, fork, xkrFABN] = extrec
+    def read(self, from_volume, stats=None):
+        """Read a volume from a bytes-like image, or from a binary file object
 
-        cnids = {}
-        childlist = [] # list of (parent_cnid, child_name, child_object) tuples
+        Forks read from a file object are LazyFork objects that refer back
+        to the file, which must therefore stay open while they are used.
+        """
+        parsed = key = None
+        fd = forkio._fileno(from_volume)
+        if _read_cache is not None and fd is not None:
+            st = os.fstat(fd)
+            key = st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+            parsed = _read_cache.get(key)
 
-        prev_key = None
-        for rec in btree.dump_btree(getfork(drCTFlSize, drCTExtRec, 4, 'data')):
-            # create a directory tree from the catalog file
-            rec_len = rec[0]
-            if rec_len == 0: continue
+        if stats: stats.start('Volume.read')
 
-            key = rec[2:1+rec_len]
-            val = rec[bitmanip.pad_up(1+rec_len, 2):]
+        if parsed is None:
+            catalog = image.Catalog(from_volume)
+            mdb = catalog.mdb
 
-            # if prev_key: # Uncomment this to test the sort order with 20% performance cost!
-            #     if _catalog_rec_sort((prev_key,)) >= _catalog_rec_sort((key,)):
-            #         raise ValueError('Sort error: %r, %r' % (prev_key, key))
-            # prev_key = key
+            if stats: stats.lap('MDB', blksize=mdb.drAlBlkSiz, blocks=mdb.drNmAlBlks)
 
-            ckrParID, namelen = struct.unpack_from('>LB', key)
-            ckrCName = key[5:5+namelen]
+            catalog.overflow # parse the extents tree now, to time it separately
 
-            datatype = (None, 'dir', 'file', 'dthread', 'fthread')[val[0]]
-            datarec = val[2:]
+            if stats: stats.lap('extents tree', records=len(catalog.overflow), nodes=mdb.drXTFlSize//512)
 
-            # print(datatype + '\t' + repr(key))
-            # print('\t', datarec)
-            # print()
+            records = [] # (ckrParID, name as str, cdrType, datarec, fork runs or None)
+            for ckrParID, ckrCName, cdrType, datarec in catalog.records():
+                if cdrType == 1:
+                    records.append((ckrParID, ckrCName.decode('mac_roman'), cdrType, datarec, None))
+                elif cdrType == 2:
+                    records.append((ckrParID, ckrCName.decode('mac_roman'), cdrType, datarec,
+                        (catalog.fork_runs(datarec, 'data'), catalog.fork_runs(datarec, 'rsrc'))))
 
-            if datatype == 'dir':
-                dirFlags, dirVal, dirDirID, dirCrDat, dirMdDat, dirBkDat, dirUsrInfo, dirFndrInfo \
-                = struct.unpack_from('>HHLLLL16s16s', datarec)
+            parsed = mdb, records
+            if key is not None: _read_cache[key] = parsed # only the catalog, so nothing to copy on a hit
 
-                f = Folder()
-                cnids[dirDirID] = f
-                childlist.append((ckrParID, ckrCName, f))
+        mdb, records = parsed
+        self.crdate, self.mddate, self.bkdate = mdb.drCrDate, mdb.drLsMod, mdb.drVolBkUp
+
+        cnids = {}
+        childlist = [] # list of (parent_cnid, child_name, child_object) tuples
+        forklist = [] # list of (file_object, FilRec, fork runs) to get forks from
 
-                f.crdate, f.mddate, f.bkdate = dirCrDat, dirMdDat, dirBkDat
+        for ckrParID, name, cdrType, datarec, runs in records:
+            # create a directory tree from the catalog file (machfs.fsck checks its order)
+            if cdrType == 1:
+                f = Folder()
+                cnids[datarec.dirDirID] = f
+                childlist.append((ckrParID, name, f))
 
-            elif datatype == 'file':
-                filFlags, filTyp, filUsrWds, filFlNum, \
-                filStBlk, filLgLen, filPyLen, \
-                filRStBlk, filRLgLen, filRPyLen, \
-                filCrDat, filMdDat, filBkDat, \
-                filFndrInfo, filClpSize, \
-                filExtRec, filRExtRec, \
-                = struct.unpack_from('>BB16sLHLLHLLLLL16sH12s12sxxxx', datarec)
+                f.crdate, f.mddate, f.bkdate = datarec.dirCrDat, datarec.dirMdDat, datarec.dirBkDat
 
+            else:
                 f = File()
-                cnids[filFlNum] = f
-                childlist.append((ckrParID, ckrCName, f))
+                cnids[datarec.filFlNum] = f
+                childlist.append((ckrParID, name, f))
+
+                f.crdate, f.mddate, f.bkdate = datarec.filCrDat, datarec.filMdDat, datarec.filBkDat
+                f.type, f.creator, f.flags, f.x, f.y = struct.unpack_from('>4s4sHHH', datarec.filUsrWds)
+
+                forklist.append((f, datarec, runs))
 
-                f.crdate, f.mddate, f.bkdate = filCrDat, filMdDat, filBkDat
-                f.type, f.creator, f.flags, f.x, f.y = struct.unpack_from('>4s4sHHH', filUsrWds)
+        if stats: stats.lap('catalog', files=len(forklist), folders=len(childlist)-len(forklist), nodes=mdb.drCTFlSize//512)
 
-                f.data = getfork(filLgLen, filExtRec, filFlNum, 'data')
-                f.rsrc = getfork(filRLgLen, filRExtRec, filFlNum, 'rsrc')
+        for f, datarec, (data_runs, rsrc_runs) in forklist:
+            if hasattr(from_volume, 'read'): # as Catalog.fork would, but the runs may come from the cache
+                f.data, f.rsrc = LazyFork(from_volume, data_runs), LazyFork(from_volume, rsrc_runs)
+            else:
+                f.data = catalog.fork(datarec, 'data')
+                f.rsrc = catalog.fork(datarec, 'rsrc')
 
-            # elif datatype == 3:
-            #     print('dir thread:', rec)
-            # elif datatype == 4:
-            #     print('fil thread:', rec)
+        if stats: stats.lap('forks', bytes=sum(datarec.filLgLen + datarec.filRLgLen for (f, datarec, runs) in forklist))
 
-        for parent_cnid, child_name, child_obj in childlist:
-            if parent_cnid != 1:
-                parent_obj = cnids[parent_cnid]
-                parent_obj[child_name] = child_obj
+        attrs = tuple(self._index.tables) if self._index else ()
+        self._index = None # rebuilt below, in one pass
 
-        self.update(cnids[2])
+        cnids[2] = self # the root's children go straight in
+        self.add_children(((cnids[parent_cnid], child_name, child_obj)
+            for (parent_cnid, child_name, child_obj) in childlist if parent_cnid != 1), validate=False)
 
         self.pop('Desktop', None)
         self.pop('Desktop DB', None)
         self.pop('Desktop DF', None)
 
-        _link_aliases(drCrDate, cnids)
+        known_cnids = {id(obj): cnid for (cnid, obj) in cnids.items()}
+        known_cnids[id(self)] = 2
+        _TreeIndex(attrs).attach((), self, known_cnids)
+
+        if stats: stats.lap('tree')
+
+        _link_aliases(mdb.drCrDate, cnids)
+
+        if stats: stats.lap('aliases')
+
+    def fingerprint(self, size=800*1024, digest_cache=None, algorithm='sha256', **write_args):
+        """Hash everything that Volume.write(size, **write_args) depends on
+
+        That is, the tree with all its metadata, the digest of every fork,
+        and the arguments to write. Equal fingerprints mean equal images,
+        so a fingerprint can name a cached image. See image.Catalog for
+        digest_cache, which here remembers the digests of forks that are
+        LazyFork objects over files on disk.
+        """
+        h = hashlib.new(algorithm)
+        def put(*fields):
+            h.update(_canonical(fields).encode('utf8') + b'\n')
+
+        args = inspect.signature(Volume.write).bind(self, size, **write_args)
+        args.apply_defaults() # so that leaving out a default changes nothing
+        args = {k: v for (k, v) in args.arguments.items() if k not in ('self', 'in_place', 'new_layout', 'dest', 'stats')}
+        if args['layout'] is not None:
+            args['layout'] = {k: v for (k, v) in args['layout'].items() if k != 'objects'} # see new_layout
+        put('machfs fingerprint', _FINGERPRINT_VERSION, args)
+        put(self.name, self.crdate, self.mddate, self.bkdate)
+
+        paths = {id(obj): p for (p, obj) in self.iter_paths()}
+        for p, obj in self.iter_paths():
+            put(p, obj.crdate, obj.mddate, obj.bkdate, obj.flags, obj.x, obj.y)
+            if isinstance(obj, File):
+                target = obj.aliastarget
+                put(obj.type, obj.creator, obj.locked,
+                    None if target is None else paths.get(id(target), ()), # () is the root
+                    len(obj.data), _fork_digest(obj.data, algorithm, digest_cache),
+                    len(obj.rsrc), _fork_digest(obj.rsrc, algorithm, digest_cache))
+
+        return h.hexdigest()
+
+    def index_by(self, *attrs):
+        """Index the files in the volume by attributes such as 'type' and 'creator'
+
+        The indexes, and the CNIDs of anything read from an image, are kept
+        up to date as items are added to or removed from any folder in the
+        volume. Changing an attribute of a File that is already in the
+        volume is not noticed, so call index_by again after doing that.
+        Each folder should appear only once in the volume.
+        """
+        known_cnids = dict(self._index.cnid_of) if self._index else {}
+        _TreeIndex(attrs).attach((), self, known_cnids)
+
+    def find(self, within=(), **criteria):
+        """List (path, File) for every file whose attributes match, e.g. type=b'INIT'
+
+        within is the path of a folder to limit the search to. The time
+        taken depends on the number of results if any of the criteria is
+        indexed (see index_by), and on the size of the volume otherwise.
+        """
+        within = tuple(n.lower() for n in within)
+        index = self._index
+
+        candidates = None
+        for attr, value in criteria.items():
+            if index is not None and attr in index.tables:
+                these = index.tables[attr].get(value, {})
+                if candidates is None or len(these) < len(candidates):
+                    candidates = these
+        if candidates is not None:
+            candidates = list(candidates.values())
+        else:
+            candidates = ((path, obj) for (path, obj) in self.iter_paths() if not isinstance(obj, AbstractFolder))
+
+        return [(path, obj) for (path, obj) in candidates
+            if tuple(n.lower() for n in path[:len(within)]) == within
+            and all(getattr(obj, attr, None) == value for (attr, value) in criteria.items())]
+
+    def by_cnid(self, cnid):
+        """Get the file or folder that had this CNID in the image it was read from"""
+        if self._index is None:
+            raise KeyError(cnid)
+        return self._index.cnids[cnid]
+
+    def write(self, size=800*1024, align=512, desktopdb=True, bootable=True, startapp=None, placement='sequential', hotfiles=(),
+            catalog_spare=0, extents_spare=0, clumpsize=None, preallocate=None, layout=None, in_place=False, new_layout=None, sparse=False, dest=None, stats=None):
+        if stats: stats.start('Volume.write')
 
-    def write(self, size=800*1024, align=512, desktopdb=True, bootable=True, startapp=None, sparse=False):
         if align < 512 or align % 512:
             raise ValueError('align must be multiple of 512')
 
         if size < 400 * 1024 or size % 512:
             raise ValueError('size must be a multiple of 512b and >= 400K')
 
+        if placement not in ('sequential', 'boot'):
+            raise ValueError('placement must be sequential or boot')
+
+        if placement == 'boot' and layout is not None:
+            raise ValueError('placement=boot and layout cannot be used together')
+
+        if in_place and layout is None:
+            raise ValueError('in_place needs the layout of the image in dest')
+
+        if clumpsize is not None and clumpsize < 1:
+            raise ValueError('clumpsize must be positive')
+
         # These are declared up here because they are needed for aliases
         drVN = _encode_name(self.name, 'vol')
         drSigWord = b'BD'
@@ -343,20 +502,43 @@ class Volume(AbstractFolder):
 
         # decide how many alloc blocks there will be
         drNmAlBlks = (size - (5+bitmap_blk_cnt)*512) // drAlBlkSiz
-        blkaccum = []
+        blkaccum = {} # first block -> bytes or LazyFork, each padded out to whole blocks
+        blkcnt = 0 # blocks up to the last one allocated
+        gaps = [] # (first block, count) left free below blkcnt
+
+        def accumulate(x, physical=0, at=None):
+            # first fit, unless at is given, in which case return None if those blocks are taken
+            nonlocal blkcnt
+            nblocks = bitmanip.pad_up(len(x), drAlBlkSiz) // drAlBlkSiz
+            count = max(nblocks, bitmanip.pad_up(physical, drAlBlkSiz) // drAlBlkSiz)
+
+            if at is None:
+                at = next((start for (start, n) in gaps if n >= count), blkcnt)
+            elif at + count > drNmAlBlks:
+                return None
+
+            if at >= blkcnt:
+                if at > blkcnt: gaps.append((blkcnt, at - blkcnt))
+                blkcnt = at + count
+                if blkcnt > drNmAlBlks:
+                    raise OutOfSpaceError
+            else:
+                for i, (start, n) in enumerate(gaps):
+                    if start <= at and at + count <= start + n:
+                        gaps[i:i+1] = [g for g in [(start, at - start), (at + count, start + n - at - count)] if g[1]]
+                        break
+                else:
+                    return None
 
-        def accumulate(x):
-            blkaccum.extend(x)
-            if len(blkaccum) > drNmAlBlks:
-                raise OutOfSpaceError
+            if nblocks: blkaccum[at] = x
+            if count > nblocks: blkaccum[at + nblocks] = bytes((count - nblocks) * drAlBlkSiz) # preallocated room to grow into
+            return at, count
 
         # <<< put the empty extents overflow file in here >>>
-        extoflowfile = btree.make_btree([], bthKeyLen=7, blksize=drAlBlkSiz)
+        extoflowfile = btree.make_btree([], bthKeyLen=7, blksize=drAlBlkSiz, spare=extents_spare)
         # also need to do some cleverness to ensure that this gets picked up...
         drXTFlSize = len(extoflowfile)
-        drXTExtRec_Start = len(blkaccum)
-        accumulate(bitmanip.chunkify(extoflowfile, drAlBlkSiz))
-        drXTExtRec_Cnt = len(blkaccum) - drXTExtRec_Start
+        drXTExtRec_Start, drXTExtRec_Cnt = accumulate(extoflowfile)
 
         # write all the files in the volume
         topwrap = _TempWrapper(self)
@@ -366,15 +548,16 @@ class Volume(AbstractFolder):
         godwrap = _TempWrapper(None)
         godwrap.cnid = 1
 
-        root_dict_backup = self._prefdict
+        root_dict_backup = self._prefdict, self._maindict
         if desktopdb:
-            self._prefdict = dict(self._prefdict)
+            self._prefdict, self._maindict = dict(self._prefdict), dict(self._maindict)
+            index, self._index = self._index, None # the desktop files are only here while we write
             f = File()
             f.type, f.creator = b'FNDR', b'ERIK'
             f.flags = 0x4000 # invisible
-            f.rsrc = make_file([Resource(b'STR ', 0, data=b'\x0AFinder 1.0')])
-            self['Desktop'] = f
+            self['Desktop'] = f # resources filled in below, once CNIDs are known
             if size >= 2*1024*1024:
+                # Still empty: the Desktop Manager's records are not documented
                 f = File()
                 f.type, f.creator = b'BTFL', b'DMGR'
                 f.flags = 0x4000
@@ -384,20 +567,30 @@ class Volume(AbstractFolder):
                 f.type, f.creator = b'DTFL', b'DMGR'
                 f.flags = 0x4000
                 self['Desktop DF'] = f
+            self._index = index
 
         system_folder_cnid = 0
         startapp_folder_cnid = 0
         bootblocks = bytearray(1024)
+        bundles = [] # (creator, parent cnid, name, rsrc) for the Desktop file
+        bootfiles = [] # System and Finder, to go at the front with placement='boot'
+
+        if stats: stats.lap('setup', blksize=drAlBlkSiz, blocks=drNmAlBlks)
 
         path2wrap = {(): godwrap, (self.name,): topwrap}
         drNxtCNID = 16
+        wraps = []
         for path, obj, aliastarget in _defer_special_files(self.iter_paths()):
             path = (self.name,) + path
             wrap = _TempWrapper(obj)
             path2wrap[path] = wrap
             wrap.path = path
             wrap.cnid = drNxtCNID; drNxtCNID += 1
+            wraps.append((path, obj, aliastarget, wrap))
+
+        if stats: stats.lap('walk', objects=len(wraps))
 
+        for path, obj, aliastarget, wrap in wraps:
             if isinstance(obj, File) and obj.type.upper() == b'ZSYS':
                 try:
                     sysname = path[-1]
@@ -405,7 +598,7 @@ class Volume(AbstractFolder):
                     fellows = path2wrap[path[:-1]].of.items()
                     fndrname = next(n for (n, o) in fellows if isinstance(o, File) and o.type == b'FNDR')
 
-                    sysresources = parse_file(obj.rsrc)
+                    sysresources = parse_file(bytes(obj.rsrc))
                     boot1 = next(r for r in sysresources if (r.type, r.id) == (b'boot', 1))
                     bb = bytearray(boot1.data)
                     if len(bb) != 1024: raise ValueError
@@ -419,6 +612,7 @@ class Volume(AbstractFolder):
                 else:
                     bootblocks[:] = bb
                     system_folder_cnid = path2wrap[path[:-1]].cnid
+                    bootfiles = [path[1:], path[1:-1] + (fndrname,)]
 
             if isinstance(obj, File) and startapp and path[1:] == tuple(startapp):
                 startapp_folder_cnid = path2wrap[path[:-1]].cnid
@@ -427,6 +621,9 @@ class Volume(AbstractFolder):
                 wrap.data, wrap.rsrc = obj.data, obj.rsrc
                 wrap.type, wrap.creator = obj.type, obj.creator
 
+                if desktopdb and aliastarget is None and (obj.type == b'APPL' or obj.flags & 0x2000): # kHasBundle
+                    bundles.append((obj.creator, path2wrap[path[:-1]].cnid, _encode_name(path[-1]), obj.rsrc))
+
             # This is the place to manage your special files (aliases for now)
             if aliastarget is not None:
                 aliastarget = (self.name,) + aliastarget # match the convention for this function
@@ -491,97 +688,172 @@ class Volume(AbstractFolder):
 
                 wrap.rsrc = make_file([alis])
 
-            if isinstance(obj, File):
-                wrap.dfrk = wrap.rfrk = (0, 0)
-                if wrap.data:
-                    pre = len(blkaccum)
-                    accumulate(bitmanip.chunkify(wrap.data, drAlBlkSiz))
-                    wrap.dfrk = (pre, len(blkaccum)-pre)
-                if wrap.rsrc:
-                    pre = len(blkaccum)
-                    accumulate(bitmanip.chunkify(wrap.rsrc, drAlBlkSiz))
-                    wrap.rfrk = (pre, len(blkaccum)-pre)
-
-        self._prefdict = root_dict_backup
-
-        catalog = [] # (key, value) tuples
-
-        drFilCnt = 0
-        drDirCnt = -1 # to exclude the root directory
-
-        for path, wrap in path2wrap.items():
-            if wrap.cnid == 1: continue
-
-            obj = wrap.of
-            pstrname = bitmanip.pstring(_encode_name(path[-1], 'file'))
-
-            mainrec_key = struct.pack('>L', path2wrap[path[:-1]].cnid) + pstrname
-
-            if isinstance(wrap.of, File):
-                drFilCnt += 1
-
-                cdrType = 2
-                filFlags = 1 << 1 # file thread record exists, but is not locked, nor "file record is used"
-                filTyp = 0
-                filUsrWds = struct.pack('>4s4sHHHxxxxxx', wrap.type, wrap.creator, obj.flags, obj.x, obj.y)
-                filFlNum = wrap.cnid
-                filStBlk, filLgLen, filPyLen = wrap.dfrk[0], len(wrap.data), bitmanip.pad_up(len(wrap.data), drAlBlkSiz)
-                filRStBlk, filRLgLen, filRPyLen = wrap.rfrk[0], len(wrap.rsrc), bitmanip.pad_up(len(wrap.rsrc), drAlBlkSiz)
-                filCrDat, filMdDat, filBkDat = obj.crdate, obj.mddate, obj.bkdate
-                filFndrInfo = bytes(16) # todo must fix
-                filClpSize = 0 # todo must fix
-                filExtRec = struct.pack('>HHHHHH', *wrap.dfrk, 0, 0, 0, 0)
-                filRExtRec = struct.pack('>HHHHHH', *wrap.rfrk, 0, 0, 0, 0)
-
-                mainrec_val = struct.pack('>BxBB16sLHLLHLLLLL16sH12s12sxxxx',
-                    cdrType, \
-                    filFlags, filTyp, filUsrWds, filFlNum, \
-                    filStBlk, filLgLen, filPyLen, \
-                    filRStBlk, filRLgLen, filRPyLen, \
-                    filCrDat, filMdDat, filBkDat, \
-                    filFndrInfo, filClpSize, \
-                    filExtRec, filRExtRec, \
-                )
-
-            else: # assume directory
-                drDirCnt += 1
-
-                cdrType = 1
-                dirFlags = 0 # must fix
-                dirVal = len(wrap.of)
-                dirDirID = wrap.cnid
-                dirCrDat, dirMdDat, dirBkDat = obj.crdate, obj.mddate, obj.bkdate
-                dirUsrInfo = bytes(16)
-                dirFndrInfo = bytes(16)
-                mainrec_val = struct.pack('>BxHHLLLL16s16sxxxxxxxxxxxxxxxx',
-                    cdrType, dirFlags, dirVal, dirDirID,
-                    dirCrDat, dirMdDat, dirBkDat,
-                    dirUsrInfo, dirFndrInfo,
-                )
-
-            catalog.append((mainrec_key, mainrec_val))
-
-            thdrec_key = struct.pack('>Lx', wrap.cnid)
-            thdrec_val_type = 4 if isinstance(wrap.of, File) else 3
-            thdrec_val = struct.pack('>BxxxxxxxxxL', thdrec_val_type, path2wrap[path[:-1]].cnid) + pstrname
-
-            catalog.append((thdrec_key, thdrec_val))
+        if desktopdb:
+            path2wrap[self.name, 'Desktop'].rsrc = _desktop_file(bundles)
+
+        if stats: stats.lap('boot blocks and aliases', aliases=sum(a is not None for (p, o, a, w) in wraps), bundles=len(bundles))
+
+        def catalog_records(): # once the forks have blocks
+            catalog = [] # (key, value) tuples
+
+            drFilCnt = 0
+            drDirCnt = -1 # to exclude the root directory
+
+            for path, wrap in path2wrap.items():
+                if wrap.cnid == 1: continue
+
+                obj = wrap.of
+                pstrname = bitmanip.pstring(_encode_name(path[-1], 'file'))
+
+                mainrec_key = struct.pack('>L', path2wrap[path[:-1]].cnid) + pstrname
+
+                if isinstance(wrap.of, File):
+                    drFilCnt += 1
+
+                    cdrType = 2
+                    filFlags = 1 << 1 # file thread record exists, but is not locked, nor "file record is used"
+                    filTyp = 0
+                    filUsrWds = struct.pack('>4s4sHHHxxxxxx', wrap.type, wrap.creator, obj.flags, obj.x, obj.y)
+                    filFlNum = wrap.cnid
+                    filStBlk, filLgLen, filPyLen = wrap.dfrk[0], len(wrap.data), wrap.dfrk[1] * drAlBlkSiz
+                    filRStBlk, filRLgLen, filRPyLen = wrap.rfrk[0], len(wrap.rsrc), wrap.rfrk[1] * drAlBlkSiz
+                    filCrDat, filMdDat, filBkDat = obj.crdate, obj.mddate, obj.bkdate
+                    filFndrInfo = bytes(16) # todo must fix
+                    filClpSize = 0 # todo must fix
+                    filExtRec = struct.pack('>HHHHHH', *wrap.dfrk, 0, 0, 0, 0)
+                    filRExtRec = struct.pack('>HHHHHH', *wrap.rfrk, 0, 0, 0, 0)
+
+                    mainrec_val = struct.pack('>BxBB16sLHLLHLLLLL16sH12s12sxxxx',
+                        cdrType, \
+                        filFlags, filTyp, filUsrWds, filFlNum, \
+                        filStBlk, filLgLen, filPyLen, \
+                        filRStBlk, filRLgLen, filRPyLen, \
+                        filCrDat, filMdDat, filBkDat, \
+                        filFndrInfo, filClpSize, \
+                        filExtRec, filRExtRec, \
+                    )
+
+                else: # assume directory
+                    drDirCnt += 1
+
+                    cdrType = 1
+                    dirFlags = 0 # must fix
+                    dirVal = len(wrap.of)
+                    dirDirID = wrap.cnid
+                    dirCrDat, dirMdDat, dirBkDat = obj.crdate, obj.mddate, obj.bkdate
+                    dirUsrInfo = bytes(16)
+                    dirFndrInfo = bytes(16)
+                    mainrec_val = struct.pack('>BxHHLLLL16s16sxxxxxxxxxxxxxxxx',
+                        cdrType, dirFlags, dirVal, dirDirID,
+                        dirCrDat, dirMdDat, dirBkDat,
+                        dirUsrInfo, dirFndrInfo,
+                    )
+
+                catalog.append((mainrec_key, mainrec_val))
+
+                thdrec_key = struct.pack('>Lx', wrap.cnid)
+                thdrec_val_type = 4 if isinstance(wrap.of, File) else 3
+                thdrec_val = struct.pack('>BxxxxxxxxxL', thdrec_val_type, path2wrap[path[:-1]].cnid) + pstrname
+
+                catalog.append((thdrec_key, thdrec_val))
+
+            return catalog, drFilCnt, drDirCnt
+
+        order = [wrap for (path, obj, aliastarget, wrap) in wraps if isinstance(obj, File)]
+        for wrap in order:
+            wrap.dfrk = wrap.rfrk = (0, 0)
+
+        catalog_slot = None
+        if placement == 'boot':
+            # The catalog records are the same size whatever blocks the forks get,
+            # so a dummy catalog tells us how much room to leave at the front
+            catalog = catalog_records()[0]
+            catalog.sort(key=_catalog_rec_sort)
+            catalog_slot = accumulate(bytes(len(btree.make_btree(catalog, bthKeyLen=37, blksize=drAlBlkSiz, spare=catalog_spare))))
+
+            hot = bootfiles + [('Desktop',), ('Desktop DB',), ('Desktop DF',), startapp or ()] + list(hotfiles)
+            hot = [(self.name,) + tuple(p) for p in hot]
+            hot = [path2wrap[p] for p in dict.fromkeys(hot) if p in path2wrap and isinstance(path2wrap[p].of, File)]
+            hotset = set(hot)
+            order = hot + [wrap for wrap in order if wrap not in hotset]
+
+        # HFS names are case-insensitive, so preallocate's paths are too
+        preallocate = {tuple(n.lower() for n in p): v for (p, v) in (preallocate or {}).items()}
+
+        forks = [] # (wrap, extent attribute, fork name, contents, preallocated length)
+        for wrap in order:
+            data_min, rsrc_min = preallocate.get(tuple(n.lower() for n in wrap.path[1:]), (0, 0))
+            if wrap.data or data_min:
+                forks.append((wrap, 'dfrk', 'data', wrap.data, data_min))
+            if wrap.rsrc or rsrc_min:
+                forks.append((wrap, 'rfrk', 'rsrc', wrap.rsrc, rsrc_min))
+
+        algorithm = layout['algorithm'] if layout is not None else 'sha256'
+        digests = {} # (path, fork): digest, as far as known, for new_layout
+        allforks = forks
+
+        kept = set() # first blocks of the forks that layout kept where they were
+        if layout is not None and layout['blksize'] == drAlBlkSiz:
+            # Unchanged forks go back where they were, and the rest fill in around them
+            old = {(tuple(path), fork): (start, digest) for (path, fork, start, count, digest) in layout['forks']}
+            objects = layout.get('objects', {}) # see new_layout
+            moved = []
+            for wrap, attr, fork, x, physical in forks:
+                key = wrap.path[1:], fork
+                start, digest = old.get(key, (None, None))
+                extent = None
+                if start is not None:
+                    if not (objects.get(key) is x and isinstance(x, (bytes, LazyFork))): # immutable, so no need to look
+                        digests[key] = _fork_digest(x, algorithm)
+                    if digests.setdefault(key, digest) == digest:
+                        extent = accumulate(x, physical, at=start)
+                if extent is None:
+                    moved.append((wrap, attr, fork, x, physical))
+                else:
+                    setattr(wrap, attr, extent)
+                    kept.add(extent[0])
+            forks = moved
+
+        for wrap, attr, fork, x, physical in forks:
+            setattr(wrap, attr, accumulate(x, physical))
+
+        if stats: stats.lap('allocate forks', forks=sum(bool(w.dfrk[1]) + bool(w.rfrk[1]) for w in order), bytes=sum(len(x) for x in blkaccum.values()), blocks=blkcnt)
+
+        catalog, drFilCnt, drDirCnt = catalog_records()
+
+        # Count the root before putting back the dict without the desktop files
+        drNmFls = sum(isinstance(x, File) for x in self.values())
+        drNmRtDirs = sum(not isinstance(x, File) for x in self.values())
+
+        self._prefdict, self._maindict = root_dict_backup
 
+        if stats: stats.lap('catalog records', files=drFilCnt, folders=drDirCnt+1, records=len(catalog))
 
         # now it is time to sort these records! fuck that shit...
         catalog.sort(key=_catalog_rec_sort)
-        catalogfile = btree.make_btree(catalog, bthKeyLen=37, blksize=drAlBlkSiz)
+
+        if stats: stats.lap('catalog sort', records=len(catalog))
+
+        catalogfile = btree.make_btree(catalog, bthKeyLen=37, blksize=drAlBlkSiz, spare=catalog_spare)
+
+        if stats: stats.lap('make_btree', nodes=len(catalogfile)//512)
         # also need to do some cleverness to ensure that this gets picked up...
         drCTFlSize = len(catalogfile)
-        drCTExtRec_Start = len(blkaccum)
-        accumulate(bitmanip.chunkify(catalogfile, drAlBlkSiz))
-        drCTExtRec_Cnt = len(blkaccum) - drCTExtRec_Start
+        if catalog_slot is None:
+            drCTExtRec_Start, drCTExtRec_Cnt = accumulate(catalogfile)
+        else:
+            drCTExtRec_Start, drCTExtRec_Cnt = catalog_slot
+            blkaccum[drCTExtRec_Start] = catalogfile # in place of the dummy, right after the extents file
 
-        if len(blkaccum) > drNmAlBlks:
+        if blkcnt > drNmAlBlks:
             raise ValueError('Does not fit!')
 
         # Create the bitmap of free volume allocation blocks
-        bitmap = bitmanip.bits(bitmap_blk_cnt * 512 * 8, len(blkaccum))
+        bitmap = bytearray(bitmanip.bits(bitmap_blk_cnt * 512 * 8, blkcnt))
+        for start, n in gaps:
+            for blk in range(start, start + n):
+                bitmap[blk // 8] &= ~(0x80 >> (blk % 8))
+        bitmap = bytes(bitmap)
 
         # Set the startup app
         if system_folder_cnid and startapp_folder_cnid:
@@ -591,13 +863,11 @@ class Volume(AbstractFolder):
                 startapp_folder_cnid = 0
 
         # Create the Volume Information Block
-        drNmFls = sum(isinstance(x, File) for x in self.values())
-        drNmRtDirs = sum(not isinstance(x, File) for x in self.values())
         drVBMSt = 3 # first block of volume bitmap
         drAllocPtr = 0
-        drClpSiz = drXTClpSiz = drCTClpSiz = drAlBlkSiz
+        drClpSiz = drXTClpSiz = drCTClpSiz = bitmanip.pad_up(clumpsize or drAlBlkSiz, drAlBlkSiz)
         drAlBlSt = 3 + bitmap_blk_cnt
-        drFreeBks = drNmAlBlks - len(blkaccum)
+        drFreeBks = drNmAlBlks - blkcnt + sum(n for (start, n) in gaps)
         drWrCnt = 0 # ????volume write count
         drVCSize = drVBMCSize = drCtlCSize = 0
         drVolBkUp = 0                  # date and time of last backup
@@ -615,18 +885,66 @@ class Volume(AbstractFolder):
         )
         vib += bytes(512-len(vib))
 
-        assert all(len(x) == drAlBlkSiz for x in blkaccum)
-        left_elements = [bootblocks, vib, bitmap, *blkaccum]
+        left_elements = [bootblocks, vib, bitmap]
+        unchanged = set() # indices into left_elements of forks already in dest
+        here = 0 # blocks so far
+        for start, x in sorted(blkaccum.items()):
+            if start > here: left_elements.append(bytes((start - here) * drAlBlkSiz)) # a gap
+            if start in kept: unchanged.add(len(left_elements))
+            left_elements.append(x)
+            slop = -len(x) % drAlBlkSiz
+            if slop: left_elements.append(bytes(slop))
+            here = start + (len(x) + slop) // drAlBlkSiz
 
         unused_offset = sum(len(x) for x in left_elements)
         unused_length = size - unused_offset - 2*512
 
         right_elements = [vib, bytes(512)]
 
+        if stats: stats.lap('bitmap and MDB', free=drFreeBks)
+
+        if new_layout is not None:
+            # As image.layout would find, but only digesting the forks not already known
+            new_layout.clear()
+            new_layout.update(blksize=drAlBlkSiz, offset=(0 if dest is None else dest.tell()) + 512*drAlBlSt,
+                algorithm=algorithm, forks=[], objects={})
+            for wrap, attr, fork, x, physical in allforks:
+                first, count = getattr(wrap, attr)
+                if not count: continue
+                key = wrap.path[1:], fork
+                if key not in digests: digests[key] = _fork_digest(x, algorithm)
+                new_layout['forks'].append([list(key[0]), fork, first, count, digests[key]])
+                new_layout['objects'][key] = x
+
+        if dest is not None:
+            # Forks in native files go straight to the destination file
+            pos = dest.tell()
+            if not (in_place and layout.get('offset') == pos + 512*drAlBlSt):
+                unchanged = set() # dest does not hold the image the layout came from
+            for i, x in enumerate(left_elements):
+                if i in unchanged:
+                    pass # the same bytes are there already
+                elif isinstance(x, LazyFork):
+                    x.copy_to(dest, pos)
+                else:
+                    dest.seek(pos)
+                    dest.write(x)
+                pos += len(x)
+            dest.seek(pos + unused_length)
+            for x in right_elements:
+                dest.write(x)
+            if stats: stats.lap('copy to dest', bytes=unused_offset+1024)
+            return
+
+        left_elements = [bytes(x) if isinstance(x, LazyFork) else x for x in left_elements]
+
         if sparse:
-            return b''.join(left_elements), unused_length, b''.join(right_elements)
+            retval = b''.join(left_elements), unused_length, b''.join(right_elements)
         else:
             all_elements = left_elements
             all_elements.append(bytes(unused_length))
             all_elements.extend(right_elements)
-            return b''.join(all_elements)
+            retval = b''.join(all_elements)
+
+        if stats: stats.lap('join', bytes=size)
+        return retval
@@ -0,0 +1,185 @@
+import collections
+import collections.abc
+import io
+import json
+import os
+from os import path
+import runpy
+import socket
+import socketserver
+import struct
+import sys
+import traceback
+from . import directory, main
+
+
+TOOLS = ('MakeHFS', 'DumpHFS', 'StatHFS', 'FsckHFS', 'DiffHFS', 'ManifestHFS')
+
+
+def default_socket():
+    """$MACHFS_SOCKET, or a socket in $XDG_RUNTIME_DIR or /tmp"""
+    return os.environ.get('MACHFS_SOCKET') or \
+        path.join(os.environ.get('XDG_RUNTIME_DIR') or '/tmp', 'machfs-%d.sock' % os.getuid())
+
+
+class LRUCache(collections.abc.MutableMapping):
+    """A dict that forgets the least recently used items beyond maxbytes
+
+    sizeof(value) says how many bytes each item costs. The newest item
+    is kept even if it is bigger than maxbytes on its own.
+    """
+
+    def __init__(self, maxbytes, sizeof=len):
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self._items = collections.OrderedDict() # key -> (value, size)
+
+    def __getitem__(self, key):
+        self._items.move_to_end(key)
+        return self._items[key][0]
+
+    def __setitem__(self, key, value):
+        if key in self._items: del self[key]
+        size = self.sizeof(value)
+        self._items[key] = value, size
+        self.nbytes += size
+        while self.nbytes > self.maxbytes and len(self._items) > 1:
+            del self[next(iter(self._items))]
+
+    def __delitem__(self, key):
+        value, size = self._items.pop(key)
+        self.nbytes -= size
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+
+def _catalog_size(parsed):
+    mdb, records = parsed # as Volume.read keeps them
+    return 1500 * len(records) # about what each record costs in memory, with its fork runs
+
+
+def run_tool(scripts_dir, tool, argv, cwd):
+    """Run a command-line tool in this process, as if from cwd
+
+    Returns (exit status, stdout bytes, stderr bytes). Standard input is
+    empty, so options like --from-tar - cannot be used.
+    """
+    script = path.join(scripts_dir, tool)
+    if tool not in TOOLS or not path.isfile(script):
+        return 127, b'', b'%s: not a tool that the server runs\n' % tool.encode()
+    if tool == 'MakeHFS' and '--watch' in argv:
+        return 2, b'', b'MakeHFS: --watch cannot run in the server\n'
+
+    out, err = io.BytesIO(), io.BytesIO()
+    saved = sys.argv, sys.stdin, sys.stdout, sys.stderr, os.getcwd()
+    sys.stdout = io.TextIOWrapper(out, write_through=True)
+    sys.stderr = io.TextIOWrapper(err, write_through=True)
+    try:
+        sys.argv = [script] + list(argv)
+        sys.stdin = io.TextIOWrapper(io.BytesIO())
+        os.chdir(cwd)
+        try:
+            runpy.run_path(script, run_name='__main__')
+            status = 0
+        except SystemExit as e:
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code, int):
+                status = e.code
+            else:
+                print(e.code, file=sys.stderr)
+                status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        return status, out.getvalue(), err.getvalue()
+    finally:
+        sys.argv, sys.stdin, sys.stdout, sys.stderr, cwd = saved
+        os.chdir(cwd)
+
+
+def _peer_uid(sock):
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None # not Linux, so rely on the socket's permissions
+    pid, uid, gid = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+    return uid
+
+
+def _listening(socket_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(socket_path)
+        except OSError:
+            return False
+        else:
+            return True
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        if _peer_uid(self.request) not in (None, os.getuid()):
+            return # only our own user may run tools as us
+
+        line = self.rfile.readline()
+        if not line:
+            return # e.g. another serve() checking whether we are running
+        request = json.loads(line)
+        status, out, err = run_tool(self.server.scripts_dir, request['tool'], request['argv'], request['cwd'])
+        header = dict(status=status, stdout=len(out), stderr=len(err))
+        self.wfile.write(json.dumps(header).encode('utf8') + b'\n' + out + err)
+
+
+def serve(socket_path=None, scripts_dir=None, cache_bytes=256*1024*1024):
+    """Serve HFSClient requests on a Unix socket until interrupted
+
+    Requests are run one at a time, in this process, by the scripts in
+    scripts_dir (by default, the folder this was started from). Parsed
+    image catalogs and compiled .rdump files are kept between requests,
+    up to cache_bytes of each, and are looked up by file identity, so a
+    changed file is read afresh.
+
+    The socket can only be used by this user. If another server is
+    already listening on it, FileExistsError is raised.
+
+    The protocol is a line of JSON (tool, argv, cwd) from the client,
+    answered by a line of JSON (status, and the lengths of stdout and
+    stderr) and then stdout and stderr.
+    """
+    socket_path = socket_path or default_socket()
+    scripts_dir = scripts_dir or path.dirname(path.realpath(sys.argv[0]))
+
+    if _listening(socket_path):
+        raise FileExistsError('a server is already listening on %s' % socket_path)
+    try:
+        os.remove(socket_path) # left over from last time
+    except FileNotFoundError:
+        pass
+
+    main._read_cache = LRUCache(cache_bytes, _catalog_size)
+    directory._rdump_cache = LRUCache(cache_bytes)
+    try:
+        umask = os.umask(0o177) # so that the socket is never usable by others, even briefly
+        try:
+            server = socketserver.UnixStreamServer(socket_path, _Handler)
+        finally:
+            os.umask(umask)
+        with server:
+            os.chmod(socket_path, 0o600)
+            server.scripts_dir = scripts_dir
+            server.serve_forever()
+    finally:
+        main._read_cache = directory._rdump_cache = None
+        try:
+            os.remove(socket_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,224 @@
+import collections
+import os
+import struct
+from multiprocessing import shared_memory
+from . import compressed, image
+
+
+SharedEntry = collections.namedtuple('SharedEntry', '''
+    path cnid type creator data_length rsrc_length
+''')
+
+# One segment holds, in order: the header, the entries sorted by CNID,
+# the entry numbers sorted by path key, the (offset, length) runs of
+# every fork, the path strings and the raw image
+_MAGIC = b'machfsSV'
+_HEADER = struct.Struct('<8sLL6Q') # magic, version, entry count, then the offset of each part and image length
+_ENTRY = struct.Struct('<LB4s4sQLLQLLLLLL')
+_ORDER = struct.Struct('<L')
+_RUN = struct.Struct('<QQ')
+_VERSION = 1
+
+
+def _path_key(path):
+    """Encode a path for the case-insensitive sorted index, as HFS compares names"""
+    return ':'.join(name.lower() for name in path).encode('utf8')
+
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False) # Python 3.13: only the publisher unlinks it
+    except TypeError:
+        return shared_memory.SharedMemory(name)
+
+
+class SharedImage:
+    """A parsed HFS image in shared memory, for a pool of worker processes
+
+    SharedImage.publish(image) reads the catalog of an image once and
+    copies the raw image and a table of every file and folder into one
+    multiprocessing.shared_memory segment. Pass the SharedImage to the
+    workers, by pickling (as pool.map does) or by name, and each attaches
+    to the same segment. Lookups by path or CNID are binary searches in
+    the table, and forks are memoryviews into the image, so nothing is
+    parsed or copied again.
+
+    The publisher owns the segment: leaving its with block (or calling
+    unlink) frees it. Start the pool from the publishing process, so that
+    the workers share its resource tracker. Memoryviews handed out must
+    be released before close().
+    """
+
+    def __init__(self, name):
+        self._shm = _attach(name)
+        self._owner = False
+        self._setup()
+
+    @classmethod
+    def publish(cls, image_or_path, name=None):
+        """Copy an image (a path, a binary file object or a bytes-like object) into shared memory"""
+        if isinstance(image_or_path, (str, os.PathLike)):
+            with compressed.open_image(image_or_path) as f:
+                return cls.publish(f, name)
+
+        catalog = image.Catalog(image_or_path)
+        entries, runs, strings = [], [], bytearray()
+        for path, cnid, datarec in catalog.walk():
+            hfspath = ':'.join(path).encode('mac_roman')
+            key = _path_key(path)
+            row = [cnid, isinstance(datarec, image.DirRec), b'', b'']
+            if isinstance(datarec, image.FilRec):
+                row[2:4] = datarec.filUsrWds[:4], datarec.filUsrWds[4:8]
+                for fork, length in [('data', datarec.filLgLen), ('rsrc', datarec.filRLgLen)]:
+                    forkruns = catalog.fork_runs(datarec, fork)
+                    row += [length, len(runs), len(forkruns)]
+                    runs.extend(forkruns)
+            else:
+                row += [0, 0, 0, 0, 0, 0]
+            row += [len(strings), len(hfspath), len(strings) + len(hfspath), len(key)]
+            strings += hfspath + key
+            entries.append(row)
+
+        entries.sort()
+        order = sorted(range(len(entries)), key=lambda i: strings[entries[i][-2]:entries[i][-2]+entries[i][-1]])
+
+        entries_off = _HEADER.size
+        order_off = entries_off + _ENTRY.size * len(entries)
+        runs_off = order_off + _ORDER.size * len(order)
+        strings_off = runs_off + _RUN.size * len(runs)
+        image_off = strings_off + len(strings)
+        image_len = catalog.length
+
+        shm = shared_memory.SharedMemory(name, create=True, size=max(image_off + image_len, 1))
+        try:
+            buf = shm.buf
+            _HEADER.pack_into(buf, 0, _MAGIC, _VERSION, len(entries),
+                entries_off, order_off, runs_off, strings_off, image_off, image_len)
+            for i, row in enumerate(entries):
+                _ENTRY.pack_into(buf, entries_off + _ENTRY.size*i, *row)
+            for i, n in enumerate(order):
+                _ORDER.pack_into(buf, order_off + _ORDER.size*i, n)
+            for i, run in enumerate(runs):
+                _RUN.pack_into(buf, runs_off + _RUN.size*i, *run)
+            buf[strings_off:image_off] = strings
+
+            pos = 0
+            while pos < image_len:
+                chunk = catalog.readat(pos, min(1<<20, image_len - pos))
+                if not chunk:
+                    raise ValueError('image ended %d bytes early' % (image_len - pos))
+                buf[image_off+pos:image_off+pos+len(chunk)] = chunk
+                pos += len(chunk)
+            del buf
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+
+        self = cls.__new__(cls)
+        self._shm = shm
+        self._owner = True
+        self._setup()
+        return self
+
+    def _setup(self):
+        self._buf = self._shm.buf
+        magic, version, self._count, self._entries_off, self._order_off, self._runs_off, \
+            self._strings_off, self._image_off, self._image_len = _HEADER.unpack_from(self._buf)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('%s is not a published SharedImage' % self._shm.name)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def image(self):
+        """The raw image, as a memoryview (which image.Catalog and Volume.read accept)"""
+        return self._buf[self._image_off:self._image_off+self._image_len]
+
+    def __reduce__(self):
+        return (SharedImage, (self.name,)) # workers attach rather than copy
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        if self._owner: self.unlink()
+
+    def close(self):
+        """Detach from the segment, which stays until the publisher unlinks it"""
+        if self._buf is not None:
+            self._buf.release()
+            self._buf = None
+            self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        """Yield a SharedEntry for every file and folder but the root, in CNID order"""
+        for i in range(self._count):
+            yield self._entry(i)
+
+    def _row(self, i):
+        return _ENTRY.unpack_from(self._buf, self._entries_off + _ENTRY.size*i)
+
+    def _entry(self, i):
+        cnid, isdir, typ, creator, dlen, drun, dn, rlen, rrun, rn, poff, plen, koff, klen = self._row(i)
+        start = self._strings_off + poff
+        path = tuple(bytes(self._buf[start:start+plen]).decode('mac_roman').split(':'))
+        if isdir:
+            return SharedEntry(path, cnid, None, None, None, None)
+        return SharedEntry(path, cnid, typ, creator, dlen, rlen)
+
+    def _find(self, key):
+        """Get the entry number of a CNID (int) or path (tuple of names), by binary search"""
+        lo, hi = 0, self._count
+        if isinstance(key, int):
+            while lo < hi:
+                mid = (lo + hi) // 2
+                cnid = self._row(mid)[0]
+                if cnid == key: return mid
+                if cnid < key: lo = mid + 1
+                else: hi = mid
+        else:
+            want = _path_key(key)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                i = _ORDER.unpack_from(self._buf, self._order_off + _ORDER.size*mid)[0]
+                koff, klen = self._row(i)[-2:]
+                start = self._strings_off + koff
+                got = bytes(self._buf[start:start+klen])
+                if got == want: return i
+                if got < want: lo = mid + 1
+                else: hi = mid
+        raise KeyError(key)
+
+    def entry(self, key):
+        """Look up a SharedEntry by CNID (int) or path (tuple of names, case-insensitive)"""
+        return self._entry(self._find(key))
+
+    def fork_views(self, key, fork='data'):
+        """Get a fork of a file as a list of memoryviews into the image, one per extent"""
+        row = self._row(self._find(key))
+        if row[1]:
+            raise ValueError('%r is a folder' % (key,))
+        first, n = row[5:7] if fork == 'data' else row[8:10]
+        views = []
+        for i in range(first, first + n):
+            offset, length = _RUN.unpack_from(self._buf, self._runs_off + _RUN.size*i)
+            start = self._image_off + offset
+            views.append(self._buf[start:start+length])
+        return views
+
+    def fork(self, key, fork='data'):
+        """Get a fork of a file as one memoryview into the image, or as bytes if it is fragmented"""
+        views = self.fork_views(key, fork)
+        if len(views) == 1:
+            return views[0]
+        return b''.join(views)
@@ -0,0 +1,83 @@
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+
+class Stats:
+    """Observer for where the time goes in Volume.read/write and read_folder/write_folder
+
+    Pass one as the stats argument to any of those methods. Each phase is
+    recorded in self.phases as a dict with 'operation' (e.g. 'Volume.write'),
+    'phase', 'seconds', 'maxrss' (process peak in bytes, where available)
+    and whatever counts the phase reports, such as 'bytes', 'files' or
+    'nodes'. With trace_memory=True, each phase also gets 'peak', the
+    tracemalloc peak during that phase, which is accurate but slow. Call
+    close(), or use the Stats as a context manager, to stop tracemalloc
+    again if this Stats started it.
+
+    The methods being observed only call start() and lap(), and only if
+    stats is not None, so there is no cost when it is.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.phases = []
+        self._t = None
+        self._op = None
+        self._started_tracing = False
+
+    def start(self, operation):
+        """Start timing the first phase of an operation"""
+        self._op = operation
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            tracemalloc.reset_peak()
+        self._t = time.perf_counter()
+
+    def lap(self, name, **counts):
+        """Finish a phase, and start timing the next one"""
+        t = time.perf_counter()
+        rec = {'operation': self._op, 'phase': name, 'seconds': t - self._t}
+        rec.update(counts)
+        if self.trace_memory:
+            rec['peak'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.reset_peak()
+        if resource is not None:
+            rec['maxrss'] = _maxrss()
+        self.phases.append(rec)
+        self._t = time.perf_counter() # don't charge our own overhead to the next phase
+
+    def close(self):
+        """Stop tracemalloc, if this Stats started it"""
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def total(self, key='seconds'):
+        return sum(rec.get(key, 0) for rec in self.phases)
+
+    def __str__(self):
+        lines = []
+        for rec in self.phases:
+            counts = ' '.join('%s=%s' % (k, v) for (k, v) in rec.items() if k not in ('operation', 'phase', 'seconds'))
+            lines.append('%-40s %9.4fs  %s' % (rec['operation'] + ': ' + rec['phase'], rec['seconds'], counts))
+        lines.append('%-40s %9.4fs' % ('total', self.total()))
+        return '\n'.join(lines)
+
+
+def _maxrss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024 # kilobytes elsewhere
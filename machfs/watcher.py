@@ -0,0 +1,121 @@
+import ctypes
+import ctypes.util
+import os
+from os import path
+import select
+import struct
+import time
+
+
+_IN_MODIFY = 0x2
+_IN_ATTRIB = 0x4
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_Q_OVERFLOW = 0x4000
+_IN_ISDIR = 0x40000000
+_IN_CLOEXEC = 0o2000000
+
+_MASK = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF
+
+
+def watch(folder_path, interval=0.5, settle=0.05, poll=False):
+    """Yield a set of changed paths below folder_path, each time some change
+
+    Paths that changed together (within settle seconds) come in one set.
+    On Linux this uses inotify, and elsewhere (or with poll=True) it
+    compares a listing of the whole tree every interval seconds. The set
+    is empty if changes were lost and the whole tree should be reread.
+    """
+    if not poll:
+        try:
+            yield from _inotify_watch(folder_path, settle)
+            return
+        except OSError:
+            pass # no inotify, or out of watches
+    yield from _poll_watch(folder_path, interval)
+
+
+def _snapshot(folder_path):
+    snap = {}
+    for dirpath, dirnames, filenames in os.walk(folder_path):
+        for name in dirnames + filenames:
+            p = path.join(dirpath, name)
+            try:
+                st = os.lstat(p)
+            except OSError:
+                continue
+            snap[p] = st.st_mtime_ns, st.st_size, st.st_mode
+    return snap
+
+
+def _poll_watch(folder_path, interval):
+    before = _snapshot(folder_path)
+    while True:
+        time.sleep(interval)
+        after = _snapshot(folder_path)
+        changed = {p for p in before.keys() | after.keys() if before.get(p) != after.get(p)}
+        before = after
+        if changed:
+            yield changed
+
+
+class _Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(_IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {} # watch descriptor -> directory path
+
+    def add_tree(self, top):
+        for dirpath, dirnames, filenames in os.walk(top):
+            wd = self._add_watch(self.fd, os.fsencode(dirpath), _MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed on %s' % dirpath)
+            self.dirs[wd] = dirpath
+
+    def read(self):
+        buf = os.read(self.fd, 64 * 1024)
+        pos = 0
+        while pos < len(buf):
+            wd, mask, cookie, namelen = struct.unpack_from('iIII', buf, pos)
+            name = buf[pos+16:pos+16+namelen].rstrip(b'\0')
+            pos += 16 + namelen
+            yield wd, mask, os.fsdecode(name)
+
+
+def _inotify_watch(folder_path, settle):
+    ino = _Inotify()
+    try:
+        ino.add_tree(folder_path)
+        while True:
+            changed = set()
+            lost = False
+            timeout = None # block until the first event
+            while select.select([ino.fd], [], [], timeout)[0]:
+                for wd, mask, name in ino.read():
+                    if mask & _IN_Q_OVERFLOW:
+                        lost = True
+                        continue
+                    dirpath = ino.dirs.get(wd)
+                    if dirpath is None: continue
+                    if mask & _IN_DELETE_SELF:
+                        del ino.dirs[wd]
+                        continue
+                    p = path.join(dirpath, name)
+                    changed.add(p)
+                    if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+                        try:
+                            ino.add_tree(p) # a new folder: watch it too
+                        except OSError:
+                            lost = True # gone already, or out of watches
+                timeout = settle
+            yield set() if lost else changed
+    finally:
+        os.close(ino.fd)
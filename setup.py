@@ -18,5 +18,5 @@ setup(
     ],
     packages=['machfs'],
     install_requires=['macresources'],
-    scripts=['bin/MakeHFS', 'bin/DumpHFS'],
+    scripts=['bin/MakeHFS', 'bin/DumpHFS', 'bin/StatHFS', 'bin/FsckHFS', 'bin/DiffHFS', 'bin/ManifestHFS', 'bin/IndexHFS', 'bin/HFSServer', 'bin/HFSClient'],
 )
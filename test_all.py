@@ -71,3 +71,937 @@ def test_many_sizes():
     for s in sizes:
         ser = v.write(s-512)
         open('/tmp/SMALL-%X.dmg'%s, 'wb').write(ser)
+
+def test_lazy_fork_write():
+    import io, tempfile
+    with tempfile.TemporaryDirectory() as d:
+        with open(os.path.join(d, 'movie'), 'wb') as f:
+            f.write(b'frame' * 10000)
+
+        h = Volume()
+        h.read_folder(d, lazy=True)
+        assert isinstance(h['movie'].data, LazyFork)
+        expect = h.write(800*1024)
+
+        with open(os.path.join(d, 'image.dsk'), 'wb+') as f:
+            h.write(800*1024, dest=f)
+            f.seek(0)
+            assert f.read() == expect
+
+        b = io.BytesIO()
+        h.write(800*1024, dest=b)
+        assert b.getvalue() == expect
+
+    h2 = Volume()
+    h2.read(expect)
+    assert h2['movie'].data == b'frame' * 10000
+
+def test_lazy_fork_read():
+    import io, tempfile
+    h = Volume()
+    h['text'] = File()
+    h['text'].type = b'TEXT'
+    h['text'].data = b'line one\rline two\r'
+    h['bin'] = File()
+    h['bin'].data = bytes(range(256)) * 3000
+    h['bin'].rsrc = b'x' * 700
+    ser = h.write(4*1024*1024)
+
+    with tempfile.TemporaryDirectory() as d:
+        img = os.path.join(d, 'image.dsk')
+        with open(img, 'wb') as f:
+            f.write(bytes(4096) + ser) # make it look partitioned
+
+        h2 = Volume()
+        with open(img, 'rb') as f:
+            h2.read(f)
+            assert isinstance(h2['bin'].data, LazyFork)
+            assert h2['bin'].data == h['bin'].data
+            assert bytes(h2['bin'].rsrc) == b'x' * 700
+
+            os.mkdir(os.path.join(d, 'out'))
+            h2.write_folder(os.path.join(d, 'out'))
+
+        with open(os.path.join(d, 'out', 'bin'), 'rb') as f:
+            assert f.read() == h['bin'].data
+        with open(os.path.join(d, 'out', 'text'), 'rb') as f:
+            assert f.read() == b'line one\nline two\n'
+
+def test_write_tar():
+    import io, tarfile
+    h = Volume()
+    h['Folder'] = Folder()
+    h['Folder']['app'] = File()
+    h['Folder']['app'].type = b'APPL'
+    h['Folder']['app'].data = b'code' * 5000
+    h['alias'] = File()
+    h['alias'].flags |= 0x8000
+    h['alias'].aliastarget = h['Folder']['app']
+
+    h2 = Volume()
+    h2.read(io.BytesIO(h.write(800*1024)))
+
+    b = io.BytesIO()
+    h2.write_tar(b)
+    b.seek(0)
+    with tarfile.open(fileobj=b) as tar:
+        assert tar.getmember('Folder').isdir()
+        assert tar.extractfile('Folder/app').read() == b'code' * 5000
+        assert tar.extractfile('Folder/app.idump').read() == b'APPL????'
+        assert tar.getmember('alias').linkname == 'Folder/app'
+        assert tar.getmember('alias.idump').linkname == 'Folder/app.idump'
+
+    h2['Folder']['app'].rsrc = b'not a resource fork'
+    b = io.BytesIO()
+    h2.write_tar(b)
+    b.seek(0)
+    with tarfile.open(fileobj=b) as tar:
+        assert tar.extractfile('Folder/app.rdump.corrupt').read() == b'not a resource fork'
+        assert 'alias.rdump' not in tar.getnames() # like write_folder, link only what was written
+
+def test_read_archive():
+    import io, tarfile, zipfile
+    b = io.BytesIO()
+    with tarfile.open(fileobj=b, mode='w') as tar:
+        def add(name, data=b'', **kwargs):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            for k, v in kwargs.items(): setattr(info, k, v)
+            tar.addfile(info, io.BytesIO(data))
+        add('Src/Read Me.idump', b'TEXTttxt') # sidecar before data fork
+        add('Src/Read Me', b'caf\xc3\xa9\n')
+        add('Src/.DS_Store', b'junk')
+        add('link', type=tarfile.SYMTYPE, linkname='Src/Read Me')
+        add('outside', type=tarfile.SYMTYPE, linkname='../etc/passwd')
+
+    h = Volume()
+    h.read_archive(io.BufferedReader(io.BytesIO(b.getvalue())))
+    assert h['Src']['Read Me'].type == b'TEXT'
+    assert h['Src']['Read Me'].data == b'caf\x8e\r'
+    assert '.DS_Store' not in h['Src']
+    assert h['link'].aliastarget is h['Src']['Read Me']
+    assert 'outside' not in h
+
+    b = io.BytesIO()
+    with zipfile.ZipFile(b, 'w') as z:
+        z.writestr('a/b/c', b'deep')
+        z.writestr('a/b/c.idump', b'APPLabcd')
+    b.seek(0)
+    h = Volume()
+    h.read_archive(b)
+    assert h['a']['b']['c'].creator == b'abcd'
+
+def test_index_sidecar():
+    import io, tempfile
+    h = Volume()
+    h.crdate = 0x12345678
+    h['Folder'] = Folder()
+    h['Folder'].mddate = 0xAB000000
+    h['Folder']['doc'] = File()
+    h['Folder']['doc'].type, h['Folder']['doc'].creator = b'MPS ', b'\x00\xff\x80?'
+    h['Folder']['doc'].flags = 0x100
+    h['Folder']['doc'].mddate = 0xAB000001
+    h['alias'] = File()
+    h['alias'].aliastarget = h['Folder']['doc']
+
+    with tempfile.TemporaryDirectory() as d:
+        h.write_folder(d, index=True)
+        assert not os.path.exists(os.path.join(d, 'Folder', 'doc.idump'))
+        with open(os.path.join(d, 'Folder', 'other.idump'), 'wb') as f:
+            f.write(b'APPLotha') # per-file .idump still honoured
+        with open(os.path.join(d, 'Folder', 'other'), 'wb') as f:
+            pass
+
+        import json
+        with open(os.path.join(d, '.idump')) as f:
+            entries = json.load(f)
+        entries['Folder/doc'].update(data='x', _maindict={}, real_t=1, locked=True) # hand edits
+        entries['Folder']['type'] = 'APPL'
+        with open(os.path.join(d, '.idump'), 'w') as f:
+            json.dump(entries, f)
+
+        h2 = Volume()
+        h2.read_folder(d)
+
+    assert h2.crdate == 0x12345678
+    assert h2['Folder'].mddate == 0xAB000000
+    doc = h2['Folder']['doc']
+    assert (doc.type, doc.creator, doc.flags, doc.mddate) == (b'MPS ', b'\x00\xff\x80?', 0x100, 0xAB000001)
+    assert h2['Folder']['other'].type == b'APPL'
+    assert doc.data == b'' and doc.locked and not hasattr(doc, 'real_t') and not hasattr(h2['Folder'], 'type')
+    assert h2['alias'].aliastarget is doc
+
+    b = io.BytesIO()
+    h.write_tar(b, index=True)
+    b.seek(0)
+    h3 = Volume()
+    h3.read_archive(b)
+    assert h3['Folder']['doc'].creator == b'\x00\xff\x80?'
+    assert h3['alias'].aliastarget is h3['Folder']['doc']
+
+def test_fragmented_read():
+    from bench_all import fragmented_image
+    image, data = fragmented_image(scale=0.05)
+    h = Volume()
+    h.read(image)
+    assert h['frag'].data == data
+
+def test_stats():
+    h = Volume()
+    h['file'] = File()
+    h['file'].data = b'x' * 5000
+
+    stats = Stats()
+    ser = h.write(800*1024, stats=stats)
+    Volume().read(ser, stats=stats)
+    phases = {(rec['operation'], rec['phase']): rec for rec in stats.phases}
+    assert phases['Volume.write', 'allocate forks']['bytes'] >= 5000
+    assert phases['Volume.read', 'catalog']['files'] == 2 # including the Desktop file
+    assert 'total' in str(stats)
+
+    import tracemalloc
+    assert not tracemalloc.is_tracing()
+    with Stats(trace_memory=True) as stats:
+        h.write(800*1024, stats=stats)
+        assert tracemalloc.is_tracing()
+    assert not tracemalloc.is_tracing() and all('peak' in rec for rec in stats.phases)
+
+def test_stat():
+    import io
+    h = Volume()
+    h.name = 'StatMe'
+    h['file'] = File()
+    h['file'].data = b'x' * 100000
+    ser = h.write(800*1024)
+
+    st = stat(ser)
+    assert st.name == 'StatMe'
+    assert st.files == 2 # including the Desktop file
+    assert st.free_blocks == st.bitmap_free_blocks
+    assert st.total_blocks - st.free_blocks >= 100000 // st.blksize
+
+    assert stat(io.BytesIO(bytes(4096) + ser), bitmap=False).offset == 4096
+
+def test_fsck():
+    import bench_all
+    h = Volume()
+    h['Folder'] = Folder()
+    h['Folder']['File'] = File()
+    h['Folder']['File'].data = b'data' * 1000
+    h['Alias'] = File()
+    h['Alias'].aliastarget = h['Folder']
+    for size in [800*1024, 4*1024*1024]:
+        assert fsck(h.write(size)) == []
+
+    frag, data = bench_all.fragmented_image(0.01)
+    assert fsck(frag) == []
+
+    broken = bytearray(frag)
+    broken[512*3] ^= 0x80 # first block is used but now marked free
+    problems = fsck(bytes(broken))
+    assert [p.where for p in problems] == ['bitmap', 'MDB']
+    assert all(p.severity == 'error' for p in problems)
+    assert 'Fragmented:frag (data fork)' in problems[0].message
+
+def test_diff():
+    h = Volume()
+    h['Folder'] = Folder()
+    h['Folder']['same'] = File()
+    h['Folder']['same'].data = b'same' * 1000
+    h['Folder']['edited'] = File()
+    h['Folder']['edited'].data = b'1' * 5000
+    h['gone'] = File()
+    old = h.write(800*1024)
+
+    assert diff(old, old) == []
+
+    h['Folder']['edited'].data = b'2' * 5000 # same length, different contents
+    h['Folder']['edited'].type = b'TEXT'
+    del h['gone']
+    h['New'] = Folder()
+    new = h.write(800*1024)
+
+    assert diff(old, new) == [
+        Change('changed', ('Folder', 'edited'), ('type', 'data')),
+        Change('removed', ('gone',), ()),
+        Change('added', ('New',), ()),
+    ]
+    assert diff(old, new, digests=False, ignore=('type',)) == diff(old, new)[1:]
+
+def test_manifest():
+    import hashlib
+    import tempfile
+    h = Volume()
+    h['Folder'] = Folder()
+    h['Folder']['File'] = File()
+    h['Folder']['File'].type, h['Folder']['File'].creator = b'TEXT', b'ttxt'
+    h['Folder']['File'].data = b'data' * 1000
+    h['Folder']['File'].rsrc = b'rsrc' * 10
+
+    entries = {e.path: e for e in manifest(h.write(800*1024), 'md5')}
+    e = entries['Folder', 'File']
+    assert (e.type, e.creator, e.data_length, e.rsrc_length) == (b'TEXT', b'ttxt', 4000, 40)
+    assert e.data_digest == hashlib.md5(b'data' * 1000).hexdigest()
+    assert e.rsrc_digest == hashlib.md5(b'rsrc' * 10).hexdigest()
+
+    class CountingCache(dict):
+        hits = 0
+        def __getitem__(self, key):
+            value = super().__getitem__(key)
+            self.hits += 1
+            return value
+
+    cache = CountingCache()
+    with tempfile.TemporaryDirectory() as d:
+        img = os.path.join(d, 'image.dsk')
+        with open(img, 'wb') as f:
+            f.write(h.write(800*1024))
+
+        first = manifest(img, digest_cache=cache)
+        assert cache.hits == 0
+        assert manifest(img, digest_cache=cache) == first
+        assert cache.hits == 2 * len(first)
+
+    import io
+    for n in range(5): # images without a file descriptor must not share cached digests
+        h['Folder']['File'].data = b'%d' % n
+        flat = h.write(800*1024)
+        got = {e.path: e for e in image.Catalog(io.BytesIO(flat), cache).manifest('md5')}
+        assert got['Folder', 'File'].data_digest == hashlib.md5(b'%d' % n).hexdigest()
+
+def test_index_corpus():
+    import sqlite3
+    import tempfile
+    h = Volume()
+    h['MPW Shell'] = File()
+    h['MPW Shell'].type, h['MPW Shell'].creator = b'APPL', b'MPS '
+    h['MPW Shell'].data = b'shell'
+
+    with tempfile.TemporaryDirectory() as d:
+        os.mkdir(os.path.join(d, 'images'))
+        for name in ['a.dsk', 'b.dsk']:
+            with open(os.path.join(d, 'images', name), 'wb') as f:
+                f.write(h.write(800*1024))
+        with open(os.path.join(d, 'images', 'notes.txt'), 'w') as f:
+            f.write('not a disk image')
+        os.symlink('nowhere.dsk', os.path.join(d, 'images', 'dangling.dsk'))
+
+        db = os.path.join(d, 'index.sqlite')
+        assert index_corpus(os.path.join(d, 'images'), db, jobs=1) == (3, 0, 0, 1)
+
+        with sqlite3.connect(db) as conn:
+            found = conn.execute('''SELECT images.path, entries.path, data_length FROM entries
+                JOIN images ON images.id = entries.image_id WHERE creator = 'MPS ' ORDER BY images.path''').fetchall()
+        assert [(os.path.basename(i), p, n) for (i, p, n) in found] == [('a.dsk', 'MPW Shell', 5), ('b.dsk', 'MPW Shell', 5)]
+
+        os.remove(os.path.join(d, 'images', 'b.dsk'))
+        assert index_corpus(os.path.join(d, 'images'), db, jobs=1) == (0, 2, 1, 0)
+
+def test_indexes():
+    h = Volume()
+    h['System Folder'] = Folder()
+    for name in ['Extension A', 'Extension B']:
+        h['System Folder'][name] = File()
+        h['System Folder'][name].type, h['System Folder'][name].creator = b'INIT', b'abcd'
+    h['Elsewhere'] = Folder()
+    h['Elsewhere']['Extension C'] = File()
+    h['Elsewhere']['Extension C'].type = b'INIT'
+
+    v = Volume()
+    v.read(h.write(800*1024))
+    assert v.by_cnid(2) is v
+    assert v.by_cnid(16) is v['System Folder'] # CNIDs go in order of the walk
+
+    v.index_by('type', 'creator')
+    assert [p for (p, f) in v.find(type=b'INIT', within=('system folder',))] == \
+        [('System Folder', 'Extension A'), ('System Folder', 'Extension B')]
+    assert len(v.find(type=b'INIT')) == 3
+
+    v['System Folder']['Extension D'] = File()
+    v['System Folder']['Extension D'].creator = b'abcd' # changing it in place is not tracked...
+    assert len(v.find(creator=b'abcd')) == 2
+    v['System Folder']['Extension D'] = v['System Folder']['Extension D'] # ...but putting it back in is
+    assert len(v.find(creator=b'abcd')) == 3
+
+    ext_a = v['System Folder']['Extension A']
+    cnid = next(c for c in range(16, 32) if v.by_cnid(c) is ext_a)
+    del v['System Folder']
+    assert v.find(creator=b'abcd') == []
+    try:
+        v.by_cnid(cnid)
+    except KeyError:
+        pass
+    else:
+        assert False, 'deleted file still has a CNID'
+
+    v.write(800*1024) # must not index the desktop files
+    assert [p for (p, f) in v.find(type=b'INIT')] == [('Elsewhere', 'Extension C')]
+    assert v.find(type=b'FNDR') == []
+
+def test_open_fork():
+    import bench_all
+    import io
+    import tempfile
+    frag, data = bench_all.fragmented_image(0.01) # extents in the overflow file
+
+    with tempfile.TemporaryDirectory() as d:
+        img = os.path.join(d, 'frag.dsk')
+        with open(img, 'wb') as f:
+            f.write(frag)
+
+        for source in [open(img, 'rb'), io.BytesIO(frag)]:
+            with source:
+                v = Volume()
+                v.read(source)
+                with v['frag'].open_data() as f:
+                    assert isinstance(f, io.RawIOBase) and f.seekable()
+                    for pos in [0, 511, 512, 1000, 1535, len(data) - 3]:
+                        f.seek(pos)
+                        assert f.read(700) == data[pos:pos+700]
+                    assert f.seek(-10, io.SEEK_END) == len(data) - 10
+                    buf = bytearray(2000)
+                    assert f.readinto(buf) == 10
+                    assert buf[:10] == data[-10:]
+                    f.seek(0)
+                    assert f.read() == data
+                    assert f.read(1) == b''
+
+    f = File()
+    f.rsrc = b'in memory'
+    assert f.open_rsrc().read() == b'in memory'
+
+def test_desktop_file():
+    from machfs import image
+    from macresources import Resource, make_file, parse_file
+    import struct
+
+    bndl = struct.pack('>4shh', b'TEXT', 0, 1) # signature 0, two types
+    bndl += struct.pack('>4shhh', b'ICN#', 0, 0, 200)
+    bndl += struct.pack('>4shhh', b'FREF', 0, 0, 300)
+
+    app = File()
+    app.type, app.creator = b'APPL', b'TEXT'
+    app.rsrc = make_file([
+        Resource(b'BNDL', 128, data=bndl),
+        Resource(b'TEXT', 0, data=b'\x0cTeachText 1'),
+        Resource(b'ICN#', 200, data=bytes(256)),
+        Resource(b'ics#', 200, data=bytes(64)),
+        Resource(b'FREF', 300, data=b'APPL\x00\x00\x00'),
+    ])
+    v = Volume()
+    v['Apps'] = Folder()
+    v['Apps']['TeachText'] = app
+    v['Apps']['Readme'] = File() # no bundle, so not in the Desktop file
+
+    cat = image.Catalog(v.write(800*1024))
+    desktop = next(rec for (path, cnid, rec) in cat.walk() if path == ('Desktop',))
+    apps_cnid = next(cnid for (path, cnid, rec) in cat.walk() if path == ('Apps',))
+    res = {(r.type, r.id): r for r in parse_file(cat.fork(desktop, 'rsrc'))}
+
+    assert res[b'STR ', 0].data == b'\x0AFinder 1.0'
+    assert res[b'APPL', 0].data == b'TEXT' + struct.pack('>L', apps_cnid) + b'\x09TeachText'
+
+    newbndl = next(r for r in res.values() if r.type == b'BNDL').data
+    owner, owner_id, ntypes, icn, nicn, icn_local, icn_id, fref, nfref, fref_local, fref_id = \
+        struct.unpack('>4shh4shhh4shhh', newbndl)
+    assert res[b'TEXT', owner_id].data == b'\x0cTeachText 1'
+    assert res[b'ICN#', icn_id].data == bytes(256)
+    assert res[b'ics#', icn_id].data == bytes(64) # the whole family, under one ID
+    assert res[b'FREF', fref_id].data == b'APPL\x00\x00\x00'
+
+    big = [path for (path, cnid, rec) in image.Catalog(v.write(4*1024*1024)).walk()]
+    assert ('Desktop',) in big and ('Desktop DB',) in big and ('Desktop DF',) in big # as before, though still empty
+
+def test_boot_placement():
+    from machfs import image
+    from macresources import Resource, make_file
+    import struct
+
+    v = Volume()
+    v['Cold'] = File()
+    v['Cold'].data = b'cold' * 1000
+    v['System Folder'] = Folder()
+    v['System Folder']['System'] = File()
+    v['System Folder']['System'].type = b'ZSYS'
+    v['System Folder']['System'].rsrc = make_file([Resource(b'boot', 1, data=bytes(1024))])
+    v['System Folder']['Finder'] = File()
+    v['System Folder']['Finder'].type = b'FNDR'
+    v['System Folder']['Finder'].data = b'finder'
+    v['Apps'] = Folder()
+    v['Apps']['Hot'] = File()
+    v['Apps']['Hot'].data = b'hot'
+    v['Apps']['Start'] = File()
+    v['Apps']['Start'].data = b'start'
+
+    def first_blocks(**kwargs):
+        cat = image.Catalog(v.write(1440*1024, startapp=('Apps', 'Start'), **kwargs))
+        blocks = {'catalog': struct.unpack('>H', cat.mdb.drCTExtRec[:2])[0]}
+        for path, cnid, rec in cat.walk():
+            if isinstance(rec, image.FilRec):
+                blocks[path[-1]] = min(rec.filStBlk if rec.filLgLen else 0xFFFF, rec.filRStBlk if rec.filRLgLen else 0xFFFF)
+        return sorted(blocks, key=blocks.get)
+
+    assert first_blocks()[-1] == 'catalog'
+    order = first_blocks(placement='boot', hotfiles=[('Apps', 'Hot'), ('Nowhere',)])
+    assert order[:3] == ['catalog', 'System', 'Finder']
+    assert order.index('Start') < order.index('Hot') < order.index('Cold')
+
+    v2 = Volume()
+    v2.read(v.write(1440*1024, placement='boot'))
+    assert v2['Cold'].data == v['Cold'].data and v2['System Folder']['System'].rsrc == v['System Folder']['System'].rsrc
+    assert fsck(v.write(1440*1024, placement='boot')) == []
+
+def test_headroom():
+    from machfs import image
+    import struct
+
+    v = Volume()
+    v['Notes'] = File()
+    v['Notes'].data = b'growing'
+    v['Empty'] = File()
+    img = v.write(1440*1024, catalog_spare=40, extents_spare=10, clumpsize=4000,
+        preallocate={('NOTES',): (20000, 0), ('empty',): (0, 1000)})
+    assert fsck(img) == []
+
+    cat = image.Catalog(img)
+    assert cat.mdb.drClpSiz == cat.mdb.drCTClpSiz == cat.mdb.drXTClpSiz == 4096
+    for cnid, spare in [(3, 10), (4, 40)]:
+        header = cat.special_file(cnid)[14:14+32]
+        bthNNodes, bthFree = struct.unpack_from('>LL', header, 24)
+        assert bthFree >= spare
+
+    recs = {path: rec for (path, cnid, rec) in cat.walk()}
+    assert recs['Notes',].filLgLen == 7 and recs['Notes',].filPyLen == 20480
+    assert recs['Empty',].filRLgLen == 0 and recs['Empty',].filRPyLen == 1024
+
+    v2 = Volume()
+    v2.read(img)
+    assert v2['Notes'].data == b'growing' and v2['Empty'].rsrc == b''
+
+def test_stable_layout():
+    from machfs import image
+    import json
+
+    v = Volume()
+    for i in range(20):
+        v['file %02d' % i] = File()
+        v['file %02d' % i].data = bytes([i]) * 5000
+    old = v.write(1440*1024)
+
+    v['file 05'].data = bytes(20000) # grows, so must move
+    v['file 06'].data = b'shrinks'
+    v['new file'] = File()
+    v['new file'].data = b'new' * 1000
+
+    plain = v.write(1440*1024)
+    layout = json.loads(json.dumps(image.layout(old))) # survives a sidecar file
+    stable = v.write(1440*1024, layout=layout)
+    assert fsck(stable) == []
+
+    def changed(a, b):
+        return sum(a[i:i+512] != b[i:i+512] for i in range(0, len(a), 512))
+    assert changed(old, stable) < changed(old, plain) / 2
+
+    v2 = Volume()
+    v2.read(stable)
+    for name in v:
+        assert v2[name].data == v[name].data
+
+    with_pins = {tuple(path): start for (path, fork, start, count, digest) in image.layout(stable)['forks']}
+    for path, fork, start, count, digest in layout['forks']:
+        if path[0] not in ('file 05', 'file 06'):
+            assert with_pins[tuple(path)] == start
+
+    import io
+    class CountingIO(io.BytesIO):
+        written = 0
+        def write(self, b):
+            self.written += len(b)
+            return super().write(b)
+
+    dest = CountingIO(old)
+    v.write(1440*1024, layout=layout, in_place=True, dest=dest)
+    assert dest.getvalue() == stable
+    assert dest.written <= len(stable) - 17 * 5000 # the unchanged forks were left alone
+
+    dest = CountingIO(bytes(len(old)))
+    v.write(1440*1024, layout=dict(layout, offset=0), in_place=True, dest=dest)
+    assert dest.getvalue() == stable # the layout is not of dest, so everything is written
+
+    try:
+        v.write(1440*1024, in_place=True, dest=io.BytesIO())
+    except ValueError:
+        pass
+    else:
+        assert False, 'in_place without a layout'
+
+    new_layout = {}
+    assert v.write(1440*1024, layout=layout, new_layout=new_layout) == stable
+    found = image.layout(stable)
+    assert sorted(new_layout.pop('forks')) == sorted(found.pop('forks'))
+    assert new_layout.pop('objects') and new_layout == found
+
+    new_layout = {}
+    v.write(1440*1024, layout=layout, new_layout=new_layout)
+    v['file 07'].data = bytes([99]) * 5000
+    from machfs import main
+    digested = []
+    def counting(x, *args):
+        digested.append(x)
+        return fork_digest(x, *args)
+    fork_digest, main._fork_digest = main._fork_digest, counting
+    try:
+        again = v.write(1440*1024, layout=new_layout)
+    finally:
+        main._fork_digest = fork_digest
+    assert len(digested) == 2 and v['file 07'].data in digested # and the Desktop file, which is made afresh
+    assert again == v.write(1440*1024, layout=image.layout(stable))
+
+def test_update_folder():
+    import tempfile
+    import threading
+    from os import path
+    from machfs import watcher
+
+    with tempfile.TemporaryDirectory() as d:
+        v = Volume()
+        v['Folder'] = Folder()
+        v['Folder']['Doc'] = File()
+        v['Folder']['Doc'].data = b'first'
+        v['Folder']['Doc'].type = b'BINA'
+        v['Other'] = File()
+        v['Alias'] = File()
+        v['Alias'].aliastarget = v['Folder']['Doc']
+        v.write_folder(d)
+
+        v2 = Volume()
+        v2.read_folder(d)
+        doc = v2['Folder']['Doc']
+
+        with open(path.join(d, 'Folder', 'Doc'), 'wb') as f: f.write(b'second')
+        with open(path.join(d, 'Folder', 'Doc.idump'), 'wb') as f: f.write(b'TEXTttxt')
+        os.mkdir(path.join(d, 'New'))
+        with open(path.join(d, 'New', 'Inside'), 'wb') as f: f.write(b'inside')
+        os.remove(path.join(d, 'Other'))
+
+        changed = [path.join(d, 'Folder', 'Doc.idump'), path.join(d, 'Folder', 'Doc'), path.join(d, 'New'), path.join(d, 'Other')]
+        assert v2.update_folder(d, changed)
+        assert v2['Folder']['Doc'] is doc and doc.data == b'second' and doc.type == b'TEXT'
+        assert v2['Alias'].aliastarget is doc
+        assert v2['New']['Inside'].data == b'inside'
+        assert 'Other' not in v2
+
+        assert not v2.update_folder(d, [path.join(d, 'Alias')]) # symlinks need a fresh read_folder
+
+        for poll in [True, False]:
+            events = watcher.watch(d, interval=0.05, poll=poll)
+            got = []
+            t = threading.Thread(target=lambda: got.append(next(events)))
+            t.start()
+            time.sleep(0.2)
+            with open(path.join(d, 'Folder', 'Doc'), 'wb') as f: f.write(b'third' * (1 + poll))
+            t.join(5)
+            assert path.join(d, 'Folder', 'Doc') in got[0]
+
+def test_server_caches():
+    import json
+    import tempfile
+    from os import path
+    from machfs import server, main
+
+    lru = server.LRUCache(10)
+    lru['a'] = b'12345'
+    lru['b'] = b'12345'
+    lru['a'] # now b is the oldest
+    lru['c'] = b'123'
+    assert list(lru) == ['a', 'c'] and lru.nbytes == 8
+    lru['huge'] = bytes(100) # kept, alone
+    assert list(lru) == ['huge']
+
+    with tempfile.TemporaryDirectory() as d:
+        img = path.join(d, 'image.dsk')
+        v = Volume()
+        v['File'] = File()
+        v['File'].data = b'cached'
+        with open(img, 'wb') as f:
+            f.write(v.write(800*1024))
+
+        main._read_cache = server.LRUCache(1 << 20, server._catalog_size)
+        try:
+            for i in range(2):
+                with open(img, 'rb') as f:
+                    v2 = Volume()
+                    v2.read(f)
+                    assert v2['File'].data == b'cached'
+                    assert v2['File'].data.source is f # forks come from this file, not from memory
+                v2['File'].data = b'changed' # a fresh tree, so the cache is untouched
+            assert len(main._read_cache) == 1
+        finally:
+            main._read_cache = None
+
+        bindir = path.join(path.dirname(path.abspath(__file__)), 'bin')
+        status, out, err = server.run_tool(bindir, 'StatHFS', ['--json', 'image.dsk'], d)
+        assert status == 0 and json.loads(out)['files'] == 2 # and the Desktop file
+        status, out, err = server.run_tool(bindir, 'StatHFS', ['missing.dsk'], d)
+        assert status == 1 and b'missing.dsk' in err
+        assert server.run_tool(bindir, 'IndexHFS', [], d)[0] == 127
+
+        import socket
+        a, b = socket.socketpair()
+        assert server._peer_uid(a) in (None, os.getuid())
+        a.close(); b.close()
+
+        sock_path = path.join(d, 'sock')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as other:
+            other.bind(sock_path)
+            other.listen()
+            try: # must not take the socket from a running server
+                server.serve(sock_path, bindir)
+            except FileExistsError:
+                pass
+            else:
+                assert False
+        assert path.exists(sock_path)
+
+def test_image_cache():
+    import tempfile
+    from os import path
+    from machfs import buildcache
+
+    v = Volume()
+    v['Folder'] = Folder()
+    v['Folder']['File'] = File()
+    v['Folder']['File'].data = b'data'
+    v['Alias'] = File()
+    v['Alias'].aliastarget = v['Folder']['File']
+
+    fp = v.fingerprint(800*1024)
+    assert fp == v.fingerprint(800*1024, align=512, startapp=None) # defaults are defaults
+    assert fp != v.fingerprint(1440*1024)
+    assert fp != v.fingerprint(800*1024, startapp=('Folder', 'File'))
+    v['Folder']['File'].data = b'dat4'
+    assert fp != v.fingerprint(800*1024)
+    v['Folder']['File'].data = b'data'
+    v['Folder'].x = 10
+    assert fp != v.fingerprint(800*1024)
+    v['Folder'].x = 0
+    assert fp == v.fingerprint(800*1024)
+
+    with tempfile.TemporaryDirectory() as d:
+        src = path.join(d, 'src')
+        os.mkdir(src)
+        with open(path.join(src, 'File'), 'wb') as f:
+            f.write(b'lazy')
+        v2 = Volume()
+        v2.read_folder(src, lazy=True)
+        digests = {}
+        assert v2.fingerprint(digest_cache=digests) == v2.fingerprint(digest_cache=digests)
+        assert len(digests) == 1
+
+        cache = buildcache.ImageCache(path.join(d, 'cache'), maxbytes=1000*1024)
+        out = path.join(d, 'out.dsk')
+        assert not cache.fetch(fp, out)
+        with open(out, 'wb') as f:
+            f.write(v.write(800*1024))
+        cache.store(fp, out)
+        os.remove(out)
+        assert cache.fetch(fp, out)
+        with open(out, 'rb') as f:
+            assert f.read() == v.write(800*1024)
+
+        cache.store('other', out) # two 800k images do not fit, so the least recently used goes
+        assert not path.exists(cache.path(fp)) and path.exists(cache.path('other'))
+
+        linked = buildcache.ImageCache(path.join(d, 'linked'), link='hardlink')
+        linked.store('one', out)
+        assert os.stat(out).st_nlink == 2
+        assert buildcache.unshare(out) and not buildcache.unshare(out)
+        with open(out, 'r+b') as f:
+            f.write(b'changed')
+        with open(linked.path('one'), 'rb') as f:
+            assert f.read(7) != b'changed' # the cached image is untouched
+
+def test_compressed_image():
+    import bz2, gzip, lzma, tempfile
+    from os import path
+
+    v = Volume()
+    v.name = 'Zipped'
+    v['File'] = File()
+    v['File'].data = os.urandom(300000) + bytes(900000)
+    v['File'].rsrc = b'rsrc'
+    img = v.write(2048*1024)
+
+    with tempfile.TemporaryDirectory() as d:
+        for name, packed in [
+            ('one.img.gz', gzip.compress(img)),
+            ('two.img.gz', gzip.compress(img[:700000]) + gzip.compress(img[700000:])), # members, like bgzip
+            ('img.bz2', bz2.compress(img, 1)), # 100k blocks
+            ('img.xz', lzma.compress(img[:1000000]) + lzma.compress(img[1000000:])),
+        ]:
+            p = path.join(d, name)
+            with open(p, 'wb') as f:
+                f.write(packed)
+
+            assert manifest(p) == manifest(img)
+            assert stat(p) == stat(img)
+            assert fsck(p) == []
+            assert path.exists(p + '.idx')
+
+            with open_image(p) as f:
+                assert isinstance(f, CompressedImage)
+                assert len(f.units) > 1 or name == 'one.img.gz'
+                f.seek(1000001)
+                assert f.read(5000) == img[1000001:1005001]
+                f.seek(-10, 2)
+                assert f.read() == img[-10:]
+
+                v2 = Volume()
+                v2.read(f)
+                assert bytes(v2['File'].data) == v['File'].data
+                assert bytes(v2['File'].rsrc) == b'rsrc'
+
+            with open(p + '.idx', 'w') as f:
+                f.write('{"stamp": [0, 0]}') # stale, so rebuilt
+            with open_image(p) as f:
+                f.seek(123457)
+                assert f.read(100) == img[123457:123557]
+
+            if name.endswith('.bz2'): # the second block's magic straddles the first two windows
+                from machfs import compressed
+                with open(p, 'rb') as f:
+                    whole = compressed.build_index(f)
+                    chunk, compressed._CHUNK = compressed._CHUNK, whole['units'][1][1] // 8 + 3
+                    try:
+                        assert compressed.build_index(f) == whole
+                    finally:
+                        compressed._CHUNK = chunk
+
+
+def _shared_fork_length(args):
+    shared, key = args
+    return len(shared.fork(key)), bytes(shared.fork(key)[:4])
+
+
+def test_shared_image():
+    import concurrent.futures, pickle
+
+    v = Volume()
+    v['Folder'] = Folder()
+    v['Folder']['Text'] = File()
+    v['Folder']['Text'].type = b'TEXT'
+    v['Folder']['Text'].data = b'text' * 1000
+    v['Folder']['Text'].rsrc = b'rsrc'
+    v['Big'] = File()
+    v['Big'].data = os.urandom(100000)
+    img = v.write(800*1024)
+
+    with SharedImage.publish(img) as shared:
+        assert len(shared) == 4 # and the Desktop file
+        e = shared.entry(('folder', 'TEXT')) # case-insensitive
+        assert e.path == ('Folder', 'Text') and e.type == b'TEXT' and e.data_length == 4000
+        assert shared.entry(e.cnid) == e
+        assert shared.entry(('Folder',)).type is None
+        try:
+            shared.entry(('Nope',))
+        except KeyError:
+            pass
+        else:
+            assert False
+
+        view = shared.fork(e.cnid)
+        assert isinstance(view, memoryview) and view == v['Folder']['Text'].data
+        view.release()
+        assert bytes(shared.fork(('Folder', 'Text'), 'rsrc')) == b'rsrc'
+        assert b''.join(shared.fork_views(('Big',))) == v['Big'].data
+
+        other = pickle.loads(pickle.dumps(shared)) # attaches by name
+        assert [x.path for x in other] == [x.path for x in shared]
+        other.close()
+
+        with concurrent.futures.ProcessPoolExecutor(2) as pool:
+            got = list(pool.map(_shared_fork_length, [(shared, ('Big',)), (shared, ('Folder', 'Text'))]))
+        assert got == [(100000, v['Big'].data[:4]), (4000, b'text')]
+
+        v2 = Volume()
+        v2.read(bytes(shared.image))
+        assert v2['Folder']['Text'].data == v['Folder']['Text'].data
+
+
+def test_selective_dump():
+    import tempfile
+    from os import path
+
+    class Untouchable: # stands in for a fork that must not be read
+        def __len__(self): raise AssertionError('fork read')
+        def __bytes__(self): raise AssertionError('fork read')
+
+    v = Volume()
+    v['Sources'] = Folder()
+    v['Sources']['main.c'] = File()
+    v['Sources']['main.c'].type = b'TEXT'
+    v['Sources']['main.c'].data = b'int main;'
+    v['Sources']['Notes'] = File()
+    v['Sources']['Notes'].type = b'TEXT'
+    v['Sources']['Notes'].data = b'notes'
+    v['Sources']['Tool'] = File()
+    v['Sources']['Tool'].type = b'MPST'
+    v['Sources']['Tool'].data = v['Sources']['Tool'].rsrc = Untouchable()
+    v['Sources']['Old'] = Folder()
+    v['Sources']['Old']['old.c'] = File()
+    v['Sources']['Old']['old.c'].type = b'TEXT'
+    v['Sources']['Old']['old.c'].data = Untouchable()
+    v['Sources']['Empty'] = Folder()
+    v['Apps'] = Folder()
+    v['Apps']['App'] = File()
+    v['Apps']['App'].data = v['Apps']['App'].rsrc = Untouchable()
+
+    with tempfile.TemporaryDirectory() as d:
+        v.write_folder(d, include=['sources'], exclude=['Sources:Old'], types=[b'TEXT'])
+        got = sorted(path.relpath(path.join(dp, f), d) for (dp, dn, fn) in os.walk(d) for f in dn + fn)
+        assert got == ['Sources', 'Sources/Notes', 'Sources/Notes.idump', 'Sources/main.c', 'Sources/main.c.idump']
+
+    with tempfile.TemporaryDirectory() as d:
+        v.write_folder(d, include=['Sources:*.c', 'Sources:Empty'])
+        assert sorted(os.listdir(path.join(d, 'Sources'))) == ['Empty', 'main.c', 'main.c.idump']
+
+
+def test_add_paths():
+    v = Volume()
+    v.index_by('type')
+    v['Existing'] = Folder()
+
+    f = File()
+    f.type = b'TEXT'
+    v.add_paths([
+        (('Folder',), Folder()),
+        (('Folder', 'Inner'), Folder()),
+        (('Folder', 'Inner', 'File'), f),
+        (('existing', 'Other'), File()), # found case-insensitively in the tree
+        ((b'Bytes\x80',), File()),
+    ])
+    assert v['folder', 'INNER', 'file'] is f
+    assert 'Other' in v['Existing']
+    assert 'Bytes\xc4' in v
+    assert v.find(type=b'TEXT') == [(('Folder', 'Inner', 'File'), f)]
+
+    g = File()
+    g.type = b'TEXT'
+    v.add_children([(v['Folder'], 'File', g)], validate=False)
+    assert sorted(p for (p, obj) in v.find(type=b'TEXT')) == [('Folder', 'File'), ('Folder', 'Inner', 'File')]
+    v.add_children([(v['Folder']['Inner'], 'file', File())]) # replaces, and unindexes the old one
+    assert v.find(type=b'TEXT') == [(('Folder', 'File'), g)]
+
+    try:
+        v.add_paths([(('Missing', 'File'), File())])
+    except KeyError:
+        pass
+    else:
+        assert False
+
+    try:
+        v.add_paths([(('☃',), File())])
+    except UnicodeEncodeError:
+        pass
+    else:
+        assert False